@@ -0,0 +1,93 @@
+"""
+Benchmark the input decoding path of ``ClamsApp.annotate``.
+
+Compares the legacy path (``json.loads`` for envelope detection, then
+``json.dumps`` of the inner MMIF, then ``Mmif(str)`` which parses the
+string again for validation and deserialization) with the parse-once
+path (:func:`clams.envelop.load_input` followed by ``Mmif(dict)``),
+across a range of MMIF sizes. Both wall time and peak (Python-level)
+memory are reported.
+
+Usage::
+
+    python benchmarks/input_decode.py --sizes 1000 10000 100000
+"""
+import argparse
+import json
+import time
+import tracemalloc
+
+from mmif import AnnotationTypes, DocumentTypes, Mmif, Document
+
+from clams.envelop import create_envelope, is_envelope, load_input, unwrap_envelope
+
+
+def make_mmif(num_annotations: int) -> str:
+    """
+    Build a synthetic MMIF with a single view holding ``num_annotations``
+    TimeFrame annotations.
+    """
+    mmif = Mmif(validate=False)
+    vdoc = Document({'@type': DocumentTypes.VideoDocument,
+                     'properties': {'id': 'd1', 'location': 'file:///dummy.mp4'}})
+    mmif.add_document(vdoc)
+    view = mmif.new_view()
+    view.metadata.app = 'http://apps.clams.ai/benchmark/v1'
+    view.new_contain(AnnotationTypes.TimeFrame, document='d1', timeUnit='milliseconds')
+    for i in range(num_annotations):
+        view.new_annotation(AnnotationTypes.TimeFrame, start=i * 10, end=i * 10 + 9, label=f'label{i % 7}')
+    return mmif.serialize()
+
+
+def legacy_path(data: bytes) -> Mmif:
+    body = json.loads(data.decode('utf-8'))
+    if is_envelope(body):
+        mmif_str, _ = unwrap_envelope(body)
+        return Mmif(mmif_str)
+    return Mmif(data.decode('utf-8'))
+
+
+def parse_once_path(data: bytes) -> Mmif:
+    decoded, _ = load_input(data, {})
+    return Mmif(decoded)
+
+
+def measure(func, data, repeat):
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        func(data)
+        times.append(time.perf_counter() - t)
+    # memory is measured in a separate run, tracing slows down execution a lot
+    tracemalloc.start()
+    func(data)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(times), peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 10000, 50000],
+                        help='number of annotations in the synthetic MMIF (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per measurement, best time is kept')
+    parser.add_argument('--raw', action='store_true', help='benchmark raw MMIF input instead of envelopes')
+    args = parser.parse_args()
+
+    header = f"{'annotations':>12} {'body MiB':>9} {'legacy s':>9} {'once s':>9} {'speedup':>8} " \
+             f"{'legacy MiB':>11} {'once MiB':>9}"
+    print(header)
+    print('-' * len(header))
+    for size in args.sizes:
+        mmif_str = make_mmif(size)
+        body = mmif_str if args.raw else create_envelope(mmif_str, {'pretty': False})
+        data = body.encode('utf-8')
+        legacy_t, legacy_m = measure(legacy_path, data, args.repeat)
+        once_t, once_m = measure(parse_once_path, data, args.repeat)
+        mib = 1024 * 1024
+        print(f"{size:>12} {len(data) / mib:>9.1f} {legacy_t:>9.3f} {once_t:>9.3f} {legacy_t / once_t:>7.2f}x "
+              f"{legacy_m / mib:>11.1f} {once_m / mib:>9.1f}")
+
+
+if __name__ == '__main__':
+    main()
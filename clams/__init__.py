@@ -4,14 +4,16 @@ import sys
 import mmif
 from clams import develop
 from clams import envelop
+from clams import profiles
 from clams.app import *
 from clams.app import __all__ as app_all
 from clams.appmetadata import AppMetadata
 from clams.envelop import create_envelope
+from clams.pipeline import Pipeline
 from clams.restify import Restifier
 from clams.ver import __version__
 
-__all__ = [AppMetadata, Restifier] + app_all
+__all__ = [AppMetadata, Restifier, Pipeline] + app_all
 version_template = "{} (based on MMIF spec: {})"
 
 
@@ -35,6 +37,7 @@ def cli():
     # then add my own subcommands
     to_register.append(develop)
     to_register.append(envelop)
+    to_register.append(profiles)
     for cli_module in to_register:
         cli_module_name = cli_module.__name__.rsplit('.')[-1]
         cli_modules[cli_module_name] = cli_module
@@ -0,0 +1,206 @@
+"""
+Admission control of memory-hungry work.
+
+:class:`MemoryAdmission` holds back requests by memory: before a request
+runs, its memory need (an estimate) is compared with the
+memory currently available. If it doesn't fit, the request waits in a
+bounded queue until enough memory is freed, either by other requests of
+the same process finishing or by other processes. A request that finds the
+queue full, or doesn't fit before its wait times out, is rejected with
+:class:`AdmissionRejected`, so that the caller can be told to retry later
+(e.g. with a HTTP ``503`` and a ``Retry-After`` header) instead of running
+out of memory.
+
+:class:`ConcurrencyLimit` holds back requests by count: only a fixed number
+of requests run at the same time, a bounded number of others wait for a
+free slot, and the rest are refused at once with :class:`TooManyRequests`
+(a HTTP ``429``).
+"""
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator, List, Optional
+
+
+class AdmissionRejected(Exception):
+    """
+    Raised when a request can't be admitted.
+
+    :param message: reason of the rejection
+    :param retry_after: suggested number of seconds to wait before retrying
+    """
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TooManyRequests(AdmissionRejected):
+    """
+    Raised when a request can't be admitted because too many requests are
+    already running or waiting.
+    """
+
+
+class MemoryAdmission(object):
+    """
+    Admits requests whose estimated memory need fits into the available
+    memory. Estimates of admitted requests that are still running in this
+    process are counted as used, so ``available`` should report memory
+    held by this process as available (the running requests' estimates
+    account for it).
+
+    :param available: returns the currently available memory in bytes, or
+                      None if unknown (then every request is admitted)
+    :param max_queue: maximum number of requests waiting for memory; a
+                      request that finds the queue full is rejected at once
+    :param timeout: maximum time in seconds a request waits for memory
+    :param poll_interval: how often (in seconds) waiting requests check the
+                          available memory, which can be freed by other
+                          processes without notice
+    """
+
+    def __init__(self, available: Callable[[], Optional[int]], max_queue: int = 8, timeout: float = 60.0,
+                 poll_interval: float = 0.5):
+        self.available = available
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.reserved = 0
+        self.waiting = 0
+        self._cond = threading.Condition()
+
+    def _fits(self, estimate: int) -> bool:
+        available = self.available()
+        if available is None:
+            return True
+        return estimate <= available - self.reserved
+
+    @property
+    def retry_after(self) -> int:
+        """
+        Suggested seconds to wait before retrying a rejected request.
+        """
+        return max(1, math.ceil(self.timeout / max(1, self.max_queue)))
+
+    @contextmanager
+    def admit(self, estimate: int) -> Iterator[None]:
+        """
+        Waits until the estimated memory need fits, and holds it as reserved
+        while the context is active.
+
+        :param estimate: estimated memory need in bytes
+        :raises AdmissionRejected: if the wait queue is full or the wait times out
+        """
+        with self._cond:
+            if not self._fits(estimate):
+                if self.waiting >= self.max_queue:
+                    raise AdmissionRejected(f"{self.waiting} request(s) already waiting for memory",
+                                            self.retry_after)
+                self.waiting += 1
+                try:
+                    deadline = time.monotonic() + self.timeout
+                    while not self._fits(estimate):
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise AdmissionRejected(
+                                f"Not enough memory became available within {self.timeout:.0f} s",
+                                self.retry_after)
+                        self._cond.wait(min(self.poll_interval, remaining))
+                finally:
+                    self.waiting -= 1
+            self.reserved += estimate
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.reserved -= estimate
+                self._cond.notify_all()
+
+
+class ConcurrencyLimit(object):
+    """
+    Limits the number of requests running at the same time. A request over
+    the limit waits (in arrival order) for a running one to finish, as long
+    as fewer than ``max_queue`` requests are waiting already; otherwise it
+    is refused at once.
+
+    :param max_in_flight: maximum number of requests running at the same time
+    :param max_queue: maximum number of requests waiting for a free slot
+    :param timeout: maximum time in seconds a request waits for a free slot
+    """
+
+    def __init__(self, max_in_flight: int, max_queue: int = 8, timeout: float = 60.0):
+        if max_in_flight < 1:
+            raise ValueError("max_in_flight must be at least 1")
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.in_flight = 0
+        self.waiting = 0
+        #: moving average of the time (in seconds) a request holds a slot, 0 before any request finished
+        self.mean_hold_time = 0.0
+        self._queue: List[threading.Event] = []
+        self._cond = threading.Condition()
+
+    @property
+    def retry_after(self) -> int:
+        """
+        Suggested seconds to wait before retrying a refused request: the
+        expected time to work off the current queue.
+        """
+        rounds = (self.waiting + 1) / self.max_in_flight
+        return max(1, math.ceil(self.mean_hold_time * rounds))
+
+    @contextmanager
+    def admit(self, on_queue: Optional[Callable[[int], None]] = None) -> Iterator[float]:
+        """
+        Waits for a free slot and holds it while the context is active.
+
+        :param on_queue: called with ``1`` when the request starts waiting
+                         and with ``-1`` when it stops waiting, e.g. to keep
+                         track of the queue depth
+        :return: seconds the request waited for the slot
+        :raises TooManyRequests: if the wait queue is full or the wait times out
+        """
+        started = time.monotonic()
+        with self._cond:
+            if self.in_flight >= self.max_in_flight or self._queue:
+                if self.waiting >= self.max_queue:
+                    raise TooManyRequests(f"{self.in_flight} request(s) running and {self.waiting} waiting",
+                                          self.retry_after)
+                turn = threading.Event()
+                self._queue.append(turn)
+                self.waiting += 1
+                if on_queue is not None:
+                    on_queue(1)
+                try:
+                    deadline = started + self.timeout
+                    while not turn.is_set():
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise TooManyRequests(f"No request slot became free within {self.timeout:.0f} s",
+                                                  self.retry_after)
+                        self._cond.wait(remaining)
+                finally:
+                    self.waiting -= 1
+                    if on_queue is not None:
+                        on_queue(-1)
+                    if not turn.is_set():
+                        self._queue.remove(turn)
+            else:
+                self.in_flight += 1
+        admitted = time.monotonic()
+        try:
+            yield admitted - started
+        finally:
+            with self._cond:
+                held = time.monotonic() - admitted
+                self.mean_hold_time = held if self.mean_hold_time == 0 else 0.8 * self.mean_hold_time + 0.2 * held
+                if self._queue:
+                    # hand the slot over to the longest waiting request
+                    self._queue.pop(0).set()
+                    self._cond.notify_all()
+                else:
+                    self.in_flight -= 1
@@ -1,26 +1,42 @@
+import asyncio
+import collections
+import contextvars
+import functools
+import itertools
 import json
 import logging
+import multiprocessing
 import os
 import pathlib
+import sqlite3
 import sys
+import threading
+import time
 import warnings
 from abc import ABC, abstractmethod
-from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import wait as futures_wait
+from contextlib import contextmanager, nullcontext
 from datetime import datetime
 from urllib import parse as urlparser
 
 __all__ = ['ClamsApp', 'ClamsPromptableApp', 'ClamsHFPromptableApp']
 
-from typing import Union, Any, Optional, Dict, List, Tuple, cast
+from typing import Union, Any, Callable, Optional, Dict, Iterable, Iterator, List, Tuple, cast
 
 from mmif import Mmif, Document, DocumentTypes, View, AnnotationTypes
+from mmif.serialize.model import MmifObjectEncoder
 from mmif.utils.video_document_helper import (
     SamplingMode, SAMPLING_MODE_DESCRIPTIONS, SAMPLING_MODE_DEFAULT,
     _sampling_mode,
 )
 from mmif.utils.workflow_helper import generate_param_hash  # pytype: disable=import-error
+from clams.admission import MemoryAdmission
 from clams.appmetadata import AppMetadata, real_valued_primitives, python_type, map_param_kv_delimiter
-from clams.envelop import unwrap_if_envelope
+from clams.cache import OutputCache, cache_key
+from clams.envelop import load_input
+from clams.hardware import get_inventory
+from clams.profiles import HostUsageMeter, ProfileStore, profile_store_path
 
 logging.basicConfig(
     level=getattr(logging, os.environ.get('CLAMS_LOGLEVEL', 'WARNING').upper(), logging.WARNING),
@@ -38,6 +54,9 @@ _sampling_mode_description = (
     )
 )
 
+# placeholder of required parameters in the parameter template
+_REQUIRED = object()
+
 falsy_values = [
     'False', 
     'false', 
@@ -90,6 +109,16 @@ class ClamsApp(ABC):
     # even after "refinement" (i.e., casting to proper data types)
     _RAW_PARAMS_KEY = "#RAW#"
 
+    #: Approximate size (in characters) of chunks yielded by :meth:`annotate_stream`
+    stream_chunk_size = 64 * 1024
+
+    #: Default number of inputs :meth:`annotate_many` passes to :meth:`_annotate_batch` at once
+    annotate_batch_size = 1
+
+    #: Maximum number of distinct sets of runtime parameters whose refinement is memoized
+    #: (least recently used ones are dropped), ``0`` to turn memoization off
+    refine_cache_size = 256
+
     def __init__(self):
         self.metadata: AppMetadata = self._load_appmetadata()
         super().__init__()
@@ -107,6 +136,41 @@ class ClamsApp(ABC):
         self.metadata_param_caster = ParameterCaster(self.metadata_param_spec)
         self.annotate_param_caster = ParameterCaster(self.annotate_param_spec)
         self.logger = logging.getLogger(str(self.metadata.identifier))
+        # serialized metadata (compact and pretty) is computed once here and
+        # re-computed only when the metadata object changes
+        self._serialized_metadata: Optional[Tuple[int, Dict[bool, Tuple[str, bytes, str]]]] = None
+        self._get_serialized_metadata()
+        self.output_cache: Optional[OutputCache] = None
+        #: Callables to receive durations (in seconds) of the phases of every :meth:`annotate` call
+        #: (``decode``, ``refine``, ``annotate``, ``warnings``, ``serialize``), e.g. for monitoring
+        self.phase_timing_hooks: List[Callable[[Dict[str, float]], None]] = []
+        #: Peak CUDA memory (in bytes) measured during the last :meth:`_annotate` call, 0 if not measured
+        self.last_cuda_peak_bytes = 0
+        if 'CLAMS_OUTPUT_CACHE_DIR' in os.environ:
+            self.enable_output_cache(os.environ['CLAMS_OUTPUT_CACHE_DIR'],
+                                     int(os.environ.get('CLAMS_OUTPUT_CACHE_MB', 1024)))
+        #: Whether resource usage (peak RSS, CPU time, peak VRAM, etc.) of every :meth:`_annotate` call is recorded
+        #: to the profile store of the app (see :mod:`clams.profiles`); turned off by ``CLAMS_RESOURCE_PROFILING=false``
+        self.resource_profiling = os.environ.get('CLAMS_RESOURCE_PROFILING', 'true') not in falsy_values
+        self._profile_store: Optional[ProfileStore] = None
+        self._profile_store_lock = threading.Lock()
+        #: VRAM admission control (see :meth:`enable_vram_admission`), on by default for GPU apps
+        self.vram_admission: Optional[MemoryAdmission] = None
+        if self.metadata.est_gpu_mem_min > 0 and os.environ.get('CLAMS_VRAM_ADMISSION', 'true') not in falsy_values:
+            self.enable_vram_admission(int(os.environ.get('CLAMS_VRAM_QUEUE_SIZE', 8)),
+                                       float(os.environ.get('CLAMS_VRAM_QUEUE_TIMEOUT', 60)))
+        #: Maximum number of :meth:`annotate` calls the default :meth:`annotate_async` runs at the same time;
+        #: set by ``CLAMS_ASYNC_WORKERS``, defaults to the number of threads of a production server worker
+        self.async_max_workers: Optional[int] = int(os.environ['CLAMS_ASYNC_WORKERS']) \
+            if 'CLAMS_ASYNC_WORKERS' in os.environ else None
+        self._async_executor: Optional[Tuple[int, ThreadPoolExecutor]] = None
+        self._async_executor_lock = threading.Lock()
+        # defaults of parameters are cast once here, and again only after the metadata changes,
+        # see _get_param_template()
+        self._param_template: Optional[tuple] = None
+        self._refine_cache: Tuple[Optional[tuple], collections.OrderedDict] = (None, collections.OrderedDict())
+        self._refine_cache_lock = threading.Lock()
+        self._get_param_template()
         
     def appmetadata(self, **kwargs: List[str]) -> str:
         """
@@ -114,10 +178,45 @@ class ClamsApp(ABC):
 
         :return: Serialized JSON string of the metadata
         """
+        return self._get_serialized_metadata()[self._metadata_pretty(kwargs)][0]
+
+    def appmetadata_with_etag(self, **kwargs: List[str]) -> Tuple[bytes, str]:
+        """
+        Same as :meth:`appmetadata`, but returns the cached serialization as
+        UTF-8 encoded bytes, together with an entity tag (a hash of the bytes)
+        that can be used for conditional HTTP requests.
+
+        :return: A tuple of (serialized metadata in bytes, entity tag)
+        """
+        _, encoded, etag = self._get_serialized_metadata()[self._metadata_pretty(kwargs)]
+        return encoded, etag
+
+    def _metadata_pretty(self, kwargs: Dict[str, List[str]]) -> bool:
         # cast only, no refinement
-        casted = self.metadata_param_caster.cast(kwargs)
-        pretty = casted.get('pretty', False)
-        return self.metadata.jsonify(pretty)
+        if not kwargs:
+            return False
+        return bool(self.metadata_param_caster.cast(kwargs).get('pretty', False))
+
+    def _get_serialized_metadata(self) -> Dict[bool, Tuple[str, bytes, str]]:
+        """
+        Returns serialized metadata in both compact (``False`` key) and
+        pretty (``True`` key) forms, as (str, bytes, etag) tuples. The
+        serialization is cached and refreshed only when
+        :meth:`~clams.appmetadata.AppMetadata.change_token` of the metadata
+        changes.
+        """
+        token = self.metadata.change_token()
+        cached = self._serialized_metadata
+        if cached is None or cached[0] != token:
+            import hashlib
+            serialized = {}
+            for pretty in (False, True):
+                json_str = self.metadata.jsonify(pretty)
+                encoded = json_str.encode('utf-8')
+                serialized[pretty] = (json_str, encoded, hashlib.sha1(encoded).hexdigest())
+            # single assignment, so concurrent readers never see a half-built cache
+            cached = self._serialized_metadata = (token, serialized)
+        return cached[1]
     
     def _load_appmetadata(self) -> AppMetadata:
         """
@@ -155,27 +254,325 @@ class ClamsApp(ABC):
     def _check_mmif_compatibility(target_specver, input_specver):
         return target_specver.split('.')[:2] == input_specver.split('.')[:2]
 
-    def annotate(self, mmif: Union[str, dict, Mmif], **runtime_params: List[str]) -> str:
+    def annotate(self, mmif: Union[bytes, str, dict, Mmif], **runtime_params: List[str]) -> str:
         """
         A public method to invoke the primary app function. It's essentially a
         wrapper around :meth:`~clams.app.ClamsApp._annotate` method where some common operations
         (that are invoked by keyword arguments) are implemented.
 
-        The input may be a raw MMIF (str, dict, or :class:`~mmif.serialize.mmif.Mmif`)
+        The input may be a raw MMIF (bytes, str, dict, or :class:`~mmif.serialize.mmif.Mmif`)
         or a JSON envelope wrapping both ``"parameters"`` and ``"mmif"``.
         Envelope detection and unwrapping happen here so every execution
         path (HTTP, CLI, direct Python API) is envelope-aware. When an
         envelope is given, its parameters are merged under ``runtime_params``
         (explicitly-passed parameters take priority on key collision).
+        Serialized input (``bytes`` or ``str``) is decoded only once (see
+        :func:`~clams.envelop.load_input`) and the decoded structure is
+        handed straight to :class:`~mmif.serialize.mmif.Mmif`.
+        When the output cache is on (see :meth:`enable_output_cache`), a
+        cached output is returned without running :meth:`_annotate`.
+
+        :param mmif: An input MMIF object, or a JSON envelope, to annotate
+        :param runtime_params: An arbitrary set of k-v pairs to configure the app at runtime
+        :return: Serialized JSON string of the output of the app
+        """
+        timings = {}
+        mmif, runtime_params, input_size = self._decode_input(mmif, runtime_params, timings)
+        t = time.perf_counter()
+        prepared = self._prepare_params(runtime_params)
+        timings['refine'] = time.perf_counter() - t
+        refined = prepared[0]
+        key = None
+        if self.output_cache is not None:
+            # the input is hashed as decoded, before it's turned into a Mmif object
+            key = cache_key(mmif, {k: v for k, v in refined.items() if k != self._RAW_PARAMS_KEY},
+                            self.metadata.app_version)
+            cached = self.output_cache.get(key)
+            if cached is not None:
+                self.logger.debug(f"Output cache hit: {key}")
+                return cached
+        annotated = self._annotate_decoded(mmif, prepared, timings, input_size)
+        t = time.perf_counter()
+        output = annotated.serialize(pretty=refined.get('pretty', False), sanitize=True)
+        timings['serialize'] = time.perf_counter() - t
+        self._report_timings(timings)
+        if key is not None:
+            self.output_cache.put(key, output)
+        return output
+
+    def annotate_mmif(self, mmif: Union[bytes, str, dict, Mmif], **runtime_params: List[str]) -> Mmif:
+        """
+        A variant of :meth:`annotate` that returns the output as a
+        :class:`~mmif.serialize.mmif.Mmif` object, for callers that keep
+        working on it in the same process (e.g. the next app of a
+        :class:`~clams.pipeline.Pipeline`). A ``Mmif`` input is annotated in
+        place. The output is not validated until it is serialized, and the
+        output cache is not used.
+
+        :param mmif: An input MMIF object, or a JSON envelope, to annotate
+        :param runtime_params: An arbitrary set of k-v pairs to configure the app at runtime
+        :return: A :class:`~mmif.serialize.mmif.Mmif` object of the output of the app
+        """
+        annotated, _, timings = self._run_annotate(mmif, **runtime_params)
+        self._report_timings(timings)
+        return annotated
+
+    def enable_output_cache(self, cache_dir: Optional[str] = None, max_size_mb: int = 1024) -> OutputCache:
+        """
+        Turns on the on-disk output cache for :meth:`annotate`. Outputs are
+        keyed by the content of the input MMIF (independent of its JSON
+        formatting), the refined runtime parameters and the app version, so
+        re-running the app on the same input with the same parameters
+        returns the cached output without calling :meth:`_annotate`. Mind
+        that a cached output is returned as-is, including its view
+        timestamps and profiling records. Least recently used outputs are
+        evicted when the cache grows over ``max_size_mb``.
+
+        Can also be turned on with ``CLAMS_OUTPUT_CACHE_DIR`` (and
+        ``CLAMS_OUTPUT_CACHE_MB``) environment variables.
+
+        :param cache_dir: directory to store outputs, can be shared by app
+            processes. Defaults to a per-app directory under the user's
+            cache directory.
+        :param max_size_mb: size limit of the cache
+        :return: the :class:`~clams.cache.OutputCache`, to inspect its hit/miss counters
+        """
+        if cache_dir is None:
+            app_id = str(self.metadata.identifier).replace('/', '-').replace(':', '-')
+            cache_base = pathlib.Path(os.environ.get('XDG_CACHE_HOME', pathlib.Path.home() / '.cache'))
+            cache_dir = cache_base / 'clams' / 'outputs' / app_id
+        self.output_cache = OutputCache(cache_dir, max_size_mb * 1024 * 1024)
+        return self.output_cache
+
+    def enable_vram_admission(self, max_queue: int = 8, timeout: float = 60.0) -> MemoryAdmission:
+        """
+        Turns on admission control of GPU memory. Before :meth:`_annotate`
+        runs on CUDA, the VRAM it needs is estimated from the peaks recorded
+        for the same parameters (95th percentile, see :mod:`clams.profiles`), or from
+        ``est_gpu_mem_typ`` in the app metadata when there's no record yet.
+        A request that doesn't fit into the currently available VRAM (across
+        all processes on the GPU) waits until enough memory is freed. When
+        ``max_queue`` requests are already waiting, or the memory isn't
+        freed within ``timeout`` seconds, the request is rejected with
+        :class:`~clams.admission.AdmissionRejected` (a ``503`` response with
+        a ``Retry-After`` header in the HTTP server).
+
+        On by default for apps that declare ``est_gpu_mem_min``. Can be
+        configured with ``CLAMS_VRAM_QUEUE_SIZE`` and ``CLAMS_VRAM_QUEUE_TIMEOUT``,
+        or turned off with ``CLAMS_VRAM_ADMISSION=false`` environment variables.
+
+        :param max_queue: maximum number of requests waiting for VRAM in this process
+        :param timeout: maximum time in seconds a request waits for VRAM
+        :return: the :class:`~clams.admission.MemoryAdmission`, to inspect its queue
+        """
+        self.vram_admission = MemoryAdmission(self._get_admissible_vram, max_queue, timeout)
+        return self.vram_admission
+
+    def annotate_stream(self, mmif: Union[bytes, str, dict, Mmif], **runtime_params: List[str]) -> Iterator[str]:
+        """
+        A streaming variant of :meth:`annotate`. Annotation and output
+        validation are done eagerly (so any error is raised from this call),
+        then the serialized output MMIF is returned as an iterator of string
+        chunks of roughly :py:attr:`stream_chunk_size` characters. Joining
+        the chunks gives exactly the same string :meth:`annotate` returns,
+        but the full JSON string is never materialized in memory.
+
+        :param mmif: An input MMIF object, or a JSON envelope, to annotate
+        :param runtime_params: An arbitrary set of k-v pairs to configure the app at runtime
+        :return: An iterator of chunks of the serialized output MMIF
+        """
+        annotated, refined, timings = self._run_annotate(mmif, **runtime_params)
+        t = time.perf_counter()
+        prepared = _prepare_for_streaming(annotated)
+        # only the preparation, chunks are serialized lazily while being sent
+        timings['serialize'] = time.perf_counter() - t
+        self._report_timings(timings)
+        # drop the reference to the object graph, the prepared tree is all we need from now on
+        del annotated
+        return _iter_json_chunks(prepared, 2 if refined.get('pretty', False) else None, self.stream_chunk_size)
+
+    async def annotate_async(self, mmif: Union[bytes, str, dict, Mmif], **runtime_params: List[str]) -> str:
+        """
+        A coroutine variant of :meth:`annotate`, used by the ASGI server (see
+        :class:`~clams.asgi.AsgiRestifier`). The default implementation runs
+        the blocking :meth:`annotate` in a bounded thread pool (see
+        :py:attr:`async_max_workers`), so the event loop keeps serving other
+        requests meanwhile; calls over the bound wait for a free thread.
+
+        Apps whose work is I/O bound (e.g. calls to a remote model service)
+        can override this with a native coroutine, to serve many concurrent
+        requests without a thread per request.
 
         :param mmif: An input MMIF object, or a JSON envelope, to annotate
         :param runtime_params: An arbitrary set of k-v pairs to configure the app at runtime
         :return: Serialized JSON string of the output of the app
         """
+        return await self.run_blocking(self.annotate, mmif, **runtime_params)
+
+    async def run_blocking(self, func: Callable, *args, **kwargs) -> Any:
+        """
+        Runs a blocking function in the thread pool of :meth:`annotate_async`
+        and waits for its result without blocking the event loop.
+
+        :param func: the function to run
+        :param args: positional arguments to the function
+        :param kwargs: keyword arguments to the function
+        :return: the return value of the function
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._get_async_executor(), functools.partial(func, *args, **kwargs))
+
+    def _get_async_executor(self) -> ThreadPoolExecutor:
+        with self._async_executor_lock:
+            # threads don't survive fork(), a forked process needs its own pool
+            if self._async_executor is None or self._async_executor[0] != os.getpid():
+                workers = self.async_max_workers or max(2, getattr(self, 'max_batch_size', 1))
+                self._async_executor = (os.getpid(), ThreadPoolExecutor(max_workers=workers,
+                                                                        thread_name_prefix='clams-annotate'))
+            return self._async_executor[1]
+
+    def annotate_many(self, mmifs: Iterable[Union[bytes, str, dict, Mmif]], executor: Optional[str] = None,
+                      max_workers: Optional[int] = None, ordered: bool = True, batch_size: Optional[int] = None,
+                      **runtime_params: List[str]) -> Iterator[str]:
+        """
+        A variant of :meth:`annotate` for many inputs with the same runtime
+        parameters. The parameters are checked and refined once (so invalid
+        parameters raise from this call), then inputs are read from the
+        iterable and their serialized outputs yielded as they are annotated,
+        so neither has to fit in memory at once. Inputs that are envelopes
+        with their own parameters are annotated with those, as in
+        :meth:`annotate`. An error on an input is raised when its output is
+        reached, and ends the iteration.
+
+        Inputs are grouped by ``batch_size`` and each group is passed to
+        :meth:`_annotate_batch`, which apps that can process several inputs
+        at once (e.g. in one forward pass of a model) can override.
+
+        :param mmifs: Input MMIF objects, or JSON envelopes, to annotate
+        :param executor: ``None`` to annotate in the calling thread, ``thread``
+            to annotate on a thread pool, or ``process`` to annotate on a pool
+            of processes forked from this one (POSIX only, the app is not
+            re-initialized in them)
+        :param max_workers: size of the pool, defaults to the number of CPU cores
+        :param ordered: when False, outputs of a pool are yielded as soon as
+            they are ready, instead of in the order of the inputs
+        :param batch_size: number of inputs passed to :meth:`_annotate_batch`
+            at once, defaults to :py:attr:`annotate_batch_size`
+        :param runtime_params: An arbitrary set of k-v pairs to configure the app at runtime
+        :return: An iterator of serialized JSON strings of the outputs
+        """
+        if executor not in (None, 'thread', 'process'):
+            raise ValueError(f"Unknown executor: {executor}, must be 'thread' or 'process'")
+        prepared = self._prepare_params(runtime_params)
+        batches = _batched(mmifs, batch_size or self.annotate_batch_size)
+        if executor is None:
+            return itertools.chain.from_iterable(self._annotate_items(batch, runtime_params, prepared)
+                                                 for batch in batches)
+        workers = max_workers or os.cpu_count() or 1
+        if executor == 'thread':
+            pool = functools.partial(ThreadPoolExecutor, max_workers=workers, thread_name_prefix='clams-annotate')
+            func = functools.partial(self._annotate_items, runtime_params=runtime_params, prepared=prepared)
+        else:
+            # forked workers inherit the app with its models, inputs are sent serialized
+            pool = functools.partial(ProcessPoolExecutor, max_workers=workers,
+                                     mp_context=multiprocessing.get_context('fork'),
+                                     initializer=_set_pool_app, initargs=(self,))
+            func = functools.partial(_annotate_in_pool, runtime_params=runtime_params, prepared=prepared)
+            batches = ([item.serialize() if isinstance(item, Mmif) else item for item in batch] for batch in batches)
+        return _iter_pooled(pool, func, batches, ordered, 2 * workers)
+
+    def _annotate_items(self, items: List[Union[bytes, str, dict, Mmif]], runtime_params: Dict[str, List[str]],
+                        prepared: Tuple[dict, List[Warning]]) -> List[str]:
+        """
+        Annotates a batch of inputs of :meth:`annotate_many`, with parameters
+        prepared by :meth:`_prepare_params`, and returns the serialized outputs.
+        """
+        refined, param_warnings = prepared
+        # by position in the batch, filled in out of order
+        outputs: Dict[int, str] = {}
+        shared = []
+        timings = {'decode': 0.0}
+        for i, item in enumerate(items):
+            input_size = len(item) if isinstance(item, (bytes, str)) else None
+            t = time.perf_counter()
+            params = runtime_params
+            if not isinstance(item, Mmif):
+                item, params = load_input(item, runtime_params)
+            if params != runtime_params:
+                # an envelope with its own parameters
+                timings['decode'] += time.perf_counter() - t
+                outputs[i] = self.annotate(item, **params)
+                continue
+            key = None
+            if self.output_cache is not None:
+                key = cache_key(item, {k: v for k, v in refined.items() if k != self._RAW_PARAMS_KEY},
+                                self.metadata.app_version)
+                cached = self.output_cache.get(key)
+                if cached is not None:
+                    self.logger.debug(f"Output cache hit: {key}")
+                    outputs[i] = cached
+                    continue
+            if not isinstance(item, Mmif):
+                item = Mmif(item)
+            timings['decode'] += time.perf_counter() - t
+            shared.append((i, item, input_size, key))
+        if shared:
+            annotated = self._run_prepared([item for _, item, _, _ in shared], refined, param_warnings, timings,
+                                           [input_size for _, _, input_size, _ in shared])
+            t = time.perf_counter()
+            for (i, _, _, key), output in zip(shared, annotated):
+                outputs[i] = output.serialize(pretty=refined.get('pretty', False), sanitize=True)
+                if key is not None:
+                    self.output_cache.put(key, outputs[i])
+            timings['serialize'] = time.perf_counter() - t
+            self._report_timings(timings)
+        return [outputs[i] for i in range(len(items))]
+
+    def _run_annotate(self, mmif: Union[bytes, str, dict, Mmif],
+                      **runtime_params: List[str]) -> Tuple[Mmif, dict, Dict[str, float]]:
+        """
+        Runs :meth:`_annotate` with all SDK-level runtime features (parameter
+        refinement, warning capture, profiling, etc.) applied, and returns the
+        output MMIF object (not serialized yet) with the refined parameters
+        and durations of the phases run so far.
+        """
+        timings = {}
+        mmif, runtime_params, input_size = self._decode_input(mmif, runtime_params, timings)
+        t = time.perf_counter()
+        prepared = self._prepare_params(runtime_params)
+        timings['refine'] = time.perf_counter() - t
+        return self._annotate_decoded(mmif, prepared, timings, input_size), prepared[0], timings
+
+    @staticmethod
+    def _decode_input(mmif: Union[bytes, str, dict, Mmif], runtime_params: Dict[str, List[str]],
+                      timings: Dict[str, float]) -> Tuple[Union[dict, Mmif], Dict[str, List[str]], Optional[int]]:
+        """
+        Decodes a serialized input (unwrapping an envelope) into its JSON
+        structure, and returns it with the effective runtime parameters and
+        the size of the serialized input.
+        """
+        input_size = len(mmif) if isinstance(mmif, (bytes, str)) else None
+        t = time.perf_counter()
+        if not isinstance(mmif, Mmif):
+            mmif, runtime_params = load_input(mmif, runtime_params)
+        timings['decode'] = time.perf_counter() - t
+        return mmif, runtime_params, input_size
+
+    def _annotate_decoded(self, mmif: Union[dict, Mmif], prepared: Tuple[dict, List[Warning]],
+                          timings: Dict[str, float], input_size: Optional[int]) -> Mmif:
+        t = time.perf_counter()
         if not isinstance(mmif, Mmif):
-            mmif, runtime_params = unwrap_if_envelope(mmif, runtime_params)
             mmif = Mmif(mmif)
-        existing_view_ids = {view.id for view in mmif.views}
+        timings['decode'] += time.perf_counter() - t
+        return self._run_prepared([mmif], *prepared, timings, [input_size])[0]
+
+    def _prepare_params(self, runtime_params: Dict[str, List[str]]) -> Tuple[dict, List[Warning]]:
+        """
+        Refines runtime parameters and checks them for undefined ones. This
+        is shared by all inputs annotated with the same parameters.
+
+        :return: the refined parameters and warnings to put in the output
+        """
         issued_warnings = []
         for key in runtime_params:
             if key not in self.annotate_param_spec:
@@ -184,30 +581,55 @@ class ClamsApp(ABC):
         self.logger.debug(f"User parameters: {runtime_params}")
         refined = self._refine_params(**runtime_params)
         self.logger.debug(f"Refined parameters: {refined}")
-        pretty = refined.get('pretty', False)
+        return refined, issued_warnings
+
+    def _run_prepared(self, mmifs: List[Mmif], refined: dict, param_warnings: List[Warning],
+                      timings: Dict[str, float], input_sizes: List[Optional[int]]) -> List[Mmif]:
+        """
+        Runs :meth:`_annotate` (or :meth:`_annotate_batch` for more than one
+        input) on decoded inputs with refined parameters, and adds warning
+        views and profiling records to the outputs.
+        """
+        existing_view_ids = [{view.id for view in mmif.views} for mmif in mmifs]
+        issued_warnings = list(param_warnings)
         sampling_mode_str = refined.get('tfSamplingMode', None)
         if sampling_mode_str is not None:
             _sampling_mode.set(SamplingMode(sampling_mode_str))
         t = datetime.now()
-        with warnings.catch_warnings(record=True) as ws:
-            annotated, cuda_profiler = self._profile_cuda_memory(self._annotate)(mmif, **refined)
+        with _warning_recorder.record() as ws, HostUsageMeter() as host_usage:
+            if len(mmifs) == 1:
+                annotated, cuda_profiler = self._profile_cuda_memory(self._annotate)(mmifs[0], **refined)
+                annotated = [annotated]
+            else:
+                annotated, cuda_profiler = self._profile_cuda_memory(self._annotate_batch)(mmifs, **refined)
+                if len(annotated) != len(mmifs):
+                    raise ValueError(f"_annotate_batch() returned {len(annotated)} outputs for {len(mmifs)} inputs")
             if ws:
                 issued_warnings.extend(ws)
+        timings['annotate'] = (datetime.now() - t).total_seconds()
+        if self.resource_profiling:
+            # resource usage for sizing and admission of future requests, a batch is recorded as one run
+            vram_peak = max((mem_info['peak'] for mem_info in cuda_profiler.values()), default=0)
+            input_size = None if None in input_sizes else sum(input_sizes)
+            self._record_profile(refined, vram_peak=vram_peak or None, rss_peak=host_usage.rss_peak,
+                                 cpu_time=host_usage.cpu_time, wall_time=timings['annotate'], input_size=input_size)
+        warnings_t = time.perf_counter()
         if issued_warnings:
-            warnings_view = annotated.new_view()
-            self.sign_view(warnings_view, refined)
-            warnings_view.metadata.warnings = issued_warnings
+            for output in annotated:
+                warnings_view = output.new_view()
+                self.sign_view(warnings_view, refined)
+                warnings_view.metadata.warnings = issued_warnings
+        timings['warnings'] = time.perf_counter() - warnings_t
         run_id = datetime.now()
         td = run_id - t
         runningTime = refined.get('runningTime', False)
         hwFetch = refined.get('hwFetch', False)
         runtime_recs = {}
         if hwFetch:
-            import multiprocessing
-            import platform, shutil, subprocess
-            runtime_recs['cpu'] = f"{platform.machine()}, {multiprocessing.cpu_count()} cores"
+            inventory = get_inventory()
+            runtime_recs['cpu'] = inventory.cpu
             runtime_recs['cuda'] = []
-            # Use cuda_profiler data if available, otherwise fallback to nvidia-smi
+            # Use cuda_profiler data if available, otherwise fallback to the static hardware inventory
             if cuda_profiler:
                 for gpu_name, mem_info in cuda_profiler.items():
                     total_str = self._cuda_memory_to_str(mem_info['total'])
@@ -216,23 +638,31 @@ class ClamsApp(ABC):
                     runtime_recs['cuda'].append(
                         f"{gpu_name}, {total_str} total, {available_str} available, {peak_str} peak used"
                     )
-            elif shutil.which('nvidia-smi'):
-                for gpu in subprocess.run(['nvidia-smi', '--query-gpu=name,memory.total', '--format=csv,noheader'], 
-                                          stdout=subprocess.PIPE).stdout.decode('utf-8').strip().split('\n'):
-                    name, mem = gpu.split(', ')
-                    runtime_recs['cuda'].append(self._cuda_device_name_concat(name, mem))
-        for annotated_view in annotated.views:
-            if annotated_view.id not in existing_view_ids and annotated_view.metadata.app == str(self.metadata.identifier):
-                annotated_view.metadata.timestamp = run_id
-                profiling_data = {}
-                if runningTime:
-                    profiling_data['runningTime'] = str(td)
-                if len(runtime_recs) > 0:
-                    profiling_data['hardware'] = runtime_recs
-                if profiling_data:
-                    annotated_view.metadata.set_additional_property('appProfiling', profiling_data)
-                    
-        return annotated.serialize(pretty=pretty, sanitize=True)
+            else:
+                for gpu in inventory.gpus:
+                    runtime_recs['cuda'].append(self._cuda_device_name_concat(gpu.name, gpu.total_memory))
+        for output, view_ids in zip(annotated, existing_view_ids):
+            for annotated_view in output.views:
+                if annotated_view.id not in view_ids and annotated_view.metadata.app == str(self.metadata.identifier):
+                    annotated_view.metadata.timestamp = run_id
+                    profiling_data = {}
+                    if runningTime:
+                        profiling_data['runningTime'] = str(td)
+                        # serialization happens after this, so its duration can only be seen by phase_timing_hooks
+                        profiling_data['phaseSeconds'] = {phase: round(seconds, 6) for phase, seconds in timings.items()}
+                    if len(runtime_recs) > 0:
+                        profiling_data['hardware'] = runtime_recs
+                    if profiling_data:
+                        annotated_view.metadata.set_additional_property('appProfiling', profiling_data)
+
+        return annotated
+
+    def _report_timings(self, timings: Dict[str, float]) -> None:
+        for hook in self.phase_timing_hooks:
+            try:
+                hook(timings)
+            except Exception:
+                self.logger.exception("Error in a phase timing hook")
 
     @abstractmethod
     def _annotate(self, mmif: Mmif, _raw_parameters=None, **refined_parameters) -> Mmif:
@@ -255,11 +685,39 @@ class ClamsApp(ABC):
         :return: A :class:`~mmif.serialize.mmif.Mmif` object of the annotated output, ready for serialization
         """
         raise NotImplementedError()
+
+    def _annotate_batch(self, mmifs: List[Mmif], **refined_parameters) -> List[Mmif]:
+        """
+        A hook to annotate several inputs at once, called by
+        :meth:`annotate_many` with up to :py:attr:`annotate_batch_size`
+        inputs (a single input goes straight to :meth:`_annotate`). The
+        default implementation calls :meth:`_annotate` on each.
+        Apps that can process inputs together (e.g. by running a model on a
+        batch of frames from all inputs) can override this, and set
+        :py:attr:`annotate_batch_size` to a suitable batch size.
+
+        :param mmifs: Input MMIF objects to annotate
+        :param refined_parameters: refined runtime parameters, the same for all inputs
+        :return: :class:`~mmif.serialize.mmif.Mmif` objects of the annotated outputs, in the order of the inputs
+        """
+        return [self._annotate(mmif, **refined_parameters) for mmif in mmifs]
+
+    def warm_up(self) -> None:
+        """
+        A hook called once in each production server worker process (see
+        :meth:`~clams.restify.Restifier.serve_production`) right after it is
+        forked and before it starts accepting requests. Override this to load
+        models (or anything else that can't be shared across ``fork()``, like
+        CUDA contexts) so that the first request to a fresh worker doesn't pay
+        the loading cost. The default implementation does nothing.
+        """
+        pass
     
     def _refine_params(self, **runtime_params: List[str]):
         """
         Method to "fill" the parameter dictionary with default values, when a key-value is not specified in the input.
         The input map is not really "filled" as a copy of it is returned with addition of default values. 
+        Results are memoized (see :py:attr:`refine_cache_size`), and every call returns a fresh copy.
         :param runtime_params: key-value pairs of runtime parameters
         :return: a copy of parameter map, with default values added
         :raises ValueError: when a value for a required parameter is not found in the input
@@ -267,15 +725,71 @@ class ClamsApp(ABC):
         if self._RAW_PARAMS_KEY in runtime_params:
             # meaning the dict is already refined, just return it 
             return runtime_params
-        refined = {}
-        
+        template = self._get_param_template()
+        key = None
+        if all(isinstance(vs, list) for vs in runtime_params.values()):
+            try:
+                key = tuple(sorted((k, tuple(vs)) for k, vs in runtime_params.items()))
+                hash(key)
+            except TypeError:
+                key = None
+        with self._refine_cache_lock:
+            if self._refine_cache[0] is not template:
+                # the metadata (or the caster) changed since the cached results were refined
+                self._refine_cache = (template, collections.OrderedDict())
+            cache = self._refine_cache[1]
+            refined = cache.get(key) if key is not None else None
+            if refined is not None:
+                cache.move_to_end(key)
+        if refined is None:
+            refined = self._overlay_params(template, runtime_params)
+            if key is not None and self.refine_cache_size > 0:
+                with self._refine_cache_lock:
+                    cache[key] = refined
+                    while len(cache) > self.refine_cache_size:
+                        cache.popitem(last=False)
+        # callers may modify the refined parameters, so the cached ones are never handed out
+        refined = {k: v.copy() if isinstance(v, (list, dict)) else v for k, v in refined.items()}
+        # raw input params are hidden under a special key
+        refined[self._RAW_PARAMS_KEY] = runtime_params
+        return refined
+
+    def _overlay_params(self, template: tuple, runtime_params: Dict[str, List[str]]) -> dict:
+        _, defaults, choices = template
+        refined = dict(defaults)
         casted = self.annotate_param_caster.cast(runtime_params)
-        for parameter in self.metadata.parameters:
-            if parameter.name in casted:
-                if parameter.choices and casted[parameter.name] not in parameter.choices:
-                    raise ValueError(f"Value for parameter \"{parameter.name}\" must be one of {parameter.choices}.")
-                refined[parameter.name] = casted[parameter.name]
-            elif parameter.default is not None:
+        for name, value in casted.items():
+            if name in refined:
+                if name in choices and value not in choices[name]:
+                    raise ValueError(f"Value for parameter \"{name}\" must be one of {choices[name]}.")
+                refined[name] = value
+        for name, value in refined.items():
+            if value is _REQUIRED:
+                raise ValueError(f"Cannot find configuration for a required parameter \"{name}\".")
+        return refined
+
+    def _get_param_template(self) -> tuple:
+        """
+        Returns the defaults of all parameters, already cast, in the order
+        of the parameters in the metadata (required parameters hold a
+        placeholder), with the choices of parameters. The template is
+        compiled in ``__init__`` and re-compiled only when
+        :meth:`~clams.appmetadata.AppMetadata.change_token` of the metadata
+        changes or the parameter caster is replaced. Both are checked
+        without serializing the metadata, so the check is cheap enough for
+        every :meth:`_refine_params` call.
+        """
+        token = (self.metadata.change_token(), self.annotate_param_caster)
+        template = self._param_template
+        if template is None or template[0] != token:
+            defaults = {}
+            choices = {}
+            for parameter in self.metadata.parameters:
+                if parameter.choices:
+                    choices[parameter.name] = parameter.choices
+                if parameter.default is None:
+                    defaults[parameter.name] = _REQUIRED
+                    continue
                 # have to cast the default values as well, since 
                 # 1. `map` type default values are not actually expected as a map (dict)
                 # 2. developers can use data type not matching the spec
@@ -283,12 +797,10 @@ class ClamsApp(ABC):
                     casted_default = self.annotate_param_caster.cast({parameter.name: list(map(str, parameter.default))})
                 else:
                     casted_default = self.annotate_param_caster.cast({parameter.name: [str(parameter.default)]})
-                refined.update(casted_default)
-            else:
-                raise ValueError(f"Cannot find configuration for a required parameter \"{parameter.name}\".")
-        # raw input params are hidden under a special key
-        refined[self._RAW_PARAMS_KEY] = runtime_params
-        return refined
+                defaults.update(casted_default)
+            # single assignment, so concurrent readers never see a half-built template
+            template = self._param_template = (token, defaults, choices)
+        return template
     
     def get_configuration(self, **runtime_params):
         warnings.warn("ClamsApp.get_configuration() is deprecated. "
@@ -330,19 +842,23 @@ class ClamsApp(ABC):
                 else:
                     view.metadata.add_parameter(k, v[0])
         
-    def set_error_view(self, mmif: Union[str, dict, Mmif], **runtime_conf: List[str]) -> Mmif:
+    def set_error_view(self, mmif: Union[bytes, str, dict, Mmif], *, exc_info: Optional[tuple] = None,
+                       **runtime_conf: List[str]) -> Mmif:
         """
         A method to record an error instead of annotation results in the view
         this app generated. For logging purpose, the runtime parameters used
         when the error occurred must be passed as well.
 
         :param mmif: input MMIF object
+        :param exc_info: the error to record, as returned by :func:`sys.exc_info`;
+                         by default, the exception being handled in the calling
+                         thread. Pass it to make the error view in another thread.
         :param runtime_conf: parameters passed to annotate when the app encountered the error
         :return: An output MMIF with a new view with the error encoded in the view metadata
         """
         import traceback
         if isinstance(mmif, (bytes, str, dict)):
-            mmif, runtime_conf = unwrap_if_envelope(mmif, runtime_conf)
+            mmif, runtime_conf = load_input(mmif, runtime_conf)
             mmif = Mmif(mmif)
         error_view: Optional[View] = None
         for view in reversed(mmif.views):
@@ -352,7 +868,8 @@ class ClamsApp(ABC):
         if error_view is None:
             error_view = mmif.new_view()
             self.sign_view(error_view, runtime_conf)
-        exc_info = sys.exc_info()
+        if exc_info is None:
+            exc_info = sys.exc_info()
         error_view.set_error(f'{exc_info[0]}: {exc_info[1]}',
                              '\t\n'.join(traceback.format_tb(exc_info[2])))
         return mmif
@@ -391,44 +908,45 @@ class ClamsApp(ABC):
             mem = ClamsApp._cuda_memory_to_str(mem)
         return f"{name}, With {mem}"
 
-    def _get_profile_path(self, param_hash: str) -> pathlib.Path:
-        """
-        Get filesystem path for memory profile file.
-
-        Profile files are stored in a per-app directory under user's cache.
-
-        :param param_hash: Hash of parameters from :func:`mmif.utils.cli.describe.generate_param_hash`
-        :return: Path to the profile file
-        """
-        # Sanitize app identifier for filesystem use
-        app_id = str(self.metadata.identifier).replace('/', '-').replace(':', '-')
-        cache_base = pathlib.Path(os.environ.get('XDG_CACHE_HOME', pathlib.Path.home() / '.cache'))
-        cache_dir = cache_base / 'clams' / 'memory_profiles' / app_id
-        return cache_dir / f"memory_{param_hash}.json"
+    def _get_profile_store(self) -> ProfileStore:
+        """
+        Get the resource profile store of the app (see :mod:`clams.profiles`),
+        opened on first use. Peak memory records of older SDK versions (a JSON
+        file per parameter hash) are imported when the store is created.
+
+        :return: The profile store
+        """
+        with self._profile_store_lock:
+            if self._profile_store is None:
+                path = profile_store_path(self.metadata.identifier)
+                is_new = not path.exists()
+                self._profile_store = ProfileStore(path)
+                if is_new:
+                    legacy_dir = path.parent.parent / 'memory_profiles' / path.stem
+                    for legacy_path in legacy_dir.glob('memory_*.json'):
+                        try:
+                            legacy = json.loads(legacy_path.read_text())
+                            self._profile_store.record(legacy_path.stem[len('memory_'):], legacy.get('parameters'),
+                                                       legacy_path.stat().st_mtime, vram_peak=legacy['peak_bytes'])
+                        except (OSError, ValueError, KeyError):
+                            continue
+            return self._profile_store
 
     @staticmethod
     def _get_available_vram() -> int:
         """
         Get currently available VRAM in bytes (GPU-wide, across all processes).
 
-        Uses nvidia-smi to get actual available memory, not just current process.
+        Uses the hardware inventory probe (see :mod:`clams.hardware`) to get actual
+        available memory, not just current process.
 
         :return: Available VRAM in bytes, or 0 if unavailable
         """
-        try:
-            import subprocess
-            import shutil
-            if shutil.which('nvidia-smi'):
-                # Get free memory from nvidia-smi (reports GPU-wide, not per-process)
-                result = subprocess.run(
-                    ['nvidia-smi', '--query-gpu=memory.free', '--format=csv,noheader,nounits', '-i', '0'],
-                    capture_output=True, text=True, timeout=5
-                )
-                if result.returncode == 0 and result.stdout.strip():
-                    free_mb = float(result.stdout.strip())
-                    return int(free_mb * 1024 * 1024)  # Convert MB to bytes
-        except Exception:
-            pass
+        # GPU-wide free memory (not per-process) of the first device visible to this process
+        inventory = get_inventory()
+        free_memory = inventory.free_memory()
+        if inventory.cuda_index(0) in free_memory:
+            return free_memory[inventory.cuda_index(0)]
 
         # Fallback to torch (only sees current process memory)
         try:
@@ -444,70 +962,87 @@ class ClamsApp(ABC):
         except Exception:
             return 0
 
-    def _record_vram_usage(self, parameters: dict, peak_bytes: int) -> None:
+    @staticmethod
+    def _get_admissible_vram() -> Optional[int]:
         """
-        Record peak memory usage to profile file.
+        VRAM available to requests of this process: the GPU-wide free memory
+        of the first device visible to this process, plus the memory held by
+        torch's caching allocator of this process (running requests of this
+        process account for it).
 
-        Uses atomic write (temp + rename) to avoid corruption from
-        concurrent writes. Only updates if new value is higher.
-
-        Profile files are JSON containing:
-        - peak_bytes: Peak VRAM usage by the torch process
-        - parameters: Original parameters for human readability
+        :return: Available VRAM in bytes, or None if unknown
+        """
+        inventory = get_inventory()
+        free_memory = inventory.free_memory()
+        if inventory.cuda_index(0) not in free_memory:
+            return None
+        torch = sys.modules.get('torch')
+        held = torch.cuda.memory_reserved(0) if torch is not None and torch.cuda.is_initialized() else 0
+        return free_memory[inventory.cuda_index(0)] + held
 
-        :param parameters: Request parameters (for hash and recording)
-        :param peak_bytes: Measured peak VRAM usage
+    def _estimate_vram(self, parameters: dict) -> int:
         """
-        import json
+        Estimates the peak VRAM a request needs: the 95th percentile of peaks
+        recorded for the same parameters, or ``est_gpu_mem_typ`` if there's no
+        record. Never more than the total memory of the device, so that a
+        request can always run once the device is free.
 
-        if peak_bytes <= 0:
-            return
+        :param parameters: refined request parameters
+        :return: estimated VRAM in bytes
+        """
+        estimate = self.metadata.est_gpu_mem_typ * 1024 * 1024
+        try:
+            recorded = self._get_profile_store().cached_stats(generate_param_hash(parameters), 'vram_peak')
+            if recorded is not None:
+                estimate = int(recorded['p95'])
+        except (sqlite3.Error, OSError) as e:
+            self.logger.warning(f"Failed to read resource profiles: {e}")
+        inventory = get_inventory()
+        gpu = inventory.gpu(inventory.cuda_index(0))
+        return min(estimate, gpu.total_memory) if gpu is not None else estimate
+
+    def _estimate_process_memory(self, metric: str) -> Tuple[int, str]:
+        """
+        Estimates the peak memory of an app process: the 95th percentile of
+        peaks recorded for all parameters, or the typical usage declared in
+        the app metadata if there's no record.
+
+        :param metric: ``rss_peak`` for host memory (falls back to ``est_host_mem_typ``),
+                       ``vram_peak`` for GPU memory (falls back to ``est_gpu_mem_typ``)
+        :return: estimated memory in bytes (0 if unknown), and where the estimate comes from
+        """
+        declared_field = 'est_host_mem_typ' if metric == 'rss_peak' else 'est_gpu_mem_typ'
+        try:
+            recorded = self._get_profile_store().cached_stats(None, metric)
+            if recorded is not None:
+                return int(recorded['p95']), f"95th percentile of {recorded['count']} recorded run(s)"
+        except (sqlite3.Error, OSError) as e:
+            self.logger.warning(f"Failed to read resource profiles: {e}")
+        declared = getattr(self.metadata, declared_field)
+        if declared > 0:
+            return declared * 1024 * 1024, f"{declared_field} in app metadata"
+        return 0, "unknown"
+
+    def _record_profile(self, parameters: dict, **measurements: Optional[float]) -> None:
+        """
+        Record a resource profile sample of a run to the profile store. The
+        sample is written in the background (see
+        :meth:`clams.profiles.ProfileStore.record_async`), so the run doesn't wait for the disk.
 
+        :param parameters: Request parameters (for hash and recording)
+        :param measurements: Measurements of the run, see :meth:`clams.profiles.ProfileStore.record`
+        """
         param_hash = generate_param_hash(parameters)
-        profile_path = self._get_profile_path(param_hash)
-
+        # Original parameters for human readability, without internal keys
+        clean_params = {
+            k: v for k, v in parameters.items()
+            if k != self._RAW_PARAMS_KEY and not k.startswith('#')
+        }
         try:
-            profile_path.parent.mkdir(parents=True, exist_ok=True)
-
-            # Check if we should update
-            should_write = True
-            if profile_path.exists():
-                try:
-                    existing_data = json.loads(profile_path.read_text())
-                    existing = existing_data.get('peak_bytes', 0)
-                    if peak_bytes <= existing:
-                        should_write = False  # Existing value is sufficient
-                    else:
-                        self.logger.debug(
-                            f"Updating peak memory for {param_hash}: "
-                            f"{self._cuda_memory_to_str(existing)} -> {self._cuda_memory_to_str(peak_bytes)}"
-                        )
-                except (ValueError, IOError, json.JSONDecodeError):
-                    pass  # Corrupted file, overwrite
-
-            if should_write:
-                # Prepare profile data with original parameters for readability
-                # Filter out internal keys and non-serializable values
-                clean_params = {
-                    k: v for k, v in parameters.items()
-                    if k != self._RAW_PARAMS_KEY and not k.startswith('#')
-                }
-                profile_data = {
-                    'peak_bytes': peak_bytes,
-                    'parameters': clean_params
-                }
-
-                # Atomic write: write to temp, then rename
-                temp_path = profile_path.with_suffix('.tmp')
-                temp_path.write_text(json.dumps(profile_data, indent=2))
-                temp_path.rename(profile_path)  # Atomic on POSIX
-
-                self.logger.info(
-                    f"Recorded peak memory for {param_hash}: "
-                    f"{self._cuda_memory_to_str(peak_bytes)}"
-                )
-        except Exception as e:
-            self.logger.warning(f"Failed to record memory profile: {e}")
+            self._get_profile_store().record_async(param_hash, clean_params, **measurements)
+            self.logger.debug(f"Recorded resource profile for {param_hash}: {measurements}")
+        except (sqlite3.Error, OSError) as e:
+            self.logger.warning(f"Failed to record resource profile: {e}")
 
     @staticmethod
     def _profile_cuda_memory(func):
@@ -515,9 +1050,10 @@ class ClamsApp(ABC):
         Decorator for profiling CUDA memory usage and managing VRAM availability.
 
         This decorator:
-        1. Checks VRAM requirements before execution (if conditions met)
-        2. Rejects requests if insufficient VRAM
-        3. Records peak memory usage after execution
+        1. Waits until the estimated VRAM requirement fits into available VRAM
+           (if VRAM admission is on, see :meth:`enable_vram_admission`)
+        2. Rejects requests if VRAM doesn't become available
+        3. Measures peak memory usage during execution
         4. Calls empty_cache() for cleanup
 
         :param func: The function to wrap (typically _annotate)
@@ -530,84 +1066,57 @@ class ClamsApp(ABC):
             app_instance = getattr(func, '__self__', None)
 
             cuda_profiler = {}
-            torch_available = False
-            cuda_available = False
-            device_count = 0
+            # an app that never imported torch doesn't use CUDA through it, so no probing at all
+            torch = sys.modules.get('torch')
+            cuda_available = torch is not None and torch.cuda.is_available()
+            device_count = torch.cuda.device_count() if cuda_available else 0
             available_before = {}
 
-            try:
-                import torch  # pytype: disable=import-error
-                torch_available = True
-                cuda_available = torch.cuda.is_available()
-                device_count = torch.cuda.device_count()
-            except ImportError:
-                pass
-
-            # Capture available VRAM before execution and reset stats
-            if torch_available and cuda_available:
-                for device_id in range(device_count):
-                    device_id_str = f'cuda:{device_id}'
-                    # Get GPU-wide available memory via nvidia-smi
-                    try:
-                        import subprocess
-                        import shutil
-                        if shutil.which('nvidia-smi'):
-                            result = subprocess.run(
-                                ['nvidia-smi', '--query-gpu=memory.free',
-                                 '--format=csv,noheader,nounits', '-i', str(device_id)],
-                                capture_output=True, text=True, timeout=5
-                            )
-                            if result.returncode == 0 and result.stdout.strip():
-                                free_mb = float(result.stdout.strip())
-                                available_before[device_id] = int(free_mb * 1024 * 1024)
-                            else:
-                                # Fallback to torch (process-specific)
-                                total = torch.cuda.get_device_properties(device_id_str).total_memory
-                                allocated = torch.cuda.memory_allocated(device_id_str)
-                                available_before[device_id] = total - allocated
+            admission = getattr(app_instance, 'vram_admission', None) if cuda_available else None
+            gate = admission.admit(app_instance._estimate_vram(kwargs)) if admission is not None else nullcontext()
+            with gate:
+                # Capture available VRAM before execution and reset stats
+                if cuda_available:
+                    # GPU-wide available memory of all devices, in a single probe
+                    inventory = get_inventory()
+                    free_memory = inventory.free_memory()
+                    for device_id in range(device_count):
+                        if inventory.cuda_index(device_id) in free_memory:
+                            available_before[device_id] = free_memory[inventory.cuda_index(device_id)]
                         else:
                             # Fallback to torch (process-specific)
+                            device_id_str = f'cuda:{device_id}'
                             total = torch.cuda.get_device_properties(device_id_str).total_memory
                             allocated = torch.cuda.memory_allocated(device_id_str)
                             available_before[device_id] = total - allocated
-                    except Exception:
-                        # Fallback to torch (process-specific)
-                        total = torch.cuda.get_device_properties(device_id_str).total_memory
-                        allocated = torch.cuda.memory_allocated(device_id_str)
-                        available_before[device_id] = total - allocated
-                # Reset peak memory stats for all devices
-                torch.cuda.reset_peak_memory_stats('cuda')
+                    # Reset peak memory stats for all devices
+                    torch.cuda.reset_peak_memory_stats('cuda')
 
-            try:
-                result = func(*args, **kwargs)
-
-                # Record peak memory usage
-                total_peak = 0
-                if torch_available and cuda_available and device_count > 0:
-                    for device_id in range(device_count):
-                        device_id_str = f'cuda:{device_id}'
-                        peak_memory = torch.cuda.max_memory_allocated(device_id_str)
-                        total_peak = max(total_peak, peak_memory)
-                        gpu_name = torch.cuda.get_device_name(device_id_str)
-                        gpu_total_memory = torch.cuda.get_device_properties(device_id_str).total_memory
-                        cuda_profiler[gpu_name] = {
-                            'total': gpu_total_memory,
-                            'available_before': available_before.get(device_id, 0),
-                            'peak': peak_memory
-                        }
-
-                    # Record peak memory for future requests (if GPU app)
-                    gpu_app = (
-                        hasattr(app_instance, 'metadata') and
-                        getattr(app_instance.metadata, 'est_gpu_mem_min', 0) > 0
-                    )
-                    if gpu_app and total_peak > 0:
-                        app_instance._record_vram_usage(kwargs, total_peak)
-
-                return result, cuda_profiler
-            finally:
-                if torch_available and cuda_available:
-                    torch.cuda.empty_cache()
+                try:
+                    result = func(*args, **kwargs)
+
+                    # Record peak memory usage
+                    total_peak = 0
+                    if cuda_available and device_count > 0:
+                        for device_id in range(device_count):
+                            device_id_str = f'cuda:{device_id}'
+                            peak_memory = torch.cuda.max_memory_allocated(device_id_str)
+                            total_peak = max(total_peak, peak_memory)
+                            gpu_name = torch.cuda.get_device_name(device_id_str)
+                            gpu_total_memory = torch.cuda.get_device_properties(device_id_str).total_memory
+                            cuda_profiler[gpu_name] = {
+                                'total': gpu_total_memory,
+                                'available_before': available_before.get(device_id, 0),
+                                'peak': peak_memory
+                            }
+
+                        if total_peak > 0 and app_instance is not None:
+                            app_instance.last_cuda_peak_bytes = total_peak
+
+                    return result, cuda_profiler
+                finally:
+                    if cuda_available:
+                        torch.cuda.empty_cache()
 
         return wrapper
 
@@ -641,6 +1150,106 @@ class ClamsApp(ABC):
                     raise FileNotFoundError(p.path)
 
 
+class _GenerateBatcher(object):
+    """
+    Collects :py:meth:`ClamsPromptableApp.generate` calls from concurrent
+    threads (i.e., concurrent requests served by the same process) and runs
+    them as shared ``generate`` calls.
+
+    Only calls that share everything but the per-prompt media (the prompt
+    turns, system prompt, prompt mode and generation parameters) can be
+    merged; their ``images`` / ``audios`` groups are concatenated into one
+    batch and the outputs are split back to the callers in order. The first
+    call of a batch waits up to ``max_wait`` seconds for others to join
+    (or until ``max_batch_size`` prompts are collected) and then runs the
+    batch on behalf of all callers. A call that doesn't fit into the open
+    batch starts a new one, and the open batch then runs without waiting
+    further. Calls that can't be merged (text-only calls, or calls that are
+    already full batches) run right away.
+    """
+
+    class _Batch(object):
+        def __init__(self):
+            self.calls = []  # (images, audios, n) per caller
+            self.size = 0
+            # set when no other call can join, e.g. when a call didn't fit and started a new batch
+            self.closed = False
+            self.done = threading.Event()
+            self.outputs: Optional[List[str]] = None
+            self.error: Optional[BaseException] = None
+
+    def __init__(self, generate, max_batch_size: int, max_wait: float, logger: logging.Logger):
+        self._generate = generate
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.logger = logger
+        self._cond = threading.Condition()
+        self._open: Dict[Any, '_GenerateBatcher._Batch'] = {}
+
+    def __call__(self, prompt, system_prompt='', images=None, audios=None, prompt_mode='turn-taking',
+                 **generation_params) -> List[str]:
+        if images is not None:
+            n = len(images)
+        elif audios is not None:
+            n = len(audios)
+        else:
+            n = 0
+        if n == 0 or n >= self.max_batch_size or (images is not None and audios is not None and len(audios) != n):
+            return self._generate(prompt, system_prompt=system_prompt, images=images, audios=audios,
+                                  prompt_mode=prompt_mode, **generation_params)
+        try:
+            key = (tuple(prompt) if isinstance(prompt, list) else prompt, system_prompt, prompt_mode,
+                   images is not None, audios is not None, tuple(sorted(generation_params.items())))
+            hash(key)
+        except TypeError:
+            # e.g. a pre-built conversation or a list-valued generation parameter
+            return self._generate(prompt, system_prompt=system_prompt, images=images, audios=audios,
+                                  prompt_mode=prompt_mode, **generation_params)
+
+        with self._cond:
+            batch = self._open.get(key)
+            leader = batch is None or batch.size + n > self.max_batch_size
+            if leader:
+                if batch is not None:
+                    # the open batch is as full as it gets, its leader doesn't need to wait any longer
+                    batch.closed = True
+                    self._cond.notify_all()
+                batch = self._open[key] = self._Batch()
+            offset = batch.size
+            batch.calls.append((images, audios, n))
+            batch.size += n
+            if leader:
+                self._cond.wait_for(lambda: batch.closed or batch.size >= self.max_batch_size,
+                                    timeout=self.max_wait)
+                # close the batch, later calls will start a new one
+                if self._open.get(key) is batch:
+                    del self._open[key]
+            elif batch.size >= self.max_batch_size:
+                self._cond.notify_all()
+        if leader:
+            self._run(batch, prompt, system_prompt, prompt_mode, generation_params)
+        else:
+            batch.done.wait()
+        if batch.error is not None:
+            raise batch.error
+        return batch.outputs[offset:offset + n]
+
+    def _run(self, batch, prompt, system_prompt, prompt_mode, generation_params) -> None:
+        images = [group for call in batch.calls for group in call[0]] if batch.calls[0][0] is not None else None
+        audios = [group for call in batch.calls for group in call[1]] if batch.calls[0][1] is not None else None
+        self.logger.debug(f"Running {batch.size} prompt(s) from {len(batch.calls)} generate call(s) as a batch")
+        try:
+            outputs = self._generate(prompt, system_prompt=system_prompt, images=images, audios=audios,
+                                     prompt_mode=prompt_mode, **generation_params)
+            if len(outputs) != batch.size:
+                raise RuntimeError(f"generate() returned {len(outputs)} outputs for a batch of {batch.size} prompts")
+            batch.outputs = outputs
+        except BaseException as e:
+            batch.error = e
+        finally:
+            batch.done.set()
+
+
 # TODO (krim @ 05/28/26): maybe we should consider implementing
 # autodoc-based auto documentation export (e.g., ``automethod`` for
 # methods and a small Sphinx extension to render
@@ -810,6 +1419,43 @@ class ClamsPromptableApp(ClamsApp):
                 f"metadata)`` inside their ``appmetadata()`` function "
                 f"in ``metadata.py``."
             )
+        self.max_batch_size = 1
+        if 'CLAMS_BATCH_MAX_SIZE' in os.environ:
+            self.enable_micro_batching(int(os.environ['CLAMS_BATCH_MAX_SIZE']),
+                                       float(os.environ.get('CLAMS_BATCH_MAX_WAIT_MS', 20)) / 1000)
+
+    def enable_micro_batching(self, max_batch_size: int = 8, max_wait: float = 0.02) -> None:
+        """
+        Turn on cross-request micro-batching of :py:meth:`generate` calls.
+        ``parallelPrompts`` stacks prompts of a single request into one
+        forward pass; with micro-batching, concurrent ``generate`` calls
+        from different requests (threads) are stacked as well. Calls are
+        merged when they share the prompt turns, system prompt, prompt
+        mode and generation parameters (i.e., only differ in the
+        ``images`` / ``audios`` groups), and each caller gets back its own
+        slice of the outputs. Text-only calls are never merged.
+
+        This only pays off when the web server runs several request
+        threads per process; :meth:`~clams.restify.Restifier.serve_production`
+        raises the number of threads to ``max_batch_size`` when
+        micro-batching is on. Can also be turned on with the
+        ``CLAMS_BATCH_MAX_SIZE`` and ``CLAMS_BATCH_MAX_WAIT_MS``
+        environment variables.
+
+        :param max_batch_size: maximum number of prompts in a merged
+            ``generate`` call. ``1`` turns micro-batching off. Mind that
+            the GPU memory cost grows with the batch size, the same way
+            as with ``parallelPrompts``.
+        :param max_wait: maximum seconds the first call of a batch waits
+            for other calls to join.
+        """
+        # instance attribute shadows the (subclass-implemented) method
+        self.__dict__.pop('generate', None)
+        self.max_batch_size = max(1, max_batch_size)
+        if self.max_batch_size > 1:
+            self.generate = _GenerateBatcher(self.generate, self.max_batch_size, max_wait, self.logger)
+            self.logger.info(f"Micro-batching generate() calls: up to {self.max_batch_size} prompts, "
+                             f"waiting up to {max_wait * 1000:.0f} ms")
 
     @abstractmethod
     def generate(
@@ -1697,3 +2343,207 @@ class ParameterCaster(object):
                 f"Colons are not allowed in map parameter keys."
             )
         return {k: v}
+
+
+def _prepare_for_streaming(mmif: Mmif) -> dict:
+    """
+    Does everything ``mmif.serialize(sanitize=True)`` does before the final
+    JSON encoding, without ever building the JSON string: generates capital
+    annotations, factors out shared properties, prunes unused ``contains``,
+    and validates the output against the MMIF schema.
+
+    :param mmif: an output MMIF object
+    :return: a tree of JSON-native python objects, ready for encoding
+    :raises jsonschema.exceptions.ValidationError: if the output is not a valid MMIF
+    """
+    mmif.generate_capital_annotations()
+    mmif.factor_out_shared_properties()
+    for view in mmif.views:
+        existing_at_types = set(annotation.at_type for annotation in view.annotations)
+        for contains_at_type in [t for t in view.metadata.contains.keys() if t not in existing_at_types]:
+            view.metadata.contains.pop(contains_at_type)
+    encoder = MmifObjectEncoder()
+
+    def to_native(obj):
+        # same type checking order as ``json`` encoders
+        if isinstance(obj, str) or obj is None or obj is True or obj is False or isinstance(obj, (int, float)):
+            return obj
+        if isinstance(obj, (list, tuple)):
+            return [to_native(o) for o in obj]
+        if isinstance(obj, dict):
+            return {k: to_native(v) for k, v in obj.items()}
+        return to_native(encoder.default(obj))
+
+    prepared = to_native(mmif._serialize())
+    Mmif.validate(prepared)
+    return prepared
+
+
+def _iter_json(obj, indent: Optional[int], level: int = 0, depth: int = 4) -> Iterator[str]:
+    """
+    Lazily encodes a JSON-native object to pieces of a string, equivalent to
+    ``json.dumps(obj, indent=indent)``. Containers at the top ``depth`` levels
+    are opened up, and anything below is encoded by ``json.dumps`` at once
+    (which is much faster than the pure python ``JSONEncoder.iterencode``).
+    For MMIF, the default depth of 4 means each annotation is one piece.
+    """
+    if depth > 0 and obj and (isinstance(obj, (list, tuple))
+                              or (isinstance(obj, dict) and all(isinstance(k, str) for k in obj))):
+        is_dict = isinstance(obj, dict)
+        opening, closing = ('{', '}') if is_dict else ('[', ']')
+        if indent is None:
+            first_sep, item_sep, last_sep = '', ', ', ''
+        else:
+            first_sep = '\n' + ' ' * (indent * (level + 1))
+            item_sep = ',' + first_sep
+            last_sep = '\n' + ' ' * (indent * level)
+        yield opening + first_sep
+        for i, item in enumerate(obj.items() if is_dict else obj):
+            if i > 0:
+                yield item_sep
+            if is_dict:
+                yield json.dumps(item[0]) + ': '
+                item = item[1]
+            yield from _iter_json(item, indent, level + 1, depth - 1)
+        yield last_sep + closing
+    else:
+        encoded = json.dumps(obj, indent=indent)
+        if indent is not None and level > 0:
+            # raw newlines never appear inside JSON strings, so this only re-indents the structure
+            encoded = encoded.replace('\n', '\n' + ' ' * (indent * level))
+        yield encoded
+
+
+def _iter_json_chunks(obj, indent: Optional[int], chunk_size: int) -> Iterator[str]:
+    """
+    Groups pieces from :func:`_iter_json` into chunks of at least
+    ``chunk_size`` characters (except for the last one).
+    """
+    buffer = []
+    buffered = 0
+    for piece in _iter_json(obj, indent):
+        buffer.append(piece)
+        buffered += len(piece)
+        if buffered >= chunk_size:
+            yield ''.join(buffer)
+            buffer = []
+            buffered = 0
+    if buffer:
+        yield ''.join(buffer)
+
+
+def _batched(iterable: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+# the app of a worker process of :meth:`ClamsApp.annotate_many`, inherited from the parent
+_pool_app: Optional[ClamsApp] = None
+
+
+def _set_pool_app(app: ClamsApp) -> None:
+    global _pool_app
+    _pool_app = app
+
+
+def _annotate_in_pool(items: list, runtime_params: Dict[str, List[str]],
+                      prepared: Tuple[dict, List[Warning]]) -> List[str]:
+    return _pool_app._annotate_items(items, runtime_params, prepared)
+
+
+def _iter_pooled(pool_factory: Callable[[], Executor], func: Callable[[list], List[str]],
+                 batches: Iterator[list], ordered: bool, window: int) -> Iterator[str]:
+    # only a window of batches is submitted ahead, so inputs are read (and outputs held) as they are consumed
+    pool = pool_factory()
+    pending = collections.deque()
+    try:
+        for batch in itertools.islice(batches, window):
+            pending.append(pool.submit(func, batch))
+        while pending:
+            if ordered:
+                future = pending.popleft()
+            else:
+                done, _ = futures_wait(pending, return_when=FIRST_COMPLETED)
+                future = next(f for f in pending if f in done)
+                pending.remove(future)
+            for batch in itertools.islice(batches, 1):
+                pending.append(pool.submit(func, batch))
+            yield from future.result()
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+class _WarningRecorder(object):
+    """
+    Records warnings like ``warnings.catch_warnings(record=True)``, but can
+    be used by many threads at once (e.g. the threads of a server, or of
+    :meth:`ClamsApp.annotate_many`): the ``warnings`` module is patched
+    while any thread records, and each warning goes to the recording of
+    the context that issued it. The recording is kept in a context
+    variable, so it follows the code of an app into executors that copy
+    the context (e.g. ``asyncio.to_thread``). A warning from a thread
+    without a recording (e.g. a plain thread started by ``_annotate``)
+    goes to the only recording in progress, if there is exactly one, and
+    is shown as usual otherwise.
+    """
+    _ONCE = ('default', 'module', 'once')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._records = contextvars.ContextVar('warning_records', default=None)
+        self._active = []
+        self._catcher = None
+        self._showwarning = None
+        self._defaultaction = None
+
+    @contextmanager
+    def record(self) -> Iterator[list]:
+        records = []
+        with self._lock:
+            if not self._active:
+                self._catcher = warnings.catch_warnings()
+                self._catcher.__enter__()
+                # the registry of warnings shown "once" is shared by threads, so deduplication
+                # is done per recording instead (see _show), as catch_warnings() would do per call
+                warnings.filters[:] = [  # pytype: disable=unsupported-operands
+                    ('always',) + f[1:] if f[0] in self._ONCE else f for f in warnings.filters]
+                self._defaultaction = warnings.defaultaction  # pytype: disable=module-attr
+                if warnings.defaultaction in self._ONCE:  # pytype: disable=module-attr
+                    warnings.defaultaction = 'always'
+                getattr(warnings, '_filters_mutated', lambda: None)()
+                self._showwarning = warnings.showwarning
+                warnings.showwarning = self._show
+            self._active.append(records)
+        token = self._records.set(records)
+        try:
+            yield records
+        finally:
+            self._records.reset(token)
+            with self._lock:
+                # by identity, as recordings with the same warnings are equal
+                self._active = [r for r in self._active if r is not records]
+                if not self._active:
+                    warnings.defaultaction = self._defaultaction
+                    self._catcher.__exit__(None, None, None)
+                    self._catcher = None
+
+    def _show(self, message, category, filename, lineno, file=None, line=None):
+        records = self._records.get()
+        if records is None:
+            with self._lock:
+                if len(self._active) == 1:
+                    records = self._active[0]
+        if records is None:
+            self._showwarning(message, category, filename, lineno, file, line)
+            return
+        with self._lock:
+            if not any((str(r.message), r.category, r.filename, r.lineno) == (str(message), category, filename, lineno)
+                       for r in records):
+                records.append(warnings.WarningMessage(message, category, filename, lineno, file, line))
+
+
+_warning_recorder = _WarningRecorder()
@@ -3,6 +3,7 @@ import os
 import shutil
 import subprocess
 import sys
+import threading
 from pathlib import Path
 from typing import Union, Dict, List, Optional, Literal, Any
 
@@ -42,7 +43,11 @@ def get_clams_pyver():
 
 def generate_app_version(cwd=None):
     gitcmd = shutil.which('git') 
-    gitdir = (Path(sys.modules["__main__"].__file__).parent.resolve() if cwd is None else Path(cwd)) / '.git'
+    if cwd is None:
+        # __main__ has no file in interactive sessions and in some subprocesses (e.g. spawned batch shards)
+        main_file = getattr(sys.modules['__main__'], '__file__', None)
+        cwd = Path(main_file).parent.resolve() if main_file else Path.cwd()
+    gitdir = Path(cwd) / '.git'
     if gitcmd is not None and gitdir.exists():
         try:
             proc = subprocess.run([gitcmd, '--git-dir', str(gitdir), 'describe', '--tags', '--always'], 
@@ -70,12 +75,29 @@ def jsonschema_versioning(js):
     js['$comment'] = f"clams-python SDK {get_clams_pyver()} was used to generate this schema"
 
 
+# version of all metadata model objects in the process, increased on every
+# change made by assigning a field or by a helper method, and used (as
+# ``AppMetadata.change_token()``) by consumers that cache serialized metadata
+_version = 0
+_version_lock = threading.Lock()
+
+
+def _bump_version():
+    global _version
+    with _version_lock:
+        _version += 1
+
+
 class _BaseModel(pydantic.BaseModel):
     
     model_config = {
         "json_schema_extra": pop_titles
     }
 
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        _bump_version()
+
 
 class Output(_BaseModel):
     """
@@ -376,6 +398,12 @@ class AppMetadata(pydantic.BaseModel):
                     "Must be equal or larger than est_gpu_mem_min. "
                     "Set to 0 (default) if the app does not use GPU."
     )
+    est_host_mem_typ: int = pydantic.Field(
+        0,
+        description="(optional) Typical peak host memory (RAM) usage of an app process for default parameters, "
+                    "in megabytes (MB), including loaded models. Used to size the number of server workers until "
+                    "the SDK has recorded actual memory usage. Set to 0 (default) if unknown."
+    )
 
     model_config = {
         'title': 'CLAMS AppMetadata',
@@ -384,6 +412,35 @@ class AppMetadata(pydantic.BaseModel):
         'json_schema_extra': lambda schema, model: [adjust(schema) for adjust in [pop_titles, jsonschema_versioning]],
     }
     
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        _bump_version()
+
+    def change_token(self) -> int:
+        """
+        Returns a cheap token that changes whenever the metadata is modified
+        by assigning a field (of this object or any nested input, output or
+        parameter object) or by the ``add_*`` helper methods. Computing the
+        token does not require serialization, so it can be used to validate
+        caches of serialized metadata.
+
+        Editing a nested list or dict in place (e.g.
+        ``metadata.more[key] = value``) does not change the token, so
+        :meth:`refresh` must be called after such edits.
+
+        :returns: an opaque, comparable token
+        :rtype: int
+        """
+        return _version
+
+    def refresh(self) -> None:
+        """
+        Marks the metadata as modified, so that caches of serialized
+        metadata are refreshed. Needed only after editing a nested list or
+        dict in place, see :meth:`change_token`.
+        """
+        _bump_version()
+
     @pydantic.model_validator(mode='after')
     def assign_versions(self):
         if self.app_version == '':
@@ -441,6 +498,7 @@ class AppMetadata(pydantic.BaseModel):
             raise ValueError(f"Cannot add a duplicate input '{new}'.")
         else:
             self.input.append(new)
+            _bump_version()
             if not required:
                 # TODO (krim @ 5/12/21): automatically add *optional* input types to parameter
                 # see https://github.com/clamsproject/clams-python/issues/29 for discussion
@@ -465,6 +523,7 @@ class AppMetadata(pydantic.BaseModel):
             if isinstance(inputs[0], Input):
                 if not self._check_input_duplicate(inputs[0]):
                     self.input.append(inputs[0])
+                    _bump_version()
             else:
                 self.add_input(at_type=inputs[0])
 
@@ -479,6 +538,7 @@ class AppMetadata(pydantic.BaseModel):
                 else:
                     newinputs.append(i)
             self.input.append(newinputs)
+            _bump_version()
 
     def add_app_tag(self, *tags: str) -> None:
         """
@@ -492,6 +552,7 @@ class AppMetadata(pydantic.BaseModel):
                 raise ValueError(f"app tag must be a non-empty string: {tag!r}")
             if tag not in self.app_tags:
                 self.app_tags.append(tag)
+                _bump_version()
 
     def add_output(self, at_type: Union[str, vocabulary.ThingTypesBase], **properties) -> Output:
         """
@@ -504,6 +565,7 @@ class AppMetadata(pydantic.BaseModel):
         new = Output(at_type=at_type, properties=properties)
         if new not in self.output:
             self.output.append(new)
+            _bump_version()
         else:
             raise ValueError(f"Cannot add a duplicate output '{new}'.")
         return new
@@ -535,6 +597,7 @@ class AppMetadata(pydantic.BaseModel):
             default=default)
         if new_param.name not in [param.name for param in self.parameters]:
             self.parameters.append(new_param)
+            _bump_version()
         else:
             raise ValueError(f"parameter '{new_param.name}' already exist.")
         
@@ -549,6 +612,7 @@ class AppMetadata(pydantic.BaseModel):
                 self.more = {}
             if key not in self.more:
                 self.more[key] = value
+                _bump_version()
             else:
                 raise ValueError(f"'{key}' is already being used in the appmetadata!")
         else:
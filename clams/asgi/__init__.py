@@ -0,0 +1,222 @@
+"""
+Asyncio-native HTTP serving of CLAMS apps.
+
+:class:`AsgiRestifier` is an `ASGI <https://asgi.readthedocs.io/>`_
+application that serves a :class:`~clams.app.ClamsApp` with the same HTTP
+contract as :class:`~clams.restify.Restifier` (``GET`` for app metadata,
+``POST``/``PUT`` to annotate), but handles requests on an event loop
+instead of a thread per request. Annotation goes through
+:meth:`~clams.app.ClamsApp.annotate_async`, so an app that overrides it
+with a native coroutine serves many concurrent requests in one process,
+while other apps run in a bounded thread pool.
+
+Request and response bodies can be compressed as with
+:class:`~clams.restify.Restifier` (see :mod:`clams.compression`).
+
+It runs under any ASGI server; :meth:`AsgiRestifier.serve` uses uvicorn
+(``pip install clams-python[asgi]``).
+"""
+import io
+import json
+import os
+import sys
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import parse_qs
+
+import jsonschema
+
+from clams.admission import AdmissionRejected
+from clams.app import ClamsApp
+from clams.compression import (CompressionError, DecompressedTooLarge, UnsupportedEncoding, compress,
+                               decompressed_size_limit, negotiate, read_decompressed)
+from clams.envelop import EnvelopeError
+
+Scope = dict
+Receive = Callable[[], Awaitable[dict]]
+Send = Callable[[dict], Awaitable[None]]
+
+_JSON = 'application/json'
+_TEXT = 'text/plain; charset=utf-8'
+
+
+class AsgiRestifier(object):
+    """
+    Wraps a :class:`.ClamsApp` into an ASGI application. Instances are
+    ASGI callables, to be run by an ASGI server.
+
+    On startup (ASGI lifespan), :meth:`~clams.app.ClamsApp.warm_up` is
+    called before requests are accepted. Job mode, streaming output and
+    the ``/metrics`` endpoint are only available with
+    :class:`~clams.restify.Restifier`.
+
+    :param app_instance: A :class:`.ClamsApp` to wrap.
+    :param loopback: when True, the server only listens to requests from localhost.
+    :param port: Port number for the server to listen.
+    :param max_decompressed_mb: Size limit (in megabytes) of a compressed request body once decompressed; larger
+                                ones are answered with ``413 Content Too Large``. Can also be set with
+                                ``CLAMS_MAX_DECOMPRESSED_MB`` environment variable, 1024 MB by default.
+    """
+
+    def __init__(self, app_instance: ClamsApp, loopback: bool = False, port: int = 5000,
+                 max_decompressed_mb: Optional[float] = None) -> None:
+        self.cla = app_instance
+        self.host = 'localhost' if loopback else '0.0.0.0'
+        self.port = port
+        self.max_decompressed_size = decompressed_size_limit(max_decompressed_mb)
+
+    def serve(self, **options):
+        """
+        Runs the app with uvicorn (https://www.uvicorn.org/), in a single
+        process. Concurrency of annotation is bounded by
+        :py:attr:`~clams.app.ClamsApp.async_max_workers`.
+
+        :param options: any additional options to pass to ``uvicorn.run``.
+        """
+        import uvicorn  # pytype: disable=import-error
+        options.setdefault('log_level', os.environ.get('CLAMS_LOGLEVEL', 'warning').lower())
+        uvicorn.run(self, host=self.host, port=self.port, **options)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+        else:
+            raise ValueError(f"Unsupported ASGI scope type: {scope['type']}")
+
+    async def _lifespan(self, receive: Receive, send: Send) -> None:
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await self.cla.run_blocking(self.cla.warm_up)
+                except Exception as e:
+                    self.cla.logger.exception("Error in warm-up")
+                    await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _http(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['path'] not in ('', '/'):
+            await _respond(send, 404, b'Not Found', _TEXT)
+            return
+        method = scope['method']
+        # this will catch duplicate arguments with different values into a list under the key
+        raw_params = parse_qs(scope.get('query_string', b'').decode('latin-1'), keep_blank_values=True)
+        headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+        if method in ('GET', 'HEAD'):
+            status, body, content_type, extra = self.get(raw_params, headers)
+            await _respond(send, status, b'' if method == 'HEAD' else body, content_type, extra,
+                           content_length=len(body))
+        elif method in ('POST', 'PUT'):
+            raw_data = await _read_body(receive)
+            if raw_data is None:
+                # client went away
+                return
+            content_encoding = headers.get('content-encoding')
+            if content_encoding:
+                try:
+                    raw_data = await self.cla.run_blocking(read_decompressed, io.BytesIO(raw_data), content_encoding,
+                                                           self.max_decompressed_size)
+                except UnsupportedEncoding as e:
+                    await _respond(send, 415, str(e).encode('utf-8'), _TEXT)
+                    return
+                except DecompressedTooLarge as e:
+                    await _respond(send, 413, str(e).encode('utf-8'), _TEXT)
+                    return
+                except CompressionError as e:
+                    await _respond(send, 500, _invalid_input(str(e)), _TEXT)
+                    return
+            status, body, content_type, extra = await self.post(raw_data, raw_params)
+            extra = extra + [('Vary', 'Accept-Encoding')]
+            encoding = negotiate(headers.get('accept-encoding'))
+            if encoding is not None:
+                body = await self.cla.run_blocking(compress, body, encoding)
+                extra.append(('Content-Encoding', encoding))
+            await _respond(send, status, body, content_type, extra)
+        else:
+            await _respond(send, 405, b'Method Not Allowed', _TEXT, [('Allow', 'GET, HEAD, POST, PUT')])
+
+    def get(self, raw_params: Dict[str, List[str]], headers: Dict[str, str]) \
+            -> Tuple[int, bytes, str, List[Tuple[str, str]]]:
+        """
+        Maps HTTP GET verb to :meth:`~clams.app.ClamsApp.appmetadata`, with
+        the same ``ETag`` handling as :meth:`.ClamsHTTPApi.get`.
+
+        :param raw_params: query string parameters
+        :param headers: request headers, with lowercased names
+        :return: status, body, content type and extra headers of the response
+        """
+        body, etag = self.cla.appmetadata_with_etag(**raw_params)
+        quoted = f'"{etag}"'
+        # clients may cache, but must revalidate every time
+        extra = [('ETag', quoted), ('Cache-Control', 'no-cache')]
+        if _etag_matches(headers.get('if-none-match'), quoted):
+            return 304, b'', _JSON, extra
+        return 200, body, _JSON, extra
+
+    async def post(self, raw_data: bytes, raw_params: Dict[str, List[str]]) \
+            -> Tuple[int, bytes, str, List[Tuple[str, str]]]:
+        """
+        Maps HTTP POST (and PUT) verb to :meth:`~clams.app.ClamsApp.annotate_async`,
+        with the same error responses as :meth:`.ClamsHTTPApi.post`.
+
+        :param raw_data: request body
+        :param raw_params: query string parameters
+        :return: status, body, content type and extra headers of the response
+        """
+        try:
+            output = await self.cla.annotate_async(raw_data, **raw_params)
+            return 200, output.encode('utf-8'), _JSON, []
+        except (jsonschema.exceptions.ValidationError,
+                json.JSONDecodeError, EnvelopeError) as e:
+            return 500, _invalid_input(
+                e.message
+                if isinstance(e, jsonschema.exceptions.ValidationError)
+                else str(e)), _TEXT, []
+        except AdmissionRejected as e:
+            self.cla.logger.warning(f"Rejected a request: {e}")
+            return 503, f"Service unavailable: {e}".encode('utf-8'), _TEXT, [('Retry-After', str(e.retry_after))]
+        except Exception:
+            self.cla.logger.exception("Error in annotation")
+            # decoding the input and serializing the error view must not block the event loop
+            body = await self.cla.run_blocking(self._error_body, raw_data, raw_params, sys.exc_info())
+            return 500, body, _JSON, []
+
+    def _error_body(self, raw_data: bytes, raw_params: Dict[str, List[str]], exc_info: tuple) -> bytes:
+        return self.cla.record_error(raw_data, exc_info=exc_info, **raw_params).serialize(pretty=True).encode('utf-8')
+
+
+def _invalid_input(detail: str) -> bytes:
+    return ("Invalid input data. See below for validation error.\n\n" + detail).encode('utf-8')
+
+
+def _etag_matches(if_none_match: Optional[str], quoted: str) -> bool:
+    if not if_none_match:
+        return False
+    # weak comparison, as for GET requests
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or quoted in tags or f'W/{quoted}' in tags
+
+
+async def _read_body(receive: Receive) -> Optional[bytes]:
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        body.extend(message.get('body', b''))
+        if not message.get('more_body', False):
+            return bytes(body)
+
+
+async def _respond(send: Send, status: int, body: bytes, content_type: str,
+                   extra_headers: Iterable[Tuple[str, str]] = (), content_length: Optional[int] = None) -> None:
+    headers = [(b'content-type', content_type.encode('latin-1')),
+               (b'content-length', str(len(body) if content_length is None else content_length).encode('latin-1'))]
+    headers.extend((name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in extra_headers)
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
@@ -0,0 +1,308 @@
+"""
+Offline batch processing of many MMIF files with one app.
+
+Running ``cli.py`` once per file makes every file pay for interpreter
+start-up and model loading. :func:`run_batch` instead keeps one warm app
+instance per shard and runs all inputs of the shard through it. It is
+exposed in ``cli.py`` of apps with the ``--batch`` option.
+
+Inputs are listed in a manifest file, or found in a directory. Work is
+split into shards, each processed by its own local process; a shard is
+pinned to one GPU (by ``CUDA_VISIBLE_DEVICES``) when GPUs are visible, or
+to its own share of CPU cores otherwise.
+
+Every output is written atomically, and inputs whose output already exists
+are skipped. Every shard records the inputs it finished in a checkpoint
+file in the output directory, so that a run that was killed resumes where
+it stopped, without re-running inputs that failed.
+
+For orchestrators that run an app as a long-lived subprocess,
+:func:`run_jsonl` reads newline-delimited inputs and writes one output line
+per input, in order (the ``--jsonl`` option of ``cli.py``).
+"""
+import json
+import logging
+import multiprocessing
+import os
+import pathlib
+import sys
+import time
+from contextlib import nullcontext, redirect_stdout
+from typing import IO, Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+import jsonschema
+
+from clams.compression import SUFFIXES, open_text
+from clams.envelop import EnvelopeError
+from clams.hardware import get_inventory
+
+logger = logging.getLogger(__name__)
+
+#: Suffixes of input files picked up from a directory, with or without a compression suffix
+INPUT_SUFFIXES = ('.mmif', '.json')
+
+#: Name of the directory (in the output directory) holding checkpoint files
+CHECKPOINT_DIR = '.clams-batch'
+
+# outcomes of an input
+DONE = 'done'
+SKIPPED = 'skipped'
+ERROR = 'error'
+INVALID = 'invalid'
+
+Task = Tuple[str, str]
+
+
+def _is_input_file(path: pathlib.Path) -> bool:
+    name = path.name
+    for suffix in SUFFIXES:
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    return name.endswith(INPUT_SUFFIXES) and not path.name.startswith('.')
+
+
+def collect_tasks(source: Union[str, os.PathLike], out_dir: Union[str, os.PathLike]) -> List[Task]:
+    """
+    Lists the inputs to process and where their outputs go.
+
+    :param source: a directory, searched recursively for MMIF files (``.mmif``
+                   or ``.json``, optionally ``.gz`` or ``.zst`` compressed),
+                   or a manifest file listing an input file per line,
+                   optionally followed by a tab and an output file. Relative
+                   paths in a manifest are relative to the manifest, blank
+                   lines and lines starting with ``#`` are ignored
+    :param out_dir: directory for outputs not given in the manifest; the
+                    output of an input found in a directory goes to the same
+                    relative path in ``out_dir``, otherwise to its file name
+    :return: (input path, output path) pairs, in a stable order
+    """
+    source = pathlib.Path(source)
+    out_dir = pathlib.Path(out_dir)
+    if source.is_dir():
+        return [(str(p), str(out_dir / p.relative_to(source)))
+                for p in sorted(source.rglob('*')) if p.is_file() and _is_input_file(p)]
+    tasks = []
+    with open(source, encoding='utf-8') as manifest:
+        for line in manifest:
+            line = line.rstrip('\n')
+            if not line.strip() or line.startswith('#'):
+                continue
+            in_path, _, out_path = line.partition('\t')
+            in_path = source.parent / in_path.strip()
+            out_path = source.parent / out_path.strip() if out_path.strip() else out_dir / in_path.name
+            tasks.append((str(in_path), str(out_path)))
+    return tasks
+
+
+def _checkpoint_path(out_dir: pathlib.Path, shard: int) -> pathlib.Path:
+    return out_dir / CHECKPOINT_DIR / f'shard-{shard}.jsonl'
+
+
+def read_checkpoints(out_dir: Union[str, os.PathLike]) -> Dict[str, str]:
+    """
+    :param out_dir: output directory of a batch run
+    :return: outcome of every input finished so far (by input path), from the checkpoints of all shards
+    """
+    finished = {}
+    for path in sorted((pathlib.Path(out_dir) / CHECKPOINT_DIR).glob('shard-*.jsonl')):
+        with open(path, encoding='utf-8') as checkpoint:
+            for line in checkpoint:
+                try:
+                    record = json.loads(line)
+                    finished[record['input']] = record['status']
+                except (ValueError, KeyError):
+                    # the last line of a killed run can be truncated
+                    continue
+    return finished
+
+
+def _pin(shard: int, shards: int) -> str:
+    """
+    Pins the current process to one GPU, or to a share of CPU cores, by the shard index.
+    """
+    gpus = get_inventory().visible_gpus()
+    if gpus:
+        gpu = gpus[shard % len(gpus)]
+        os.environ['CUDA_VISIBLE_DEVICES'] = str(gpu.index)
+        return f"GPU {gpu.index}"
+    if not hasattr(os, 'sched_setaffinity'):
+        return "all cores"
+    cores = sorted(os.sched_getaffinity(0))
+    share = max(1, len(cores) // shards)
+    mine = cores[(shard * share) % len(cores):][:share]
+    os.sched_setaffinity(0, mine)
+    # honored by math libraries that are not loaded yet
+    os.environ.setdefault('OMP_NUM_THREADS', str(len(mine)))
+    return f"cores {','.join(map(str, mine))}"
+
+
+def _write_atomically(path: pathlib.Path, content: str) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # the temporary name keeps the suffix, so it is compressed the same way
+    tmp = path.with_name(f'.tmp.{os.getpid()}.{path.name}')
+    with open_text(str(tmp), 'w') as out:
+        out.write(content)
+    os.replace(tmp, path)
+
+
+def _process(app, in_path: str, out_path: pathlib.Path, params: Dict[str, List[str]]) -> str:
+    # mirrors the error handling of cli.py
+    try:
+        with open_text(in_path) as f:
+            in_data = f.read()
+    except (OSError, EOFError, UnicodeDecodeError) as e:
+        app.logger.error(f"Can't read {in_path}: {e}")
+        return INVALID
+    try:
+        _write_atomically(out_path, app.annotate(in_data, **params))
+        return DONE
+    except (jsonschema.exceptions.ValidationError, json.JSONDecodeError, EnvelopeError) as e:
+        detail = e.message if isinstance(e, jsonschema.exceptions.ValidationError) else str(e)
+        app.logger.error(f"Invalid input data in {in_path}: {detail}")
+        return INVALID
+    except Exception:
+        app.logger.exception(f"Error in annotation of {in_path}")
+        _write_atomically(out_path, app.record_error(in_data, **params).serialize(pretty=True))
+        return ERROR
+
+
+def _run_shard(app_factory: Callable, tasks: List[Task], shard: int, shards: int, out_dir: str,
+               params: Dict[str, List[str]], pin: bool, app_instance=None) -> Dict[str, int]:
+    out_dir = pathlib.Path(out_dir)
+    where = _pin(shard, shards) if pin else "no pinning"
+    counts = {DONE: 0, SKIPPED: 0, ERROR: 0, INVALID: 0}
+    checkpoint_path = _checkpoint_path(out_dir, shard)
+    checkpoint_path.parent.mkdir(parents=True, exist_ok=True)
+    app = None
+    with open(checkpoint_path, 'a', encoding='utf-8') as checkpoint:
+        for in_path, out_path in tasks:
+            if os.path.exists(out_path):
+                counts[SKIPPED] += 1
+                continue
+            if app is None:
+                # only load the app when there's work left
+                app = app_instance if app_instance is not None else app_factory()
+                app.logger.info(f"Batch shard {shard} ({where}): {len(tasks)} input(s)")
+            started = time.perf_counter()
+            status = _process(app, in_path, pathlib.Path(out_path), params)
+            counts[status] += 1
+            checkpoint.write(json.dumps({'input': in_path, 'output': out_path, 'status': status,
+                                         'seconds': round(time.perf_counter() - started, 3)}) + '\n')
+            checkpoint.flush()
+    return counts
+
+
+def run_batch(app_factory: Callable, source: Union[str, os.PathLike], out_dir: Union[str, os.PathLike],
+              params: Optional[Dict[str, List[str]]] = None, shards: int = 1, pin: bool = True,
+              retry_failed: bool = False, app_instance=None) -> Dict[str, int]:
+    """
+    Runs an app over many inputs. See the module documentation.
+
+    :param app_factory: a picklable callable (e.g. ``get_app`` of ``app.py``)
+                        returning a :class:`~clams.app.ClamsApp`, called once
+                        in every shard process
+    :param source: a directory or a manifest file (see :func:`collect_tasks`)
+    :param out_dir: output directory, also holds the checkpoints
+    :param params: runtime parameters for all inputs, values in lists (as in HTTP query strings)
+    :param shards: number of shard processes; with 1, inputs are processed in this process
+    :param pin: whether to pin every shard process to a GPU or to a share of CPU cores
+    :param retry_failed: whether to re-run inputs that failed in an earlier run (by default, they are skipped)
+    :param app_instance: an app already created in this process, used instead
+                         of calling ``app_factory`` when ``shards`` is 1
+    :return: number of inputs by outcome: ``done``, ``skipped`` (output
+             exists, or finished in an earlier run), ``error`` (an error view
+             was written as the output) and ``invalid`` (input not readable as
+             MMIF, no output written)
+    """
+    out_dir = pathlib.Path(out_dir)
+    params = params or {}
+    finished = read_checkpoints(out_dir)
+    pending, resumed = [], 0
+    for task in collect_tasks(source, out_dir):
+        status = finished.get(task[0])
+        if status is None:
+            pending.append(task)
+        elif status in (ERROR, INVALID) and retry_failed:
+            # the error view written as the output would make it look finished
+            pathlib.Path(task[1]).unlink(missing_ok=True)
+            pending.append(task)
+        else:
+            resumed += 1
+    shards = max(1, min(shards, len(pending)))
+    if shards == 1:
+        results = [_run_shard(app_factory, pending, 0, 1, str(out_dir), params, pin=False,
+                              app_instance=app_instance)]
+    else:
+        # a fresh interpreter per shard, so that CUDA and thread pools are set up after pinning
+        ctx = multiprocessing.get_context('spawn')
+        with ctx.Pool(shards, maxtasksperchild=1) as pool:
+            results = pool.starmap(_run_shard, [(app_factory, pending[i::shards], i, shards, str(out_dir), params,
+                                                 pin) for i in range(shards)])
+    counts = {DONE: 0, SKIPPED: resumed, ERROR: 0, INVALID: 0}
+    for result in results:
+        for status, n in result.items():
+            counts[status] += n
+    return counts
+
+
+def run_jsonl(app, lines: Iterable[str], out: IO[str], params: Optional[Dict[str, List[str]]] = None) \
+        -> Dict[str, int]:
+    """
+    Runs an app over newline-delimited inputs (MMIF or envelopes, one JSON
+    document per line) until the input ends, writing exactly one line for
+    every input line, in the same order.
+
+    A failure never ends the stream. When the app fails, the output line is
+    the error view MMIF made by :meth:`~clams.app.ClamsApp.record_error`.
+    When a line is not a valid input (including a blank line), or no error
+    view can be made for it, the output line is ``{"error": {"line": <line number>, "message": <reason>}}``.
+
+    :param app: a :class:`~clams.app.ClamsApp`
+    :param lines: the input lines, e.g. ``sys.stdin``
+    :param out: a text stream for the output lines, flushed after every line
+    :param params: runtime parameters for all inputs, values in lists (as in
+                   HTTP query strings); ``pretty`` is always off, to keep an
+                   output on one line
+    :return: number of inputs by outcome: ``done``, ``error`` (error view) and ``invalid`` (error record)
+    """
+    params = dict(params or {})
+    params['pretty'] = ['false']
+    counts = {DONE: 0, ERROR: 0, INVALID: 0}
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            app.logger.error(f"Invalid input data in line {number}: blank line")
+            output, status = _error_record(number, "Invalid input data. Blank line."), INVALID
+        else:
+            # prints of the app must not end up between output lines
+            with redirect_stdout(sys.stderr) if out is sys.stdout else nullcontext():
+                output, status = _process_line(app, line, number, params)
+        counts[status] += 1
+        out.write(output + '\n')
+        out.flush()
+    return counts
+
+
+def _process_line(app, line: str, number: int, params: Dict[str, List[str]]) -> Tuple[str, str]:
+    try:
+        return app.annotate(line, **params), DONE
+    except (jsonschema.exceptions.ValidationError, json.JSONDecodeError, EnvelopeError) as e:
+        detail = e.message if isinstance(e, jsonschema.exceptions.ValidationError) else str(e)
+        app.logger.error(f"Invalid input data in line {number}: {detail}")
+        return _error_record(number, f"Invalid input data. {detail}"), INVALID
+    except Exception as e:
+        app.logger.exception(f"Error in annotation of line {number}")
+        try:
+            return app.record_error(line, **params).serialize(), ERROR
+        except Exception:
+            return _error_record(number, f"{e.__class__.__name__}: {e}"), INVALID
+
+
+def _error_record(number: int, message: str) -> str:
+    return json.dumps({'error': {'line': number, 'message': message}})
+
+
+def print_summary(counts: Dict[str, int], out=sys.stderr) -> None:
+    """
+    Prints the outcome of :func:`run_batch`.
+    """
+    print(', '.join(f"{n} {status}" for status, n in counts.items()), file=out)
@@ -0,0 +1,141 @@
+"""
+On-disk cache of serialized app outputs.
+
+Outputs are stored as files named after their key in a cache directory
+(``<key>.mmif``). The cache is a least-recently-used cache: every hit
+updates the modification time of the file, and when the total size of the
+cache goes over the limit, files with the oldest modification times are
+deleted first. Since all state is on disk, a cache directory can be shared
+by multiple server processes of the same app.
+"""
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import threading
+from typing import Any, Optional
+
+from mmif.serialize.model import MmifObjectEncoder
+from mmif.utils.workflow_helper import generate_param_hash  # pytype: disable=import-error
+
+logger = logging.getLogger(__name__)
+
+
+def cache_key(mmif: Any, parameters: dict, app_version: str) -> str:
+    """
+    Computes a content-addressed key for an app run.
+
+    :param mmif: the input MMIF, as a decoded JSON structure or a :class:`~mmif.serialize.mmif.Mmif`
+    :param parameters: refined runtime parameters (see :meth:`~clams.app.ClamsApp._refine_params`)
+    :param app_version: version of the app
+    :return: a hex digest to use as the cache key
+    """
+    # canonical form: key order and whitespace of the input don't matter; a Mmif object is
+    # encoded straight into the same form as its decoded JSON, without a serialize/parse round trip
+    canonical = json.dumps(mmif, cls=MmifObjectEncoder, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    h = hashlib.sha256(canonical.encode('utf-8'))
+    h.update(b'\0' + generate_param_hash(parameters).encode('utf-8'))
+    h.update(b'\0' + str(app_version).encode('utf-8'))
+    return h.hexdigest()
+
+
+class OutputCache(object):
+    """
+    A size-bounded, on-disk LRU cache of serialized output MMIFs.
+
+    Hit, miss and eviction counters are kept per process.
+
+    :param cache_dir: directory to store cached outputs
+    :param max_size: maximum total size of cached outputs in bytes
+    """
+
+    def __init__(self, cache_dir: str, max_size: int):
+        self.cache_dir = pathlib.Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # a running estimate, other processes sharing the directory can change the actual size
+        self._size = sum(size for _, size, _ in self._entries())
+
+    def _path(self, key: str) -> pathlib.Path:
+        return self.cache_dir / f'{key}.mmif'
+
+    def _entries(self):
+        for p in self.cache_dir.glob('*.mmif'):
+            try:
+                stat = p.stat()
+            except FileNotFoundError:
+                continue
+            yield stat.st_mtime, stat.st_size, p
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        :param key: cache key (see :func:`cache_key`)
+        :return: the cached output, or None on a miss
+        """
+        path = self._path(key)
+        try:
+            content = path.read_text(encoding='utf-8')
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return content
+
+    def put(self, key: str, content: str) -> None:
+        """
+        Stores an output, then evicts least recently used outputs if the
+        cache is over its size limit. Outputs larger than the size limit are
+        not stored.
+
+        :param key: cache key (see :func:`cache_key`)
+        :param content: serialized output MMIF
+        """
+        data = content.encode('utf-8')
+        if len(data) > self.max_size:
+            return
+        path = self._path(key)
+        tmp = path.with_name(f'.{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+        with self._lock:
+            self._size += len(data)
+            if self._size > self.max_size:
+                self._evict()
+
+    def _evict(self) -> None:
+        entries = sorted(self._entries())
+        size = sum(size for _, size, _ in entries)
+        for _, entry_size, p in entries:
+            if size <= self.max_size:
+                break
+            p.unlink(missing_ok=True)
+            size -= entry_size
+            self.evictions += 1
+        self._size = size
+        logger.debug(f"Output cache at {self.cache_dir} evicted down to {size} bytes")
+
+    def clear(self) -> None:
+        """
+        Deletes all cached outputs.
+        """
+        with self._lock:
+            for _, _, p in self._entries():
+                p.unlink(missing_ok=True)
+            self._size = 0
+
+    def stats(self) -> dict:
+        """
+        :return: hit, miss and eviction counters of this process, and the
+                 (estimated) total size of the cache in bytes
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'size': self._size, 'max_size': self.max_size}
@@ -0,0 +1,266 @@
+"""
+Compression of MMIF in transport and in files.
+
+MMIF with dense annotations compresses well, so the HTTP servers accept
+request bodies with a ``Content-Encoding`` of ``gzip`` or ``zstd``
+(decompressed as a stream, without holding the compressed copy), and
+compress response bodies in the best encoding the client lists in its
+``Accept-Encoding`` header. ``cli.py`` of apps reads and writes
+``.gz`` and ``.zst`` files directly (see :class:`FileType`).
+
+gzip is always available; zstd requires the ``zstandard`` package
+(``pip install clams-python[zstd]``) and is neither accepted nor offered
+without it.
+
+A few kilobytes of compressed data can decompress to gigabytes, so request
+bodies are decompressed only up to a size limit (see
+:func:`decompressed_size_limit`).
+"""
+import argparse
+import gzip
+import importlib.util
+import io
+import os
+import zlib
+from typing import IO, Iterable, Iterator, List, Optional, TextIO, Union, cast
+
+#: Encodings in order of preference when negotiating a response encoding
+PREFERENCE = ('zstd', 'gzip')
+
+#: File name suffixes of compressed files, by encoding
+SUFFIXES = {'.gz': 'gzip', '.zst': 'zstd'}
+
+#: Default size limit of decompressed request bodies, in megabytes
+DEFAULT_MAX_DECOMPRESSED_MB = 1024
+
+_READ_SIZE = 64 * 1024
+
+
+class UnsupportedEncoding(ValueError):
+    """
+    Raised when data is in an encoding that is unknown, or whose library
+    isn't installed.
+    """
+
+
+class CompressionError(ValueError):
+    """
+    Raised when compressed data is corrupt or truncated.
+    """
+
+
+class DecompressedTooLarge(ValueError):
+    """
+    Raised when compressed data decompresses to more than the size limit.
+    """
+
+
+def _has_zstd() -> bool:
+    return importlib.util.find_spec('zstandard') is not None
+
+
+def _zstd():
+    """
+    :return: the ``zstandard`` module
+    :raises UnsupportedEncoding: if it isn't installed
+    """
+    try:
+        import zstandard  # pytype: disable=import-error
+    except ImportError:
+        raise UnsupportedEncoding("zstd encoding requires the zstandard package (pip install clams-python[zstd])")
+    return zstandard
+
+
+def available_encodings() -> List[str]:
+    """
+    :return: encodings supported in this environment, in order of preference
+    """
+    return [e for e in PREFERENCE if e != 'zstd' or _has_zstd()]
+
+
+def _normalize(encoding: Optional[str]) -> Optional[str]:
+    encoding = (encoding or '').strip().lower()
+    if encoding in ('', 'identity'):
+        return None
+    if encoding == 'x-gzip':
+        return 'gzip'
+    if encoding not in available_encodings():
+        raise UnsupportedEncoding(f"Unsupported content encoding: {encoding}")
+    return encoding
+
+
+def negotiate(accept_encoding: Optional[str]) -> Optional[str]:
+    """
+    Picks a response encoding from an ``Accept-Encoding`` header.
+
+    :param accept_encoding: value of the header, None if absent
+    :return: the most preferred available encoding the client accepts (its
+             quality values take precedence), or None for no compression
+    """
+    if not accept_encoding:
+        return None
+    accepted = {}
+    for item in accept_encoding.split(','):
+        name, _, params = item.strip().partition(';')
+        q = 1.0
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[name.strip().lower()] = q
+    if 'x-gzip' in accepted:
+        accepted.setdefault('gzip', accepted['x-gzip'])
+    candidates = [(accepted.get(e, accepted.get('*', 0.0)), -i, e) for i, e in enumerate(available_encodings())]
+    q, _, encoding = max(candidates)
+    return encoding if q > 0 else None
+
+
+def decompressing_reader(stream: IO[bytes], encoding: Optional[str]) -> IO[bytes]:
+    """
+    :param stream: a binary stream of compressed data
+    :param encoding: ``gzip``, ``zstd``, or None/``identity`` for uncompressed data
+    :return: a binary stream of the decompressed data, decompressed as it is read
+    :raises UnsupportedEncoding: if the encoding is not supported
+    """
+    encoding = _normalize(encoding)
+    if encoding is None:
+        return stream
+    if encoding == 'gzip':
+        return cast(IO[bytes], gzip.GzipFile(fileobj=stream, mode='rb'))
+    return _zstd().ZstdDecompressor().stream_reader(stream, read_across_frames=True)
+
+
+def decompressed_size_limit(max_mb: Optional[float] = None, request_limit: Optional[int] = None) -> int:
+    """
+    :param max_mb: size limit configured for the server, in megabytes
+    :param request_limit: size limit of request bodies of the server, in bytes
+    :return: size limit of decompressed request bodies in bytes: ``max_mb`` if given, or else the
+             ``CLAMS_MAX_DECOMPRESSED_MB`` environment variable, or else ``request_limit``, or else
+             :data:`DEFAULT_MAX_DECOMPRESSED_MB`
+    """
+    if max_mb is None and 'CLAMS_MAX_DECOMPRESSED_MB' in os.environ:
+        max_mb = float(os.environ['CLAMS_MAX_DECOMPRESSED_MB'])
+    if max_mb is None and request_limit:
+        return request_limit
+    return int((max_mb if max_mb is not None else DEFAULT_MAX_DECOMPRESSED_MB) * 1024 * 1024)
+
+
+def read_decompressed(stream: IO[bytes], encoding: Optional[str], max_size: Optional[int] = None) -> bytes:
+    """
+    Reads a compressed stream to its end.
+
+    :param stream: a binary stream of compressed data
+    :param encoding: ``gzip``, ``zstd``, or None/``identity`` for uncompressed data
+    :param max_size: when set, the data is not decompressed beyond this many bytes
+    :return: the decompressed data
+    :raises UnsupportedEncoding: if the encoding is not supported
+    :raises CompressionError: if the data is corrupt or truncated
+    :raises DecompressedTooLarge: if the data decompresses to more than ``max_size`` bytes
+    """
+    reader = decompressing_reader(stream, encoding)
+    out = io.BytesIO()
+    try:
+        while True:
+            # one byte more than allowed is enough to know the limit is exceeded
+            chunk = reader.read(_READ_SIZE if max_size is None else min(_READ_SIZE, max_size - out.tell() + 1))
+            if not chunk:
+                break
+            out.write(chunk)
+            if max_size is not None and out.tell() > max_size:
+                raise DecompressedTooLarge(f"Decompressed data exceeds the limit of {max_size} bytes")
+    except (OSError, EOFError, zlib.error) as e:
+        raise CompressionError(f"Corrupt {encoding} data: {e}") from e
+    except Exception as e:
+        if _has_zstd() and isinstance(e, _zstd().ZstdError):
+            raise CompressionError(f"Corrupt {encoding} data: {e}") from e
+        raise
+    return out.getvalue()
+
+
+def _compressor(encoding: str):
+    if encoding == 'gzip':
+        return zlib.compressobj(6, zlib.DEFLATED, 31)
+    return _zstd().ZstdCompressor().compressobj()
+
+
+def compress(data: Union[bytes, str], encoding: str) -> bytes:
+    """
+    :param data: data to compress, strings are encoded in UTF-8
+    :param encoding: ``gzip`` or ``zstd``
+    :return: the compressed data
+    :raises UnsupportedEncoding: if the encoding is not supported
+    """
+    return b''.join(compress_chunks([data], encoding))
+
+
+def compress_chunks(chunks: Iterable[Union[bytes, str]], encoding: str) -> Iterator[bytes]:
+    """
+    Compresses data as it comes, e.g. a streamed response body.
+
+    :param chunks: chunks of data to compress, strings are encoded in UTF-8
+    :param encoding: ``gzip`` or ``zstd``
+    :return: an iterator of compressed chunks
+    :raises UnsupportedEncoding: if the encoding is not supported
+    """
+    encoding = _normalize(encoding)
+    if encoding is None:
+        raise UnsupportedEncoding("No compression encoding given")
+    return _compress_chunks(chunks, _compressor(encoding))
+
+
+def _compress_chunks(chunks: Iterable[Union[bytes, str]], compressor) -> Iterator[bytes]:
+    for chunk in chunks:
+        compressed = compressor.compress(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def encoding_for_path(path: str) -> Optional[str]:
+    """
+    :param path: a file path
+    :return: the compression encoding of the file by its suffix, or None for uncompressed files
+    """
+    for suffix, encoding in SUFFIXES.items():
+        if str(path).endswith(suffix):
+            return encoding
+    return None
+
+
+def open_text(path: str, mode: str = 'r') -> TextIO:
+    """
+    Opens a text file for reading or writing, compressed by the suffix of
+    its name (``.gz`` or ``.zst``), or uncompressed otherwise.
+
+    :param path: a file path
+    :param mode: ``r``, ``w`` or ``a`` (text mode is implied)
+    :return: a text stream in UTF-8
+    :raises UnsupportedEncoding: if the file is zstd compressed and ``zstandard`` isn't installed
+    """
+    mode = mode.replace('t', '').replace('b', '')
+    encoding = encoding_for_path(path)
+    if encoding is None:
+        return cast(TextIO, open(path, mode, encoding='utf-8'))
+    _normalize(encoding)
+    if encoding == 'gzip':
+        return cast(TextIO, gzip.open(path, mode + 't', encoding='utf-8'))
+    return cast(TextIO, _zstd().open(path, mode + 't', encoding='utf-8'))
+
+
+class FileType(argparse.FileType):
+    """
+    A drop-in replacement of :class:`argparse.FileType` for text files that
+    opens ``.gz`` and ``.zst`` files with :func:`open_text`. ``-`` still
+    stands for STDIN/STDOUT.
+    """
+
+    def __call__(self, string):
+        if string == '-' or encoding_for_path(string) is None:
+            return super().__call__(string)
+        try:
+            return open_text(string, self._mode)
+        except (OSError, UnsupportedEncoding) as e:
+            raise argparse.ArgumentTypeError(f"can't open '{string}': {e}")
@@ -1,7 +1,7 @@
 import argparse
 import json
 import sys
-from typing import Dict, List, Optional, Tuple, Union
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 from mmif import Mmif
 
@@ -69,6 +69,16 @@ def unwrap_envelope(body: dict) -> Tuple[str, Dict[str, List[str]]]:
     :raises EnvelopeError: if ``"mmif"`` key is missing or
         ``"parameters"`` is not a dict
     """
+    mmif_obj, params = _split_envelope(body)
+    return json.dumps(mmif_obj), params
+
+
+def _split_envelope(body: dict) -> Tuple[Any, Dict[str, List[str]]]:
+    """
+    Validate the envelope structure and return the inner MMIF *as is*
+    (i.e., still the decoded JSON structure) together with the
+    normalized parameters.
+    """
     params = body.get(ENVELOPE_KEY)
     if not isinstance(params, dict):
         raise EnvelopeError(
@@ -79,8 +89,7 @@ def unwrap_envelope(body: dict) -> Tuple[str, Dict[str, List[str]]]:
         raise EnvelopeError(
             f'Envelope is missing required "{MMIF_KEY}" key'
         )
-    mmif_str = json.dumps(body[MMIF_KEY])
-    return mmif_str, normalize_params(params)
+    return body[MMIF_KEY], normalize_params(params)
 
 
 def unwrap_if_envelope(data, runtime_params):
@@ -90,9 +99,10 @@ def unwrap_if_envelope(data, runtime_params):
     ``runtime_params`` (so query-string / CLI flags take priority). If
     ``data`` is not an envelope, return it unchanged.
 
-    This is the single entry point used by every execution path
-    (HTTP, CLI, direct Python API) so envelope handling is uniform
-    regardless of how the app is invoked.
+    Note that the inner MMIF of an envelope is returned re-serialized
+    as a string, so the caller ends up parsing the input more than
+    once. The SDK itself uses :func:`load_input` instead, which decodes
+    the input exactly once.
 
     :param data: raw input -- ``bytes``, ``str``, or ``dict``
     :param runtime_params: explicitly-passed parameters that override
@@ -113,6 +123,37 @@ def unwrap_if_envelope(data, runtime_params):
     return data, runtime_params
 
 
+def load_input(data, runtime_params) -> Tuple[Any, Dict[str, List[str]]]:
+    """
+    Decode a raw input body exactly once and return the MMIF part as
+    the decoded JSON structure, ready to be handed to
+    :class:`~mmif.serialize.mmif.Mmif` without another round of
+    ``json.loads``/``json.dumps``. Envelopes are unwrapped and their
+    parameters merged under the explicitly-passed ``runtime_params``
+    (so query-string / CLI flags take priority), same as
+    :func:`unwrap_if_envelope`.
+
+    This is the single entry point used by every execution path
+    (HTTP, CLI, direct Python API) so envelope handling is uniform
+    regardless of how the app is invoked.
+
+    :param data: raw input -- ``bytes``, ``str``, or already-decoded
+        ``dict``
+    :param runtime_params: explicitly-passed parameters that override
+        envelope parameters on key collision
+    :returns: tuple of (decoded_mmif, effective_params)
+    :raises json.JSONDecodeError: if ``data`` is not valid JSON
+    :raises EnvelopeError: if ``data`` is a malformed envelope
+    """
+    # json.loads accepts bytes directly (and detects the encoding), so
+    # there's no need to decode to an intermediate str first
+    body = json.loads(data) if isinstance(data, (bytes, bytearray, str)) else data
+    if is_envelope(body):
+        inner_mmif, envelope_params = _split_envelope(body)
+        return inner_mmif, {**envelope_params, **runtime_params}
+    return body, runtime_params
+
+
 def create_envelope(
     mmif: Union[str, dict, Mmif],
     parameters: Optional[dict] = None,
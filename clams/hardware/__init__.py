@@ -0,0 +1,302 @@
+"""
+Hardware inventory of the host running a CLAMS app.
+
+Static properties of the host (CPU architecture and core count, total
+memory, names and total memory of NVIDIA GPUs) are detected once per process, on first use,
+and cached. Worker processes forked from a process that already detected
+the hardware inherit the cache. Only the dynamic value (free GPU memory)
+is probed again, through :meth:`HardwareInventory.free_memory`.
+
+GPUs are queried through a pluggable probe (:class:`GPUProbe`):
+
+* :class:`NVMLProbe` (default): queries NVML in-process, requires the
+  ``nvidia-ml-py`` package (``pip install clams-python[nvml]``)
+* :class:`NvidiaSmiProbe`: runs ``nvidia-smi`` in a subprocess, used when
+  NVML is not available
+* :class:`FakeProbe`: reports made-up devices, for tests on machines
+  without GPUs
+
+The ``CLAMS_GPU_PROBE`` environment variable (``nvml``, ``nvidia-smi`` or
+``none``) or :func:`set_probe` overrides the default.
+"""
+import logging
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import threading
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class GPUInfo(object):
+    """
+    Static properties of a GPU.
+
+    :param index: device index (as used by ``nvidia-smi -i``, and by ``cuda:<index>`` unless
+                  ``CUDA_VISIBLE_DEVICES`` is set, see :meth:`HardwareInventory.cuda_index`)
+    :param name: device name
+    :param total_memory: total memory in bytes
+    """
+
+    def __init__(self, index: int, name: str, total_memory: int):
+        self.index = index
+        self.name = name
+        self.total_memory = total_memory
+
+    def __repr__(self):
+        return f"GPUInfo(index={self.index}, name={self.name!r}, total_memory={self.total_memory})"
+
+
+class GPUProbe(ABC):
+    """
+    Interface to query NVIDIA GPUs of the host. Implementations must not
+    initialize CUDA (probing happens in the main server process, before
+    workers are forked).
+    """
+
+    @abstractmethod
+    def devices(self) -> List[GPUInfo]:
+        """
+        :return: static properties of all GPUs, empty if there's none
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def free_memory(self) -> Dict[int, int]:
+        """
+        :return: currently free memory (GPU-wide, across all processes) in bytes by device index;
+                 empty if unavailable
+        """
+        raise NotImplementedError()
+
+
+class NVMLProbe(GPUProbe):
+    """
+    Queries GPUs in-process through NVML bindings (``pynvml`` module of the
+    ``nvidia-ml-py`` package).
+
+    :raises ImportError: if ``nvidia-ml-py`` is not installed
+    """
+
+    def __init__(self):
+        import pynvml  # pytype: disable=import-error
+        self.nvml = pynvml
+        self._init_pid: Optional[int] = None
+        self._init()
+
+    def _init(self) -> None:
+        # NVML must be initialized in every process
+        if self._init_pid != os.getpid():
+            self.nvml.nvmlInit()
+            self._init_pid = os.getpid()
+
+    def devices(self) -> List[GPUInfo]:
+        self._init()
+        gpus = []
+        for i in range(self.nvml.nvmlDeviceGetCount()):
+            handle = self.nvml.nvmlDeviceGetHandleByIndex(i)
+            name = self.nvml.nvmlDeviceGetName(handle)
+            if isinstance(name, bytes):
+                name = name.decode('utf-8')
+            gpus.append(GPUInfo(i, name, int(self.nvml.nvmlDeviceGetMemoryInfo(handle).total)))
+        return gpus
+
+    def free_memory(self) -> Dict[int, int]:
+        try:
+            self._init()
+            return {i: int(self.nvml.nvmlDeviceGetMemoryInfo(self.nvml.nvmlDeviceGetHandleByIndex(i)).free)
+                    for i in range(self.nvml.nvmlDeviceGetCount())}
+        except self.nvml.NVMLError as e:
+            logger.warning(f"Failed to query free GPU memory via NVML: {e}")
+            return {}
+
+
+class NvidiaSmiProbe(GPUProbe):
+    """
+    Queries GPUs by running ``nvidia-smi`` in a subprocess.
+    """
+
+    @staticmethod
+    def _query(*query: str) -> Optional[List[List[str]]]:
+        if not shutil.which('nvidia-smi'):
+            return None
+        try:
+            result = subprocess.run(
+                ['nvidia-smi', f"--query-gpu={','.join(query)}", '--format=csv,noheader,nounits'],
+                capture_output=True, text=True, timeout=5)
+        except (OSError, subprocess.SubprocessError):
+            return None
+        if result.returncode != 0 or not result.stdout.strip():
+            return None
+        return [[field.strip() for field in line.split(',')] for line in result.stdout.strip().split('\n')]
+
+    def devices(self) -> List[GPUInfo]:
+        gpus = []
+        for row in self._query('index', 'name', 'memory.total') or []:
+            try:
+                gpus.append(GPUInfo(int(row[0]), row[1], int(float(row[2]) * 1024 * 1024)))
+            except (ValueError, IndexError):
+                logger.warning(f"Unexpected nvidia-smi output: {row}")
+        return gpus
+
+    def free_memory(self) -> Dict[int, int]:
+        free = {}
+        for row in self._query('index', 'memory.free') or []:
+            try:
+                free[int(row[0])] = int(float(row[1]) * 1024 * 1024)
+            except (ValueError, IndexError):
+                continue
+        return free
+
+
+class FakeProbe(GPUProbe):
+    """
+    Reports made-up GPUs, for tests. Set :py:attr:`free` to change the
+    reported free memory.
+
+    :param gpus: ``(name, total_memory, free_memory)`` of each fake device, memory in bytes
+    """
+
+    def __init__(self, gpus: Sequence[Tuple[str, int, int]] = ()):
+        self.gpus = [GPUInfo(i, name, total) for i, (name, total, _) in enumerate(gpus)]
+        self.free = {i: free for i, (_, _, free) in enumerate(gpus)}
+        self.calls = 0
+
+    def devices(self) -> List[GPUInfo]:
+        self.calls += 1
+        return list(self.gpus)
+
+    def free_memory(self) -> Dict[int, int]:
+        self.calls += 1
+        return dict(self.free)
+
+
+def default_probe() -> GPUProbe:
+    """
+    :return: the probe selected by ``CLAMS_GPU_PROBE``, or NVML if its
+             bindings are installed and work, or ``nvidia-smi`` otherwise
+    """
+    choice = os.environ.get('CLAMS_GPU_PROBE', '').lower()
+    if choice == 'none':
+        return FakeProbe()
+    if choice == 'nvidia-smi':
+        return NvidiaSmiProbe()
+    try:
+        return NVMLProbe()
+    except ImportError:
+        if choice == 'nvml':
+            raise
+    except Exception as e:
+        # bindings are installed, but there's no (working) driver
+        if choice == 'nvml':
+            raise
+        logger.debug(f"NVML is not available ({e}), falling back to nvidia-smi")
+    return NvidiaSmiProbe()
+
+
+class HardwareInventory(object):
+    """
+    Cached hardware inventory. Use :func:`get_inventory` to get the
+    inventory of the current host instead of instantiating this class.
+    """
+
+    def __init__(self, probe: GPUProbe):
+        self.probe = probe
+        self.cpu = f"{platform.machine()}, {multiprocessing.cpu_count()} cores"
+        #: total host memory (RAM) in bytes, 0 if unknown
+        self.memory = self._total_memory()
+        self.gpus: List[GPUInfo] = probe.devices()
+
+    @staticmethod
+    def _total_memory() -> int:
+        try:
+            return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError):
+            return 0
+
+    @property
+    def has_gpu(self) -> bool:
+        return len(self.gpus) > 0
+
+    def gpu(self, index: int) -> Optional[GPUInfo]:
+        """
+        :param index: device index
+        :return: static properties of the device, or None if there's no such device
+        """
+        return next((g for g in self.gpus if g.index == index), None)
+
+    def visible_gpus(self) -> List[GPUInfo]:
+        """
+        :return: GPUs visible to CUDA in this process, in the order of CUDA
+                 device ordinals (honors ``CUDA_VISIBLE_DEVICES`` given as
+                 device indices; other forms, e.g. UUIDs, are ignored)
+        """
+        visible = os.environ.get('CUDA_VISIBLE_DEVICES')
+        if visible is None:
+            return list(self.gpus)
+        try:
+            indices = [int(i) for i in visible.split(',') if i.strip()]
+        except ValueError:
+            return list(self.gpus)
+        gpus = []
+        for i in indices:
+            gpu = self.gpu(i)
+            if gpu is None:
+                # CUDA ignores the rest of the list after an invalid index
+                break
+            gpus.append(gpu)
+        return gpus
+
+    def cuda_index(self, ordinal: int = 0) -> Optional[int]:
+        """
+        :param ordinal: CUDA device ordinal in this process (as in ``cuda:<ordinal>``)
+        :return: index of the device in this inventory (as used by NVML and
+                 ``nvidia-smi``), or None if there's no such device
+        """
+        visible = self.visible_gpus()
+        return visible[ordinal].index if ordinal < len(visible) else None
+
+    def free_memory(self) -> Dict[int, int]:
+        """
+        Probes the currently free memory of all GPUs (GPU-wide, across all
+        processes). Does nothing on a host without GPUs.
+
+        :return: free memory in bytes by device index; empty if unavailable
+        """
+        if not self.gpus:
+            return {}
+        return self.probe.free_memory()
+
+
+_inventory: Optional[HardwareInventory] = None
+_inventory_lock = threading.Lock()
+
+
+def get_inventory() -> HardwareInventory:
+    """
+    :return: the hardware inventory of this host, detected on the first call
+    """
+    global _inventory
+    if _inventory is None:
+        with _inventory_lock:
+            if _inventory is None:
+                _inventory = HardwareInventory(default_probe())
+    return _inventory
+
+
+def set_probe(probe: GPUProbe) -> HardwareInventory:
+    """
+    Replaces the GPU probe (e.g. with a :class:`FakeProbe` in tests) and
+    detects the hardware again with it.
+
+    :param probe: the probe to use from now on
+    :return: the new hardware inventory
+    """
+    global _inventory
+    with _inventory_lock:
+        _inventory = HardwareInventory(probe)
+    return _inventory
@@ -0,0 +1,356 @@
+"""
+Asynchronous job queue for long-running ``annotate`` requests.
+
+Instead of holding an HTTP connection (and a web server worker slot) for
+the whole duration of an annotation, a client submits its input and gets a
+job id back right away. Submitted jobs are stored in a local directory and
+processed by worker threads running in every server process. Since all
+state lives on the local disk, any server process can accept submissions,
+run queued jobs, and answer status queries, and finished results survive
+client disconnects until the retention period expires.
+
+Files in the job directory, for a job ``<id>``:
+
+* ``<id>.json`` : the job record (status, timestamps, parameters, etc.)
+* ``<id>.input`` : the submitted input, while the job is waiting in the queue
+* ``<id>.running`` : the same input, renamed when a worker claims the job
+  (renaming is atomic, so only one worker can claim a job)
+* ``<id>.lock`` : locked (with ``flock``) by the worker process while it
+  runs the job, so that a job of a worker that died is told apart from a
+  running one, even when the pid of the worker has been reused
+* ``<id>.mmif`` : the output MMIF, once the job is finished
+"""
+import json
+import logging
+import os
+import pathlib
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional
+
+import jsonschema
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+from clams.admission import AdmissionRejected
+from clams.envelop import EnvelopeError
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+logger = logging.getLogger(__name__)
+
+
+def _write_atomic(path: pathlib.Path, content: bytes) -> None:
+    tmp = path.with_name(f'.{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+    tmp.write_bytes(content)
+    os.replace(tmp, path)
+
+
+def _hold_lock(path: pathlib.Path) -> Optional[int]:
+    """
+    Locks a file (creating it) for as long as the returned descriptor is
+    open. The lock is released by the OS when the process dies.
+    """
+    if fcntl is None:
+        return None
+    fd = os.open(path, os.O_RDWR | os.O_CREAT)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    return fd
+
+
+def _release_lock(path: pathlib.Path, fd: Optional[int]) -> None:
+    if fd is not None:
+        # removed while still locked, so that no one can see it unlocked before the job is recorded otherwise
+        path.unlink(missing_ok=True)
+        os.close(fd)
+
+
+def _lock_held(path: pathlib.Path) -> bool:
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return True
+    finally:
+        os.close(fd)
+    return False
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class JobQueue(object):
+    """
+    A disk-backed job queue that runs :meth:`~clams.app.ClamsApp.annotate`
+    in background worker threads.
+
+    :param app_instance: A :class:`~clams.app.ClamsApp` to run jobs with
+    :param job_dir: Directory to store job records, inputs and results. Must
+                    be shared by all server processes of the app.
+    :param workers: Number of worker threads per server process
+    :param retention: Seconds to keep records and results of finished jobs
+    :param poll_interval: Seconds between checks for jobs submitted to other
+                          server processes
+    """
+
+    def __init__(self, app_instance, job_dir: str, workers: int = 1, retention: float = 24 * 60 * 60,
+                 poll_interval: float = 1.0):
+        self.cla = app_instance
+        self.job_dir = pathlib.Path(job_dir)
+        self.job_dir.mkdir(parents=True, exist_ok=True)
+        self.workers = workers
+        self.retention = retention
+        self.poll_interval = poll_interval
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._started_pid: Optional[int] = None
+        self._threads: List[threading.Thread] = []
+        self._start_lock = threading.Lock()
+        self._last_sweep = 0.0
+
+    def _path(self, job_id: str, suffix: str) -> pathlib.Path:
+        return self.job_dir / f'{job_id}.{suffix}'
+
+    def start(self) -> None:
+        """
+        Starts worker threads in the current process. Calling this more than
+        once in the same process does nothing, so it is safe to call on every
+        request. Threads do not survive ``fork()``, so this must be called
+        after the server process is forked.
+        """
+        if self._started_pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._started_pid == os.getpid():
+                return
+            self._stop.clear()
+            self._threads = [threading.Thread(target=self._work, name=f'clams-job-worker-{i}', daemon=True)
+                             for i in range(self.workers)]
+            for t in self._threads:
+                t.start()
+            self._started_pid = os.getpid()
+
+    def stop(self) -> None:
+        """
+        Stops worker threads in the current process, waiting for them to
+        finish their current job.
+        """
+        self._stop.set()
+        self._wakeup.set()
+        if self._started_pid == os.getpid():
+            for t in self._threads:
+                t.join()
+        self._threads = []
+        self._started_pid = None
+
+    def submit(self, data: bytes, parameters: Dict[str, List[str]]) -> dict:
+        """
+        Stores a new job in the queue.
+
+        :param data: raw input (MMIF or envelope)
+        :param parameters: runtime parameters, as passed to :meth:`~clams.app.ClamsApp.annotate`
+        :return: the job record
+        """
+        job_id = uuid.uuid4().hex
+        record = {'id': job_id, 'status': QUEUED, 'submitted': time.time(), 'parameters': parameters}
+        # the record must exist before the input, so that no worker can claim a job without a record
+        self._write_record(record)
+        _write_atomic(self._path(job_id, 'input'), data)
+        self._wakeup.set()
+        return record
+
+    def get(self, job_id: str) -> Optional[dict]:
+        """
+        Looks up a job record. A job recorded as running in a process that
+        no longer exists is reported as failed.
+
+        :param job_id: the job id
+        :return: the job record, or None if no such job exists
+        """
+        record = self._read_record(job_id)
+        if record is not None and record['status'] == RUNNING and not self._is_running(record):
+            # the job may have just finished, and released its lock
+            record = self._read_record(job_id)
+            if record is not None and record['status'] == RUNNING:
+                record.update(status=FAILED, error='The job was interrupted, the process running it no longer exists.')
+        return record
+
+    def _is_running(self, record: dict) -> bool:
+        if fcntl is None:
+            return _pid_alive(record.get('pid', 0))
+        return _lock_held(self._path(record['id'], 'lock'))
+
+    def result_path(self, job_id: str) -> Optional[pathlib.Path]:
+        """
+        :param job_id: the job id
+        :return: the path to the output MMIF of a finished job, or None if there's no output
+        """
+        path = self._path(job_id, 'mmif')
+        return path if path.exists() else None
+
+    def delete(self, job_id: str) -> bool:
+        """
+        Deletes all files of a job that is not running.
+
+        :param job_id: the job id
+        :return: True if the job was found and deleted
+        """
+        record = self.get(job_id)
+        if record is None or record['status'] == RUNNING:
+            return False
+        for suffix in ('input', 'running', 'lock', 'mmif', 'json'):
+            self._path(job_id, suffix).unlink(missing_ok=True)
+        return True
+
+    def _read_record(self, job_id: str) -> Optional[dict]:
+        # job ids are hex strings, anything else can't be a valid file name in the job dir
+        if not job_id or not all(c in '0123456789abcdef' for c in job_id):
+            return None
+        try:
+            return json.loads(self._path(job_id, 'json').read_bytes())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write_record(self, record: dict) -> None:
+        _write_atomic(self._path(record['id'], 'json'), json.dumps(record).encode('utf-8'))
+
+    def _claim_next(self) -> Optional[str]:
+        queued = []
+        for p in self.job_dir.glob('*.input'):
+            try:
+                queued.append((p.stat().st_mtime, p))
+            except FileNotFoundError:
+                continue
+        for _, p in sorted(queued):
+            try:
+                p.rename(p.with_suffix('.running'))
+            except FileNotFoundError:
+                continue  # claimed by another worker
+            return p.stem
+        return None
+
+    def _work(self) -> None:
+        while not self._stop.is_set():
+            # no error can end the worker, it would never run another job of this process
+            try:
+                job_id = self._claim_next()
+                if job_id is not None:
+                    try:
+                        self._run(job_id)
+                    except Exception as e:
+                        logger.exception(f"Job worker failed to run job {job_id}")
+                        self._fail(job_id, e)
+                    continue
+                self._sweep_if_due()
+            except Exception:
+                logger.exception(f"Job worker failed to scan {self.job_dir}")
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+    def _fail(self, job_id: str, error: Exception) -> None:
+        try:
+            self._path(job_id, 'running').unlink(missing_ok=True)
+            record = self._read_record(job_id)
+            # a job already recorded as finished keeps its outcome
+            if record is not None and record['status'] in (QUEUED, RUNNING):
+                record.update(status=FAILED, error=f'{type(error).__name__}: {error}', finished=time.time())
+                self._write_record(record)
+        except Exception:
+            logger.exception(f"Failed to record the failure of job {job_id}")
+
+    def _run(self, job_id: str) -> None:
+        record = self._read_record(job_id)
+        running_path = self._path(job_id, 'running')
+        if record is None:
+            running_path.unlink(missing_ok=True)
+            return
+        # locked before the job is recorded as running, and released after it is recorded otherwise
+        lock_path = self._path(job_id, 'lock')
+        lock_fd = _hold_lock(lock_path)
+        try:
+            record.update(status=RUNNING, started=time.time(), pid=os.getpid())
+            self._write_record(record)
+            data = running_path.read_bytes()
+            params = record['parameters']
+            result_path = self._path(job_id, 'mmif')
+            tmp_path = result_path.with_suffix('.mmif.tmp')
+            try:
+                with open(tmp_path, 'w') as out_f:
+                    for chunk in self.cla.annotate_stream(data, **params):
+                        out_f.write(chunk)
+                os.replace(tmp_path, result_path)
+                record['status'] = SUCCEEDED
+            except AdmissionRejected as e:
+                # not enough memory at the moment, put the job back in the queue
+                self.cla.logger.info(f"Requeueing job {job_id}: {e}")
+                record.update(status=QUEUED, started=None, pid=None)
+                self._write_record(record)
+                # released before another worker can claim the job again
+                _release_lock(lock_path, lock_fd)
+                lock_fd = None
+                running_path.rename(self._path(job_id, 'input'))
+                self._stop.wait(e.retry_after)
+                return
+            except (jsonschema.exceptions.ValidationError, json.JSONDecodeError, EnvelopeError) as e:
+                detail = e.message if isinstance(e, jsonschema.exceptions.ValidationError) else str(e)
+                record.update(status=FAILED,
+                              error=f'Invalid input data. See below for validation error.\n\n{detail}')
+            except Exception as e:
+                self.cla.logger.exception(f"Error in annotation (job {job_id})")
+                record.update(status=FAILED, error=f'{type(e).__name__}: {e}')
+                try:
+                    _write_atomic(result_path,
+                                  self.cla.record_error(data, **params).serialize(pretty=True).encode('utf-8'))
+                except Exception:
+                    # the error is recorded in the job record all the same
+                    self.cla.logger.exception(f"Failed to make the error view of job {job_id}")
+            finally:
+                tmp_path.unlink(missing_ok=True)
+                if record['status'] != QUEUED:
+                    running_path.unlink(missing_ok=True)
+                    record['finished'] = time.time()
+                    self._write_record(record)
+        finally:
+            _release_lock(lock_path, lock_fd)
+
+    def _sweep_if_due(self) -> None:
+        now = time.time()
+        if now - self._last_sweep >= min(60.0, self.retention):
+            self._last_sweep = now
+            self.sweep()
+
+    def sweep(self) -> int:
+        """
+        Deletes finished (or interrupted) jobs older than the retention period.
+
+        :return: number of jobs deleted
+        """
+        deleted = 0
+        cutoff = time.time() - self.retention
+        for p in self.job_dir.glob('*.json'):
+            record = self.get(p.stem)
+            if record is None or record['status'] in (QUEUED, RUNNING):
+                continue
+            if record.get('finished', record.get('started', record['submitted'])) <= cutoff:
+                if self.delete(p.stem):
+                    deleted += 1
+        if deleted:
+            logger.info(f"Deleted {deleted} expired job(s) from {self.job_dir}")
+        return deleted
@@ -0,0 +1,274 @@
+"""
+Runtime metrics of a CLAMS app server, in Prometheus text exposition
+format.
+
+Web server workers are separate processes, so every process keeps its own
+values in memory and writes them to a file (``<pid>.json``) in a metrics
+directory shared by all processes of the server, when asked to (e.g. at the
+end of every request) and at most every ``flush_interval`` seconds when
+values changed. When metrics are collected, files of all processes are
+merged:
+
+* counters and histograms are summed over all processes, including the ones
+  that exited (e.g. recycled workers); files of exited processes are folded
+  into an archive file (``archive.json``) so that the directory doesn't
+  grow with every recycled worker
+* ``livesum`` gauges (e.g. in-flight requests) are summed over live
+  processes only
+* ``latest`` gauges (e.g. the last recorded CUDA peak memory) take the most
+  recently set value among all processes
+"""
+import dataclasses
+import json
+import os
+import pathlib
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+#: Default upper bounds (in seconds) of histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+COUNTER = 'counter'
+HISTOGRAM = 'histogram'
+LIVESUM = 'livesum'
+LATEST = 'latest'
+
+_ARCHIVE = 'archive'
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _label_key(labels: Dict[str, str]) -> str:
+    return json.dumps(sorted(labels.items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels: List[Tuple[str, str]]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(str(v))}"' for k, v in labels) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+@dataclasses.dataclass
+class _Histogram(object):
+    buckets: List[int]
+    sum: float = 0.0
+    count: int = 0
+
+
+class Metrics(object):
+    """
+    A registry of metrics shared by all processes of a server through a
+    metrics directory. Create it in the main process, before workers are
+    forked; a forked process starts with its own, empty values.
+
+    :param metrics_dir: directory to store per-process values
+    :param flush_interval: seconds between writes of changed values by a
+        background thread, ``0`` to write only on :meth:`flush`
+    """
+
+    def __init__(self, metrics_dir: str, flush_interval: float = 1.0):
+        self.metrics_dir = pathlib.Path(metrics_dir)
+        self.metrics_dir.mkdir(parents=True, exist_ok=True)
+        self.flush_interval = flush_interval
+        self._specs: Dict[str, Tuple[str, str, Tuple[float, ...]]] = {}
+        # guards values, never held while writing files
+        self._lock = threading.Lock()
+        # serializes writes, so that an older snapshot never overwrites a newer one
+        self._write_lock = threading.Lock()
+        self._pid: Optional[int] = None
+        self._dirty = False
+        # counters and livesum gauges hold [value], latest gauges hold [value, time]
+        self._scalars: Dict[str, Dict[str, List[float]]] = {}
+        self._histograms: Dict[str, Dict[str, _Histogram]] = {}
+
+    def register(self, name: str, kind: str, description: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        """
+        Declares a metric.
+
+        :param name: metric name
+        :param kind: one of ``counter``, ``histogram``, ``livesum`` and ``latest`` (the latter two are gauges)
+        :param description: help text
+        :param buckets: upper bounds of histogram buckets (histograms only)
+        """
+        self._specs[name] = (kind, description, tuple(buckets))
+
+    def _local(self) -> None:
+        # values are per process, start over after fork
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._scalars = {}
+            self._histograms = {}
+            self._dirty = False
+            if self.flush_interval > 0:
+                threading.Thread(target=self._flush_periodically, args=(self._pid,),
+                                 name='clams-metrics-flush', daemon=True).start()
+
+    def inc(self, name: str, amount: float = 1, **labels: str) -> None:
+        """
+        Increases a counter, or a ``livesum`` gauge (use a negative amount to decrease).
+        """
+        with self._lock:
+            self._local()
+            series = self._scalars.setdefault(name, {}).setdefault(_label_key(labels), [0])
+            series[0] += amount
+            self._dirty = True
+
+    def set(self, name: str, value: float, **labels: str) -> None:
+        """
+        Sets a gauge. For counters, sets the total count of this process
+        (for values counted elsewhere, e.g. cache hits).
+        """
+        with self._lock:
+            self._local()
+            self._scalars.setdefault(name, {})[_label_key(labels)] = [value, time.time()]
+            self._dirty = True
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        """
+        Adds an observation to a histogram.
+        """
+        buckets = self._specs[name][2]
+        with self._lock:
+            self._local()
+            histogram = self._histograms.setdefault(name, {}).setdefault(
+                _label_key(labels), _Histogram([0] * len(buckets)))
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram.buckets[i] += 1
+            histogram.sum += value
+            histogram.count += 1
+            self._dirty = True
+
+    def flush(self) -> None:
+        """
+        Writes the values of this process to the metrics directory, if they
+        changed since the last write.
+        """
+        with self._write_lock:
+            with self._lock:
+                if not self._dirty or self._pid != os.getpid():
+                    return
+                snapshot: Dict[str, Dict[str, list]] = {name: {key: list(value) for key, value in series.items()}
+                                                         for name, series in self._scalars.items()}
+                for name, series in self._histograms.items():
+                    snapshot[name] = {key: [list(h.buckets), h.sum, h.count] for key, h in series.items()}
+                self._dirty = False
+            path = self.metrics_dir / f'{os.getpid()}.json'
+            tmp = path.with_name(f'.{path.name}.tmp')
+            tmp.write_text(json.dumps(snapshot))
+            os.replace(tmp, path)
+
+    def _flush_periodically(self, pid: int) -> None:
+        while self._pid == pid:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except OSError:
+                # e.g. the directory was removed at exit
+                return
+
+    def _merge(self, into: Dict[str, Dict[str, list]], values: Dict[str, Dict[str, list]], live: bool) -> None:
+        for name, series in values.items():
+            if name not in self._specs:
+                continue
+            kind = self._specs[name][0]
+            merged = into.setdefault(name, {})
+            for key, value in series.items():
+                if kind == LIVESUM and not live:
+                    continue
+                if key not in merged:
+                    merged[key] = json.loads(json.dumps(value))
+                elif kind == HISTOGRAM:
+                    merged[key][0] = [a + b for a, b in zip(merged[key][0], value[0])]
+                    merged[key][1] += value[1]
+                    merged[key][2] += value[2]
+                elif kind == LATEST:
+                    if value[1] >= merged[key][1]:
+                        merged[key] = value
+                else:
+                    merged[key][0] += value[0]
+
+    def collect(self) -> Dict[str, Dict[str, list]]:
+        """
+        Merges values of all processes. Files of processes that no longer
+        exist are folded into the archive.
+
+        :return: merged values, keyed by metric name and then by labels
+        """
+        self.flush()
+        with open(self.metrics_dir / '.lock', 'w') as lock:
+            # without flock, concurrent collections may archive a file of an exited process twice
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            archive_path = self.metrics_dir / f'{_ARCHIVE}.json'
+            try:
+                archive = json.loads(archive_path.read_text())
+            except (FileNotFoundError, ValueError):
+                archive = {}
+            merged: Dict[str, Dict[str, list]] = {}
+            archived = False
+            for p in self.metrics_dir.glob('*.json'):
+                if p.stem == _ARCHIVE:
+                    continue
+                try:
+                    pid = int(p.stem)
+                    values = json.loads(p.read_text())
+                except (ValueError, FileNotFoundError):
+                    continue
+                if pid == os.getpid() or _pid_alive(pid):
+                    self._merge(merged, values, live=True)
+                else:
+                    self._merge(archive, values, live=False)
+                    p.unlink(missing_ok=True)
+                    archived = True
+            if archived:
+                tmp = archive_path.with_name(f'.{archive_path.name}.tmp')
+                tmp.write_text(json.dumps(archive))
+                os.replace(tmp, archive_path)
+            self._merge(merged, archive, live=False)
+        return merged
+
+    def exposition(self) -> str:
+        """
+        :return: merged values of all processes in Prometheus text exposition format
+        """
+        merged = self.collect()
+        lines = []
+        for name, (kind, description, buckets) in self._specs.items():
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f"# TYPE {name} {kind if kind in (COUNTER, HISTOGRAM) else 'gauge'}")
+            for key, value in sorted(merged.get(name, {}).items()):
+                labels = [tuple(pair) for pair in json.loads(key)]
+                if kind == HISTOGRAM:
+                    for bound, count in zip(buckets + (float('inf'),), value[0] + [value[2]]):
+                        lines.append(f'{name}_bucket{_format_labels(labels + [("le", _format_value(bound))])} '
+                                     f'{count}')
+                    lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(value[1])}')
+                    lines.append(f'{name}_count{_format_labels(labels)} {value[2]}')
+                else:
+                    lines.append(f'{name}{_format_labels(labels)} {_format_value(value[0])}')
+        return '\n'.join(lines) + '\n'
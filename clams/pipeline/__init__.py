@@ -0,0 +1,108 @@
+"""
+In-process pipelines of CLAMS apps.
+
+Chaining apps with :meth:`~clams.app.ClamsApp.annotate` serializes the
+output of every app to a JSON string, which the next app parses (and
+validates) again. A :class:`Pipeline` instead hands one live
+:class:`~mmif.serialize.mmif.Mmif` object from app to app, so the input is
+decoded once and the output is serialized (and validated) once, after the
+last app.
+"""
+import time
+from typing import Callable, Dict, Iterable, List, Tuple, Union
+
+from mmif import Mmif
+
+from clams.app import ClamsApp
+from clams.envelop import load_input
+
+Stage = Union[ClamsApp, Tuple[ClamsApp, Dict[str, List[str]]]]
+
+
+class Pipeline(object):
+    """
+    Runs a sequence of :class:`~clams.app.ClamsApp` instances over one MMIF
+    in the current process. Each app runs with all SDK-level runtime
+    features as in :meth:`~clams.app.ClamsApp.annotate` (parameter
+    refinement, warning views, profiling records), except the output cache.
+
+    Runtime parameters given to :meth:`run` or :meth:`annotate` go to all
+    apps, so they are meant for universal parameters (e.g. ``pretty`` or
+    ``hwFetch``); parameters for a single app are given with the app, and
+    take priority over the shared ones.
+
+    :param stages: apps to run, in order, each one an app instance or a
+        tuple of an app instance and its runtime parameters
+    """
+
+    def __init__(self, stages: Iterable[Stage]) -> None:
+        self.stages: List[Tuple[ClamsApp, Dict[str, List[str]]]] = []
+        for stage in stages:
+            app, params = stage if isinstance(stage, tuple) else (stage, {})
+            if not isinstance(app, ClamsApp):
+                raise TypeError(f"A pipeline stage must be a ClamsApp, got {type(app).__name__}")
+            self.stages.append((app, dict(params)))
+        if not self.stages:
+            raise ValueError("A pipeline needs at least one app")
+        #: Names of the stages, the app identifiers, numbered when an app appears more than once
+        self.names: List[str] = []
+        for app, _ in self.stages:
+            name = str(app.metadata.identifier)
+            count = sum(1 for n in self.names if n == name or n.startswith(f'{name}#'))
+            self.names.append(name if count == 0 else f'{name}#{count + 1}')
+        #: Callables to receive durations (in seconds) of ``decode``, every stage (by its name in
+        #: :py:attr:`names`) and ``serialize`` of every run, e.g. for monitoring. The phases within
+        #: each stage are reported to ``phase_timing_hooks`` of the app.
+        self.timing_hooks: List[Callable[[Dict[str, float]], None]] = []
+
+    def run(self, mmif: Union[bytes, str, dict, Mmif], **runtime_params: List[str]) -> Mmif:
+        """
+        Runs all apps over the input.
+
+        :param mmif: An input MMIF object, or a JSON envelope, to annotate.
+            A :class:`~mmif.serialize.mmif.Mmif` object is annotated in place.
+        :param runtime_params: runtime parameters for all apps
+        :return: the output of the last app, not validated until it is serialized
+        """
+        annotated, _, timings = self._run(mmif, runtime_params)
+        self._report_timings(timings)
+        return annotated
+
+    def annotate(self, mmif: Union[bytes, str, dict, Mmif], **runtime_params: List[str]) -> str:
+        """
+        Runs all apps over the input and serializes the output, as
+        :meth:`~clams.app.ClamsApp.annotate` of a single app does.
+
+        :param mmif: An input MMIF object, or a JSON envelope, to annotate
+        :param runtime_params: runtime parameters for all apps
+        :return: Serialized JSON string of the output of the last app
+        """
+        annotated, refined, timings = self._run(mmif, runtime_params)
+        t = time.perf_counter()
+        output = annotated.serialize(pretty=refined.get('pretty', False), sanitize=True)
+        timings['serialize'] = time.perf_counter() - t
+        self._report_timings(timings)
+        return output
+
+    def _run(self, mmif: Union[bytes, str, dict, Mmif],
+             runtime_params: Dict[str, List[str]]) -> Tuple[Mmif, dict, Dict[str, float]]:
+        timings = {}
+        t = time.perf_counter()
+        if not isinstance(mmif, Mmif):
+            mmif, runtime_params = load_input(mmif, runtime_params)
+            mmif = Mmif(mmif)
+        timings['decode'] = time.perf_counter() - t
+        refined = {}
+        for name, (app, params) in zip(self.names, self.stages):
+            t = time.perf_counter()
+            mmif, refined, app_timings = app._run_annotate(mmif, **{**runtime_params, **params})
+            app._report_timings(app_timings)
+            timings[name] = time.perf_counter() - t
+        return mmif, refined, timings
+
+    def _report_timings(self, timings: Dict[str, float]) -> None:
+        for hook in self.timing_hooks:
+            try:
+                hook(timings)
+            except Exception:
+                self.stages[0][0].logger.exception("Error in a pipeline timing hook")
@@ -0,0 +1,478 @@
+"""
+Local store of resource profiles of app runs.
+
+Every recorded app run adds a sample to the profile store of the app,
+keyed by the hash of its runtime parameters (see
+:func:`mmif.utils.workflow_helper.generate_param_hash`). A sample holds
+peak VRAM, peak resident memory (RSS), CPU time, wall time and input size
+of the run; any of them can be missing. :class:`HostUsageMeter` measures
+peak RSS and CPU time of a run. The store answers distribution queries
+(median, 95th percentile, maximum) per parameter hash, so that scheduling
+decisions don't hinge on a single outlier.
+
+Samples are stored in a SQLite database in WAL mode, so all server
+processes of an app can record to and read from the same store
+concurrently. Only the most recent samples of each parameter hash are
+kept. Apps record samples of their runs with
+:meth:`ProfileStore.record_async`, which buffers them and writes them in
+batches from a background thread, off the request path. Likewise, apps
+read the distributions they need per request with
+:meth:`ProfileStore.cached_stats`, which answers from memory and is
+refreshed by the same background thread.
+
+This module also provides the ``profiles`` subcommand of the ``clams`` CLI
+to inspect, export and import profile stores.
+"""
+import argparse
+import atexit
+import json
+import logging
+import math
+import os
+import pathlib
+import sqlite3
+import sys
+import threading
+import time
+from typing import Dict, IO, Iterator, List, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+#: Measurements of a sample
+METRICS = ('vram_peak', 'rss_peak', 'cpu_time', 'wall_time', 'input_size')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+    id INTEGER PRIMARY KEY,
+    param_hash TEXT NOT NULL,
+    recorded REAL NOT NULL,
+    vram_peak INTEGER,
+    rss_peak INTEGER,
+    cpu_time REAL,
+    wall_time REAL,
+    input_size INTEGER
+);
+CREATE INDEX IF NOT EXISTS samples_param_hash ON samples (param_hash, id);
+CREATE TABLE IF NOT EXISTS parameters (
+    param_hash TEXT PRIMARY KEY,
+    parameters TEXT NOT NULL
+);
+"""
+
+
+def profile_store_path(app_identifier: str) -> pathlib.Path:
+    """
+    :param app_identifier: app identifier (from the app metadata)
+    :return: the default location of the profile store of the app, under the user's cache directory
+    """
+    app_id = str(app_identifier).replace('/', '-').replace(':', '-')
+    cache_base = pathlib.Path(os.environ.get('XDG_CACHE_HOME', pathlib.Path.home() / '.cache'))
+    return cache_base / 'clams' / 'profiles' / f'{app_id}.sqlite3'
+
+
+def current_rss() -> int:
+    """
+    :return: resident memory of the current process in bytes. Falls back to
+             the peak resident memory where ``/proc`` is not available (e.g. macOS).
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return _max_rss()
+
+
+def _max_rss() -> int:
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KB elsewhere
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _reset_peak_rss() -> bool:
+    # resets VmHWM of the process, Linux only
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss() -> Optional[int]:
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+# number of HostUsageMeter blocks running in this process
+_active_meters = 0
+_active_meters_lock = threading.Lock()
+
+
+class HostUsageMeter(object):
+    """
+    Context manager to measure peak resident memory (RSS) and CPU time of
+    the current process over a block of code. Both are process-wide, so
+    they include other threads running at the same time (e.g. concurrent
+    requests of a threaded server worker).
+
+    On Linux, a meter that has the process to itself resets the peak RSS
+    of the process on entry, so its peak is precise. Resetting would spoil
+    the peaks of other meters running at the same time, so a meter that
+    starts while another one runs doesn't reset, and its peak (the peak
+    since the last reset) is only an upper bound. Elsewhere, the peak is the
+    process lifetime peak if the block raised it, or the RSS at the end of
+    the block otherwise.
+    """
+
+    def __init__(self):
+        self.rss_peak: Optional[int] = None
+        self.cpu_time: Optional[float] = None
+        self._reset = False
+        self._max_rss_before = 0
+        self._cpu_before = 0.0
+
+    def __enter__(self) -> 'HostUsageMeter':
+        global _active_meters
+        with _active_meters_lock:
+            exclusive = _active_meters == 0
+            _active_meters += 1
+        self._reset = exclusive and _reset_peak_rss()
+        if not self._reset:
+            self._max_rss_before = _max_rss()
+        self._cpu_before = time.process_time()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        global _active_meters
+        with _active_meters_lock:
+            _active_meters -= 1
+        self.cpu_time = time.process_time() - self._cpu_before
+        peak = _peak_rss()
+        if peak is None:
+            max_rss = _max_rss()
+            peak = max_rss if max_rss > self._max_rss_before else current_rss()
+        self.rss_peak = peak
+
+
+def _check_measurements(measurements: Dict[str, Optional[float]]) -> None:
+    unknown = set(measurements) - set(METRICS)
+    if unknown:
+        raise ValueError(f"Unknown measurements: {', '.join(sorted(unknown))}")
+
+
+def _percentile(values: List[float], q: float) -> float:
+    # nearest-rank method, values must be sorted
+    return values[max(0, math.ceil(q * len(values)) - 1)]
+
+
+class ProfileStore(object):
+    """
+    A SQLite-backed store of resource profile samples. Safe to use from
+    multiple threads and processes; every thread (and forked process)
+    opens its own connection.
+
+    :param path: path to the database file, created if missing
+    :param max_samples: number of most recent samples kept per parameter hash
+    :param write_delay: seconds :meth:`record_async` waits to gather samples into a batch
+    """
+
+    def __init__(self, path: Union[str, pathlib.Path], max_samples: int = 1000, write_delay: float = 1.0):
+        self.path = pathlib.Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_samples = max_samples
+        self.write_delay = write_delay
+        self._local = threading.local()
+        # samples buffered by record_async(), of the process that buffered them
+        self._pending: List[tuple] = []
+        self._pending_pid: Optional[int] = None
+        self._pending_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        # answers of cached_stats(), by (param_hash, metric)
+        self._cached_stats: Dict[tuple, Optional[Dict[str, float]]] = {}
+        self._cached_stats_lock = threading.Lock()
+        with self._connect() as conn:
+            conn.executescript(_SCHEMA)
+            # stores created by older versions miss newer measurements
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(samples)")}
+            for metric in METRICS:
+                if metric not in columns:
+                    conn.execute(f"ALTER TABLE samples ADD COLUMN {metric} "
+                                 f"{'REAL' if metric.endswith('time') else 'INTEGER'}")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            # connections must not be shared with forked processes
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def record(self, param_hash: str, parameters: Optional[dict] = None, recorded: Optional[float] = None,
+               **measurements: Optional[float]) -> None:
+        """
+        Adds a sample.
+
+        :param param_hash: hash of the runtime parameters of the run
+        :param parameters: the runtime parameters, kept for human readability
+        :param recorded: timestamp of the sample, defaults to now
+        :param measurements: any of ``vram_peak`` (bytes), ``rss_peak`` (bytes), ``cpu_time`` (seconds),
+                             ``wall_time`` (seconds) and ``input_size`` (bytes)
+        """
+        _check_measurements(measurements)
+        with self._connect() as conn:
+            self._insert(conn, param_hash, parameters, recorded or time.time(), measurements)
+        with self._cached_stats_lock:
+            self._cached_stats.clear()
+
+    def record_async(self, param_hash: str, parameters: Optional[dict] = None,
+                     **measurements: Optional[float]) -> None:
+        """
+        Adds a sample without waiting for the disk. Samples are buffered and
+        written in batches by a background thread, at most
+        :py:attr:`write_delay` seconds later (and at exit). Queries see the
+        samples once they are written (or after :meth:`flush`).
+
+        :param param_hash: hash of the runtime parameters of the run
+        :param parameters: the runtime parameters, kept for human readability
+        :param measurements: see :meth:`record`
+        """
+        _check_measurements(measurements)
+        with self._pending_lock:
+            if self._pending_pid != os.getpid():
+                # a forked process starts with an empty buffer and its own writer
+                self._pending = []
+                self._pending_pid = os.getpid()
+                self._wakeup = threading.Event()
+                threading.Thread(target=self._write_pending, args=(self._wakeup,),
+                                 name='clams-profile-writer', daemon=True).start()
+                atexit.register(self.flush)
+            self._pending.append((param_hash, parameters, time.time(), measurements))
+            self._wakeup.set()
+
+    def _write_pending(self, wakeup: threading.Event) -> None:
+        while True:
+            wakeup.wait()
+            time.sleep(self.write_delay)
+            wakeup.clear()
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Writes samples buffered by :meth:`record_async` now.
+        """
+        with self._flush_lock:
+            with self._pending_lock:
+                if self._pending_pid != os.getpid():
+                    return
+                pending, self._pending = self._pending, []
+            if not pending:
+                return
+            try:
+                with self._connect() as conn:
+                    for param_hash, parameters, recorded, measurements in pending:
+                        self._insert(conn, param_hash, parameters, recorded, measurements)
+            except (sqlite3.Error, OSError) as e:
+                logger.warning(f"Failed to write {len(pending)} resource profile sample(s): {e}")
+                return
+        self._refresh_cached_stats()
+
+    def _insert(self, conn: sqlite3.Connection, param_hash: str, parameters: Optional[dict], recorded: float,
+                measurements: Dict[str, Optional[float]]) -> None:
+        conn.execute(f"INSERT INTO samples (param_hash, recorded, {', '.join(METRICS)}) "
+                     f"VALUES (?, ?, {', '.join('?' * len(METRICS))})",
+                     (param_hash, recorded, *(measurements.get(m) for m in METRICS)))
+        if parameters is not None:
+            conn.execute("INSERT OR REPLACE INTO parameters VALUES (?, ?)",
+                         (param_hash, json.dumps(parameters, sort_keys=True, default=str)))
+        conn.execute("DELETE FROM samples WHERE param_hash = ? AND id <= "
+                     "(SELECT id FROM samples WHERE param_hash = ? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                     (param_hash, param_hash, self.max_samples))
+
+    def stats(self, param_hash: Optional[str], metric: str) -> Optional[Dict[str, float]]:
+        """
+        :param param_hash: hash of runtime parameters, or None for all samples of the store
+        :param metric: one of :data:`METRICS`
+        :return: ``count``, ``p50``, ``p95`` and ``max`` of the metric, or None if there's no sample with it
+        """
+        if metric not in METRICS:
+            raise ValueError(f"Unknown metric: {metric}")
+        query = f"SELECT {metric} FROM samples WHERE {metric} IS NOT NULL"
+        args = ()
+        if param_hash is not None:
+            query += " AND param_hash = ?"
+            args = (param_hash,)
+        values = sorted(row[0] for row in self._connect().execute(query, args))
+        if not values:
+            return None
+        return {'count': len(values), 'p50': _percentile(values, 0.5), 'p95': _percentile(values, 0.95),
+                'max': values[-1]}
+
+    def cached_stats(self, param_hash: Optional[str], metric: str) -> Optional[Dict[str, float]]:
+        """
+        Same as :meth:`stats`, but answered from memory, so that it can be
+        used on the request path. Only the first query of a parameter hash
+        and metric reads the store (again after :meth:`record`). The answers
+        are refreshed every time samples buffered by :meth:`record_async` are
+        written, which also picks up samples written by other processes in
+        the meantime.
+
+        :param param_hash: hash of runtime parameters, or None for all samples of the store
+        :param metric: one of :data:`METRICS`
+        :return: see :meth:`stats`
+        """
+        key = (param_hash, metric)
+        with self._cached_stats_lock:
+            if key in self._cached_stats:
+                return self._cached_stats[key]
+        answer = self.stats(param_hash, metric)
+        with self._cached_stats_lock:
+            self._cached_stats[key] = answer
+        return answer
+
+    def _refresh_cached_stats(self) -> None:
+        with self._cached_stats_lock:
+            keys = list(self._cached_stats)
+        try:
+            answers = {key: self.stats(*key) for key in keys}
+        except (sqlite3.Error, OSError) as e:
+            logger.warning(f"Failed to read resource profiles: {e}")
+            return
+        with self._cached_stats_lock:
+            self._cached_stats.update(answers)
+
+    def param_hashes(self) -> Dict[str, Optional[dict]]:
+        """
+        :return: all parameter hashes with samples, with their runtime parameters (if recorded)
+        """
+        self.flush()
+        rows = self._connect().execute(
+            "SELECT DISTINCT s.param_hash, p.parameters FROM samples s "
+            "LEFT JOIN parameters p ON s.param_hash = p.param_hash")
+        return {h: json.loads(params) if params else None for h, params in rows}
+
+    def samples(self) -> Iterator[dict]:
+        """
+        :return: all samples, oldest first, with their runtime parameters (if recorded)
+        """
+        self.flush()
+        rows = self._connect().execute(
+            f"SELECT s.param_hash, s.recorded, {', '.join('s.' + m for m in METRICS)}, p.parameters "
+            f"FROM samples s LEFT JOIN parameters p ON s.param_hash = p.param_hash ORDER BY s.id")
+        for param_hash, recorded, *values, params in rows:
+            sample = {'param_hash': param_hash, 'recorded': recorded, **dict(zip(METRICS, values))}
+            if params:
+                sample['parameters'] = json.loads(params)
+            yield sample
+
+    def export_samples(self, out: IO[str]) -> int:
+        """
+        Writes all samples as JSON lines.
+
+        :param out: a text stream to write to
+        :return: number of exported samples
+        """
+        count = 0
+        for sample in self.samples():
+            out.write(json.dumps(sample) + '\n')
+            count += 1
+        return count
+
+    def import_samples(self, lines: IO[str]) -> int:
+        """
+        Adds samples from JSON lines written by :meth:`export_samples`.
+
+        :param lines: a text stream to read from
+        :return: number of imported samples
+        """
+        count = 0
+        for line in lines:
+            if not line.strip():
+                continue
+            sample = json.loads(line)
+            self.record(sample['param_hash'], sample.get('parameters'), sample.get('recorded'),
+                        **{m: sample.get(m) for m in METRICS})
+            count += 1
+        return count
+
+    def clear(self) -> None:
+        """
+        Deletes all samples.
+        """
+        with self._pending_lock:
+            self._pending = []
+        with self._connect() as conn:
+            conn.execute("DELETE FROM samples")
+            conn.execute("DELETE FROM parameters")
+        with self._cached_stats_lock:
+            self._cached_stats.clear()
+
+
+def describe_argparser():
+    """
+    :returns: tuple of (one-line help, detailed description)
+    """
+    oneliner = 'inspect, export or import resource profiles of an app'
+    detailed = (
+        'Resource profiles (peak VRAM, peak RSS, CPU time, wall time and input size '
+        'of past runs, by runtime parameters) are recorded by CLAMS apps '
+        'in a local store. "show" prints their distributions, "export" '
+        'writes all samples as JSON lines to stdout, and "import" adds '
+        'samples from JSON lines (e.g. exported on another machine) read '
+        'from stdin.'
+    )
+    return oneliner, detailed
+
+
+def prep_argparser(**kwargs):
+    """
+    :returns: argparse.ArgumentParser for the profiles subcommand
+    """
+    parser = argparse.ArgumentParser(
+        description=describe_argparser()[1],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        **kwargs,
+    )
+    parser.add_argument(
+        'ACTION',
+        choices=['show', 'export', 'import'],
+        help='What to do with the profile store.',
+    )
+    parser.add_argument(
+        'APP',
+        help='Identifier of the app (as in its metadata), or path to a profile store file.',
+    )
+    return parser
+
+
+def main(args):
+    """
+    CLI entry point.
+    """
+    path = pathlib.Path(args.APP)
+    if not path.is_file():
+        path = profile_store_path(args.APP)
+        if args.ACTION != 'import' and not path.is_file():
+            print(f'Error: no profile store found at {path}', file=sys.stderr)
+            sys.exit(1)
+    store = ProfileStore(path)
+    if args.ACTION == 'export':
+        store.export_samples(sys.stdout)
+    elif args.ACTION == 'import':
+        print(f'Imported {store.import_samples(sys.stdin)} sample(s) into {path}', file=sys.stderr)
+    else:
+        summary = {}
+        for param_hash, parameters in store.param_hashes().items():
+            summary[param_hash] = {'parameters': parameters,
+                                   **{m: store.stats(param_hash, m) for m in METRICS}}
+        print(json.dumps(summary, indent=2))
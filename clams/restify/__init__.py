@@ -1,11 +1,29 @@
+import atexit
+import functools
 import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from contextlib import ExitStack
+from typing import Callable, Dict, List, Optional, Tuple
 
 import jsonschema
-from flask import Flask, request, Response
+from flask import Flask, current_app, request, Response, send_file
 from flask_restful import Resource, Api
 
+from clams.admission import AdmissionRejected, ConcurrencyLimit, TooManyRequests
 from clams.app import ClamsApp
+from clams.compression import (CompressionError, DecompressedTooLarge, UnsupportedEncoding, compress,
+                               compress_chunks, decompressed_size_limit, negotiate, read_decompressed)
 from clams.envelop import EnvelopeError
+from clams.hardware import get_inventory
+from clams.jobs import JobQueue, QUEUED, RUNNING, SUCCEEDED
+from clams.metrics import Metrics, COUNTER, HISTOGRAM, LIVESUM, LATEST
+from clams.profiles import current_rss
 
 
 class Restifier(object):
@@ -20,8 +38,37 @@ class Restifier(object):
     :param loopback: when True, the flask wrapper only listens to requests from localhost (used for debugging).
     :param port: Port number for the flask app to listen (used for debugging).
     :param debug: When True, the flask wrapper will run in `debug mode <https://flask.palletsprojects.com/en/1.1.x/quickstart/#debug-mode>`_.
+    :param streaming: When True, output MMIF of POST/PUT requests is sent in chunks (chunked transfer encoding)
+                      as it is serialized, instead of a single fully materialized body. See
+                      :meth:`~clams.app.ClamsApp.annotate_stream`.
+    :param job_dir: When set, the app runs in job mode: POST/PUT requests are queued as asynchronous jobs
+                    (see :class:`~clams.jobs.JobQueue`) and answered with ``202 Accepted`` and a job id, and
+                    status and output of a job are available at ``GET /jobs/<id>``. Jobs, inputs and outputs are
+                    stored in this directory. Can also be set with ``CLAMS_JOB_DIR`` environment variable.
+    :param job_workers: Number of job worker threads per server process (job mode only).
+    :param job_retention: Seconds to keep finished jobs and their outputs (job mode only).
+    :param metrics_dir: Directory where server processes share their runtime metrics, served at ``GET /metrics``
+                        in Prometheus text format. Can also be set with ``CLAMS_METRICS_DIR`` environment
+                        variable. By default, a temporary directory is used (and removed at exit).
+    :param max_in_flight: When set, at most this many POST/PUT requests are processed at the same time in a server
+                          process (see :class:`~clams.admission.ConcurrencyLimit`); others wait in a queue of
+                          ``max_queue`` requests, for at most ``queue_timeout`` seconds, and requests that find the
+                          queue full are answered with ``429 Too Many Requests`` and a ``Retry-After`` header. Can
+                          also be set with ``CLAMS_MAX_IN_FLIGHT``, ``CLAMS_REQUEST_QUEUE_SIZE`` and
+                          ``CLAMS_REQUEST_QUEUE_TIMEOUT`` environment variables. Not applied to job submissions.
+    :param max_queue: Number of requests waiting for processing per server process (with ``max_in_flight``).
+    :param queue_timeout: Seconds a request waits for processing (with ``max_in_flight``).
+    :param max_decompressed_mb: Size limit (in megabytes) of a compressed request body once decompressed; larger
+                                ones are answered with ``413 Content Too Large``. Can also be set with
+                                ``CLAMS_MAX_DECOMPRESSED_MB`` environment variable. Defaults to ``MAX_CONTENT_LENGTH``
+                                of the flask app if set, or 1024 MB otherwise (see
+                                :func:`~clams.compression.decompressed_size_limit`).
     """
-    def __init__(self, app_instance: ClamsApp, loopback: bool = False, port: int = 5000, debug: bool = True) -> None:
+    def __init__(self, app_instance: ClamsApp, loopback: bool = False, port: int = 5000, debug: bool = True,
+                 streaming: bool = False, job_dir: Optional[str] = None, job_workers: int = 1,
+                 job_retention: float = 24 * 60 * 60, metrics_dir: Optional[str] = None,
+                 max_in_flight: Optional[int] = None, max_queue: Optional[int] = None,
+                 queue_timeout: Optional[float] = None, max_decompressed_mb: Optional[float] = None) -> None:
         super().__init__()
         self.cla = app_instance
         self.import_name = app_instance.__class__.__name__
@@ -29,9 +76,28 @@ class Restifier(object):
         self.host = 'localhost' if loopback else '0.0.0.0'
         self.port = port
         self.debug = debug
+        job_dir = job_dir or os.environ.get('CLAMS_JOB_DIR')
+        self.jobs = JobQueue(self.cla, job_dir, job_workers, job_retention) if job_dir else None
+        self.metrics, observe_phases = _server_metrics(metrics_dir or os.environ.get('CLAMS_METRICS_DIR'))
+        # the same app may be wrapped more than once (e.g. in tests), but its phases are counted once per metrics
+        if observe_phases not in self.cla.phase_timing_hooks:
+            self.cla.phase_timing_hooks.append(observe_phases)
+        max_in_flight = max_in_flight or int(os.environ.get('CLAMS_MAX_IN_FLIGHT', 0))
+        self.concurrency_limit = ConcurrencyLimit(
+            max_in_flight,
+            max_queue if max_queue is not None else int(os.environ.get('CLAMS_REQUEST_QUEUE_SIZE', 8)),
+            queue_timeout if queue_timeout is not None else float(os.environ.get('CLAMS_REQUEST_QUEUE_TIMEOUT', 60))
+        ) if max_in_flight else None
         api = Api(self.flask_app)
         api.add_resource(ClamsHTTPApi, '/',
-                         resource_class_args=[self.cla])
+                         resource_class_args=[self.cla],
+                         resource_class_kwargs={'streaming': streaming, 'jobs': self.jobs,
+                                                'metrics': self.metrics, 'limit': self.concurrency_limit,
+                                                'max_decompressed_mb': max_decompressed_mb})
+        api.add_resource(ClamsMetricsApi, '/metrics', resource_class_args=[self.metrics])
+        if self.jobs is not None:
+            api.add_resource(ClamsJobsApi, '/jobs/<string:job_id>',
+                             resource_class_args=[self.jobs])
     
     def run(self, **options):
         """
@@ -45,62 +111,98 @@ class Restifier(object):
         """
         Runs the CLAMS app as a flask webapp, using a production-ready web server (gunicorn, https://docs.gunicorn.org/en/stable/#).
 
+        By default, a worker process is recycled after every request (``max_requests=1``) to free GPU memory.
+        Instead, workers can be kept alive and retired only when their memory use passes a watermark, checked
+        after each request:
+
+        * ``recycle_rss_mb`` (or ``CLAMS_RECYCLE_RSS_MB`` environment variable): resident memory of the worker
+        * ``recycle_vram_mb`` (or ``CLAMS_RECYCLE_VRAM_MB`` environment variable): CUDA memory reserved by
+          torch in the worker (summed over devices)
+
+        When a watermark is set, ``max_requests`` defaults to 0 (no request limit); pass ``max_requests`` (or
+        set ``CLAMS_MAX_REQUESTS``) to also retire workers after that many requests.
+
+        Every worker calls :meth:`~clams.app.ClamsApp.warm_up` before it starts accepting requests, so a worker
+        that replaces a recycled one loads its model in the background, while already warm workers take the
+        incoming requests. To keep such warm workers at hand, ``spare_workers`` (or ``CLAMS_SPARE_WORKERS``)
+        adds that many workers on top of the CPU-based number (see :meth:`recommend_workers`), or on top of
+        ``workers`` when it is set explicitly. Spare workers are not a standby pool: gunicorn has no standby
+        mode, so they are ordinary workers that serve requests and are recycled like the others. Within the
+        calculated number they are capped by the RAM- and VRAM-based limits, as every worker holds its own copy
+        of the model.
+
+        When the app declares GPU memory use and more than one GPU is visible, every worker is pinned to one GPU
+        (by ``CUDA_VISIBLE_DEVICES``), chosen by the ``gpu_placement`` strategy (or ``CLAMS_GPU_PLACEMENT``):
+        ``round-robin`` (default), ``free-memory`` or ``none``. The replacement of a recycled worker takes the
+        GPU its predecessor left, so placement stays balanced.
+
+        The number of workers is calculated by :meth:`recommend_workers`. ``autosize=True`` (or
+        ``CLAMS_GUNICORN_WORKERS=auto``) bases the calculation on the memory use the app has recorded in earlier
+        runs, with a safety margin of ``autosize_margin`` (or ``CLAMS_AUTOSIZE_MARGIN``, default 0.2). With
+        ``dry_run=True``, the number of workers and how it was derived are printed, and the server is not started.
+
         :param options: any additional options to pass to the web server.
         """
         import gunicorn.app.base
-        import multiprocessing
-        import os
+
+        # detect hardware once, forked workers inherit the inventory
+        get_inventory()
+        rss_mb = options.pop('recycle_rss_mb', os.environ.get('CLAMS_RECYCLE_RSS_MB'))
+        vram_mb = options.pop('recycle_vram_mb', os.environ.get('CLAMS_RECYCLE_VRAM_MB'))
+        recycle_policy = _MemoryWatermark(self.cla.logger,
+                                          float(rss_mb) if rss_mb else None,
+                                          float(vram_mb) if vram_mb else None)
+        if 'max_requests' not in options and 'CLAMS_MAX_REQUESTS' in os.environ:
+            options['max_requests'] = int(os.environ['CLAMS_MAX_REQUESTS'])
+        spare_workers = int(options.pop('spare_workers', os.environ.get('CLAMS_SPARE_WORKERS', 0)))
+        if spare_workers and 'workers' in options:
+            options['workers'] += spare_workers
+        autosize = options.pop('autosize', os.environ.get('CLAMS_GUNICORN_WORKERS') == 'auto')
+        autosize_margin = float(options.pop('autosize_margin', os.environ.get('CLAMS_AUTOSIZE_MARGIN', 0.2)))
+        if options.pop('dry_run', False):
+            workers, reasoning = (options['workers'], ['workers set explicitly']) if 'workers' in options \
+                else self.recommend_workers(spare_workers, autosize, autosize_margin)
+            print('\n'.join(reasoning + [f"Recommended number of workers: {workers}"]))
+            return
+
+        placement = None
+        strategy = options.pop('gpu_placement', os.environ.get('CLAMS_GPU_PLACEMENT', 'round-robin'))
+        if strategy != 'none':
+            capacity, _ = self._vram_capacity(autosize, autosize_margin)
+            if len(capacity) > 1:
+                placement = _GPUPlacement(self.cla.logger, capacity, strategy)
 
         def number_of_workers():
-            # Allow override via environment variable
-            if 'CLAMS_GUNICORN_WORKERS' in os.environ:
-                return int(os.environ['CLAMS_GUNICORN_WORKERS'])
-
-            cpu_workers = (multiprocessing.cpu_count() * 2) + 1
-
-            # Get GPU memory requirement from app metadata
-            # Use est_gpu_mem_typ (typical usage) for worker calculation
-            try:
-                metadata = self.cla.metadata
-                gpu_mem_mb = metadata.est_gpu_mem_typ  # typical usage determines how many workers fit
-            except Exception:
-                gpu_mem_mb = 0
-
-            if gpu_mem_mb <= 0:
-                return cpu_workers
-
-            # Calculate workers based on total VRAM of the first CUDA device (no other GPUs are considered for now)
-            # Use nvidia-smi instead of torch to avoid initializing CUDA in parent process before fork
-            try:
-                import subprocess
-                import shutil
-                if shutil.which('nvidia-smi'):
-                    result = subprocess.run(
-                        ['nvidia-smi', '--query-gpu=memory.total', '--format=csv,noheader,nounits', '-i', '0'],
-                        capture_output=True, text=True, timeout=5
-                    )
-                    if result.returncode == 0 and result.stdout.strip():
-                        total_vram_mb = float(result.stdout.strip())
-                        vram_workers = max(1, int(total_vram_mb // gpu_mem_mb))
-                        workers = min(vram_workers, cpu_workers)
-                        self.cla.logger.info(
-                            f"GPU detected: {total_vram_mb:.0f} MB VRAM, "
-                            f"app requires {gpu_mem_mb} MB, "
-                            f"using {workers} workers (max {vram_workers} by VRAM, {cpu_workers} by CPU)"
-                        )
-                        return workers
-            except Exception:
-                pass
-
-            return cpu_workers
+            workers, reasoning = self.recommend_workers(spare_workers, autosize, autosize_margin)
+            for line in reasoning:
+                self.cla.logger.info(line)
+            return workers
+
+        def number_of_threads():
+            # concurrent requests can only share batched generate() calls
+            # (see ClamsPromptableApp.enable_micro_batching) when a worker has enough threads
+            threads = max(2, getattr(self.cla, 'max_batch_size', 1))
+            limit = self.concurrency_limit
+            if limit is not None:
+                # queued requests hold a thread too, and one more is needed to refuse requests quickly
+                threads = max(threads, limit.max_in_flight + limit.max_queue + 1)
+            return threads
         
+        def post_worker_init(worker):
+            # runs in the forked worker, before it accepts any request
+            started = time.perf_counter()
+            self.cla.warm_up()
+            self.cla.logger.info(f"Worker (pid: {worker.pid}) warmed up in {time.perf_counter() - started:.1f} s")
+            if jobs is not None:
+                jobs.start()
+
         class ProductionApplication(gunicorn.app.base.BaseApplication):
 
             def __init__(self, app, host, port, **options):
                 self.options = {
                     'bind': f'{host}:{port}',
                     'workers': number_of_workers(),
-                    'threads': 2,
+                    'threads': number_of_threads(),
                     # disable timeout for long-running GPU workloads (default 30s is too short)
                     'timeout': 0,
                     # because the default is 'None'
@@ -112,6 +214,17 @@ class Restifier(object):
                     # developers can override via serve_production(max_requests=N) for single-model apps
                     'max_requests': 1,
                 }
+                if recycle_policy.enabled:
+                    # workers persist until they hit a memory watermark
+                    self.options['max_requests'] = 0
+                    self.options['post_request'] = recycle_policy
+                self.options['post_worker_init'] = post_worker_init
+                if placement is not None:
+                    self.options['pre_fork'] = placement.pre_fork
+                    self.options['post_fork'] = placement.post_fork
+                if jobs is not None:
+                    # job worker threads live in the gunicorn workers, so workers must persist
+                    self.options['max_requests'] = 0
                 self.options.update(options)
                 self.application = app
                 super().__init__()
@@ -125,15 +238,113 @@ class Restifier(object):
             def load(self):
                 return self.application
 
+        jobs = self.jobs
         # Log max_requests setting
-        max_req = options.get('max_requests', 1)  # default is 1, meaning workers are killed after each request
-        if max_req == 0:
+        # default is 1 (meaning workers are killed after each request), or 0 in job mode or with memory watermarks
+        max_req = options.get('max_requests', 1 if jobs is None and not recycle_policy.enabled else 0)
+        if spare_workers and 'workers' in options:
+            # otherwise, the number of spares kept is logged with the calculation of the number of workers
+            self.cla.logger.info(f"Added {spare_workers} spare worker(s) to the number of workers set explicitly")
+        if placement is not None:
+            self.cla.logger.info(f"GPU placement: {placement}")
+        if recycle_policy.enabled:
+            self.cla.logger.info(f"Worker recycling: {recycle_policy}"
+                                 + (f", or after {max_req} request(s)" if max_req else ""))
+        elif max_req == 0:
             self.cla.logger.info("Worker recycling: disabled (workers persist)")
         else:
             self.cla.logger.info(f"Worker recycling: after {max_req} request(s)")
 
         ProductionApplication(self.flask_app, self.host, self.port, **options).run()
 
+    def recommend_workers(self, spare_workers: int = 0, autosize: bool = False,
+                          margin: float = 0.2) -> Tuple[int, List[str]]:
+        """
+        Calculates the number of production server workers. The number is the
+        minimum of
+
+        * CPU-based: ``(cores x 2) + 1``
+        * RAM-based: total host memory divided by the peak memory of an app
+          process (recorded in earlier runs, see :mod:`clams.profiles`, or
+          ``est_host_mem_typ`` in the app metadata)
+        * VRAM-based: the sum, over all GPUs visible to the server, of the
+          number of workers that fit into the memory of each GPU according to
+          ``est_gpu_mem_typ`` in the app metadata
+
+        where ``spare_workers`` are added to the CPU-based number only, so
+        they are capped by the memory-based numbers: a spare worker is an
+        ordinary worker that serves requests, is recycled like the others,
+        and needs the same memory (it is not a standby pool). The reasoning
+        tells how many of the spare workers are kept. In autosizing mode,
+        the VRAM-based number also uses the recorded peak VRAM (falling back
+        to ``est_gpu_mem_typ``), and memory estimates are inflated by the
+        safety ``margin``. ``CLAMS_GUNICORN_WORKERS`` overrides the
+        calculation (spare workers are added to it).
+
+        :param spare_workers: number of workers to add, memory permitting (see :meth:`serve_production`)
+        :param autosize: whether to use recorded resource profiles for all memory estimates
+        :param margin: safety margin in autosizing mode, as a fraction of the memory estimates
+        :return: number of workers, and human-readable lines explaining how it was derived
+        """
+        override = os.environ.get('CLAMS_GUNICORN_WORKERS', 'auto')
+        if override != 'auto':
+            return int(override) + spare_workers, [f"CLAMS_GUNICORN_WORKERS={override}, "
+                                                   f"plus {spare_workers} spare worker(s)"]
+        inventory = get_inventory()
+        cores = multiprocessing.cpu_count()
+        limits = {'CPU': cores * 2 + 1 + spare_workers}
+        reasoning = [f"CPU: {cores} cores, (cores x 2) + 1 + {spare_workers} spare = {limits['CPU']} workers"]
+        factor = 1 + margin if autosize else 1
+        mib = 1024 * 1024
+
+        host_mem, source = self.cla._estimate_process_memory('rss_peak')
+        if host_mem > 0 and inventory.memory > 0:
+            limits['RAM'] = max(1, int(inventory.memory // (host_mem * factor)))
+            reasoning.append(f"RAM: {inventory.memory / mib:.0f} MB total / {host_mem / mib:.0f} MB per worker "
+                             f"({source}){f' x {factor:g} margin' if autosize else ''} = {limits['RAM']} workers")
+        else:
+            reasoning.append("RAM: peak memory of the app is unknown, not limiting")
+
+        capacity, explanation = self._vram_capacity(autosize, margin)
+        if capacity:
+            limits['VRAM'] = max(1, sum(capacity.values()))
+            reasoning.append(f"{explanation} = {limits['VRAM']} workers")
+        elif explanation:
+            reasoning.append(explanation)
+        bound = min(limits, key=limits.get)
+        if spare_workers:
+            kept = max(0, limits[bound] - min(cores * 2 + 1, *limits.values()))
+            reasoning.append(f"Spare workers: {kept} of {spare_workers} kept"
+                             + (f", capped by {bound}" if kept < spare_workers else ""))
+        reasoning.append(f"Using {limits[bound]} workers, limited by {bound}"
+                         + (" (autosizing)" if autosize else ""))
+        return limits[bound], reasoning
+
+    def _vram_capacity(self, autosize: bool = False, margin: float = 0.2) -> Tuple[Dict[int, int], str]:
+        """
+        :return: number of workers that fit on each GPU visible to the server, by device index (empty if the
+                 app doesn't use GPU or there's no GPU), and how it was derived
+        """
+        gpus = get_inventory().visible_gpus()
+        if not gpus:
+            return {}, ''
+        mib = 1024 * 1024
+        if autosize:
+            gpu_mem, source = self.cla._estimate_process_memory('vram_peak')
+        else:
+            gpu_mem, source = self.cla.metadata.est_gpu_mem_typ * mib, 'est_gpu_mem_typ in app metadata'
+        if gpu_mem <= 0:
+            return {}, "VRAM: the app declares no GPU memory use, not limiting"
+        factor = 1 + margin if autosize else 1
+        capacity = {gpu.index: int(gpu.total_memory // (gpu_mem * factor)) for gpu in gpus}
+        devices = ' + '.join(f"{gpu.total_memory / mib:.0f}" for gpu in gpus)
+        names = ', '.join(sorted({gpu.name for gpu in gpus}))
+        explanation = (f"VRAM: {devices} MB total on {names} / {gpu_mem / mib:.0f} MB per worker ({source})"
+                       f"{f' x {factor:g} margin' if autosize else ''}")
+        if len(gpus) > 1:
+            explanation += ' = ' + ' + '.join(str(capacity[gpu.index]) for gpu in gpus)
+        return capacity, explanation
+
     def serve_development(self, **options):
         """
         Runs the CLAMS app as a flask webapp, using flask built-in development server (https://werkzeug.palletsprojects.com/en/2.0.x/).
@@ -152,15 +363,215 @@ class Restifier(object):
         return self.flask_app.test_client()
 
 
+def _cuda_reserved_mb() -> float:
+    """
+    CUDA memory reserved by torch's caching allocator in the current
+    process, in MB, summed over devices. 0 when the app does not use torch
+    or CUDA was never initialized (torch is never imported here).
+    """
+    torch = sys.modules.get('torch')
+    if torch is None or not torch.cuda.is_initialized():
+        return 0.0
+    return sum(torch.cuda.memory_reserved(d) for d in range(torch.cuda.device_count())) / (1024 * 1024)
+
+
+class _MemoryWatermark(object):
+    """
+    Gunicorn ``post_request`` hook that retires a worker once its memory use
+    passes a watermark. The worker finishes the current request and exits
+    gracefully (the same way gunicorn retires workers after ``max_requests``),
+    and the gunicorn arbiter spawns a replacement.
+    """
+
+    def __init__(self, logger, rss_mb: Optional[float] = None, vram_mb: Optional[float] = None):
+        self.logger = logger
+        self.rss_mb = rss_mb
+        self.vram_mb = vram_mb
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.rss_mb or self.vram_mb)
+
+    def __str__(self):
+        marks = []
+        if self.rss_mb:
+            marks.append(f"RSS > {self.rss_mb:.0f} MB")
+        if self.vram_mb:
+            marks.append(f"CUDA reserved > {self.vram_mb:.0f} MB")
+        return 'when ' + ' or '.join(marks)
+
+    def __call__(self, worker, req, environ, resp) -> None:
+        if not worker.alive:
+            return
+        reason = None
+        if self.rss_mb:
+            rss = current_rss() / (1024 * 1024)
+            if rss > self.rss_mb:
+                reason = f"RSS {rss:.0f} MB exceeds watermark {self.rss_mb:.0f} MB"
+        if reason is None and self.vram_mb:
+            vram = _cuda_reserved_mb()
+            if vram > self.vram_mb:
+                reason = f"CUDA reserved memory {vram:.0f} MB exceeds watermark {self.vram_mb:.0f} MB"
+        if reason is not None:
+            self.logger.warning(f"Recycling worker (pid: {worker.pid}) after {worker.nr} request(s): {reason}")
+            worker.alive = False
+
+
+class _GPUPlacement(object):
+    """
+    Gunicorn ``pre_fork`` and ``post_fork`` hooks that pin every worker to a
+    single GPU, by setting ``CUDA_VISIBLE_DEVICES`` in the forked worker
+    before the app initializes CUDA. The device is chosen in the gunicorn
+    arbiter, right before forking, among devices that have room for more
+    workers (or among all devices, when none has):
+
+    * ``round-robin``: the device with the fewest live workers, relative to
+      the number of workers it can hold
+    * ``free-memory``: the device with the most free memory per live worker
+
+    Only live workers count, so the replacement of a recycled (or crashed)
+    worker takes the slot its predecessor left behind.
+
+    :param capacity: number of workers each device can hold, by device index
+    :param strategy: ``round-robin`` or ``free-memory``
+    """
+    strategies = ('round-robin', 'free-memory')
+
+    def __init__(self, logger, capacity: Dict[int, int], strategy: str = 'round-robin'):
+        if strategy not in self.strategies:
+            raise ValueError(f"Unknown GPU placement strategy: {strategy} (expected one of {self.strategies})")
+        self.logger = logger
+        self.capacity = capacity
+        self.strategy = strategy
+
+    def __str__(self):
+        return f"{self.strategy} over GPUs {', '.join(str(i) for i in self.capacity)}"
+
+    def choose(self, assigned: Dict[int, int]) -> int:
+        """
+        :param assigned: number of live workers on each device
+        :return: index of the device for a new worker
+        """
+        if self.strategy == 'free-memory':
+            free = get_inventory().free_memory()
+            return min(self.capacity, key=lambda i: (assigned[i] >= self.capacity[i],
+                                                     -free.get(i, 0) / (assigned[i] + 1), i))
+        return min(self.capacity, key=lambda i: (assigned[i] >= self.capacity[i],
+                                                 assigned[i] / max(1, self.capacity[i]), i))
+
+    def pre_fork(self, server, worker) -> None:
+        # runs in the arbiter, the chosen device is inherited by the forked worker
+        assigned = {i: 0 for i in self.capacity}
+        for live in server.WORKERS.values():
+            device = getattr(live, 'clams_gpu', None)
+            if device in assigned:
+                assigned[device] += 1
+        worker.clams_gpu = self.choose(assigned)
+
+    def post_fork(self, server, worker) -> None:
+        os.environ['CUDA_VISIBLE_DEVICES'] = str(worker.clams_gpu)
+        self.logger.info(f"Worker (pid: {worker.pid}) placed on GPU {worker.clams_gpu}")
+
+
+def _when_sent(res: Response, callback: Callable[[], None]) -> None:
+    """
+    Calls back when the response body is made: right away, or for a streamed
+    response, when the server closes it after sending (or failing to send) it.
+    """
+    if res.is_streamed:
+        res.call_on_close(callback)
+    else:
+        callback()
+
+
+# metrics (and their phase timing hooks) by directory, shared by all Restifiers of the process
+_server_metrics_by_dir: Dict[str, Tuple[Metrics, Callable[[Dict[str, float]], None]]] = {}
+_server_metrics_lock = threading.Lock()
+_default_metrics_dir: Optional[str] = None
+
+
+def _server_metrics(metrics_dir: Optional[str]) -> Tuple[Metrics, Callable[[Dict[str, float]], None]]:
+    global _default_metrics_dir
+    with _server_metrics_lock:
+        if metrics_dir is None:
+            if _default_metrics_dir is None:
+                _default_metrics_dir = tempfile.mkdtemp(prefix='clams-metrics-')
+                owner = os.getpid()
+                # forked workers run atexit handlers too, only the creating process may remove the directory
+                atexit.register(lambda d=_default_metrics_dir: os.getpid() == owner and
+                                shutil.rmtree(d, ignore_errors=True))
+            metrics_dir = _default_metrics_dir
+        key = os.path.abspath(metrics_dir)
+        if key not in _server_metrics_by_dir:
+            _server_metrics_by_dir[key] = _new_server_metrics(key)
+        return _server_metrics_by_dir[key]
+
+
+def _new_server_metrics(metrics_dir: str) -> Tuple[Metrics, Callable[[Dict[str, float]], None]]:
+    metrics = Metrics(metrics_dir)
+    metrics.register('clams_requests_total', COUNTER, 'Number of handled HTTP requests.')
+    metrics.register('clams_request_duration_seconds', HISTOGRAM, 'Time to handle a HTTP request.')
+    metrics.register('clams_phase_duration_seconds', HISTOGRAM,
+                     'Time spent in each phase of annotate (decode, refine, annotate, warnings, serialize).')
+    metrics.register('clams_requests_in_flight', LIVESUM, 'Number of HTTP requests being handled.')
+    metrics.register('clams_error_views_total', COUNTER, 'Number of annotation errors returned as error views.')
+    metrics.register('clams_admission_rejections_total', COUNTER,
+                     'Number of requests rejected (503) for lack of available memory.')
+    metrics.register('clams_requests_queued', LIVESUM, 'Number of HTTP requests waiting for a free request slot.')
+    metrics.register('clams_request_queue_wait_seconds', HISTOGRAM, 'Time a HTTP request waited for a request slot.')
+    metrics.register('clams_requests_shed_total', COUNTER,
+                     'Number of requests refused (429) because too many were running and waiting.')
+    metrics.register('clams_output_cache_hits_total', COUNTER, 'Number of output cache hits.')
+    metrics.register('clams_output_cache_misses_total', COUNTER, 'Number of output cache misses.')
+    metrics.register('clams_loaded_models', LIVESUM, 'Number of models loaded in model caches of live workers.')
+    metrics.register('clams_cuda_peak_memory_bytes', LATEST, 'Peak CUDA memory of the last measured annotation.')
+
+    def observe_phases(timings: Dict[str, float]) -> None:
+        for phase, seconds in timings.items():
+            metrics.observe('clams_phase_duration_seconds', seconds, phase=phase)
+    return metrics, observe_phases
+
+
+class ClamsMetricsApi(Resource):
+    """
+    Serves runtime metrics of all server processes in Prometheus text
+    exposition format (see :mod:`clams.metrics`).
+
+    Constructor takes an instance of :class:`~clams.metrics.Metrics`.
+    """
+    def __init__(self, metrics: Metrics):
+        super().__init__()
+        self.metrics = metrics
+
+    def get(self) -> Response:
+        return Response(response=self.metrics.exposition(), status=200,
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 class ClamsHTTPApi(Resource):
     """
     ClamsHTTPApi provides mapping from HTTP verbs to Python API defined in :class:`.ClamsApp`.
 
     Constructor takes an instance of :class:`.ClamsApp`.
+
+    :param cla_instance: A :class:`.ClamsApp` to wrap.
+    :param streaming: When True, output MMIF is streamed in chunks.
+    :param jobs: When given, POST/PUT requests are submitted to this job queue instead of being processed
+                 synchronously.
+    :param metrics: When given, request metrics are recorded here.
+    :param limit: When given, POST/PUT requests are processed within this concurrency limit, and refused with
+                  ``429`` when its queue is full.
     """
-    def __init__(self, cla_instance: ClamsApp):
+    def __init__(self, cla_instance: ClamsApp, streaming: bool = False, jobs: Optional[JobQueue] = None,
+                 metrics: Optional[Metrics] = None, limit: Optional[ConcurrencyLimit] = None,
+                 max_decompressed_mb: Optional[float] = None):
         super().__init__()
         self.cla = cla_instance
+        self.streaming = streaming
+        self.jobs = jobs
+        self.metrics = metrics
+        self.limit = limit
+        self.max_decompressed_mb = max_decompressed_mb
 
     @staticmethod
     def json_to_response(json_str: str, status=200) -> Response:
@@ -178,24 +589,139 @@ class ClamsHTTPApi(Resource):
     def get(self) -> Response:
         """
         Maps HTTP GET verb to :meth:`~clams.app.ClamsApp.appmetadata`.
+        The response carries an ``ETag`` header, and a request with a
+        matching ``If-None-Match`` header gets a ``304 Not Modified``
+        response without a body.
 
         :return: Returns app metadata in a HTTP response.
         """
         # this will catch duplicate arguments with different values into a list under the key
         raw_params = request.args.to_dict(flat=False)
-        return self.json_to_response(self.cla.appmetadata(**raw_params))
+        body, etag = self.cla.appmetadata_with_etag(**raw_params)
+        res = Response(response=body, status=200, mimetype='application/json')
+        res.set_etag(etag)
+        # clients may cache, but must revalidate every time
+        res.cache_control.no_cache = True
+        return res.make_conditional(request)
 
     def post(self) -> Response:
         """
         Maps HTTP POST verb to :meth:`~clams.app.ClamsApp.annotate`.
         Note that for now HTTP PUT verbs is also mapped to :meth:`~clams.app.ClamsApp.annotate`.
+        A request body can be compressed (``Content-Encoding`` of ``gzip``
+        or ``zstd``), and the response body is compressed in the best
+        encoding listed in ``Accept-Encoding`` (see :mod:`clams.compression`).
 
         :return: Returns MMIF output from a ClamsApp in a HTTP response.
         """
-        raw_data = request.get_data().decode('utf-8')
+        if self.metrics is None:
+            return self._compress_response(self._limited_post())
+        started = time.perf_counter()
+        self.metrics.inc('clams_requests_in_flight')
+        method = request.method
+
+        def finished(status: int) -> None:
+            self.metrics.inc('clams_requests_in_flight', -1)
+            self.metrics.inc('clams_requests_total', method=method, status=str(status))
+            self.metrics.observe('clams_request_duration_seconds', time.perf_counter() - started, method=method)
+            self._record_app_state()
+            # values are written once per request, not on every update
+            self.metrics.flush()
+        try:
+            res = self._limited_post()
+        except BaseException:
+            finished(500)
+            raise
+        # a streamed request is still in flight until its body is sent
+        _when_sent(res, functools.partial(finished, res.status_code))
+        return self._compress_response(res)
+
+    def _record_app_state(self):
+        cache = self.cla.output_cache
+        if cache is not None:
+            self.metrics.set('clams_output_cache_hits_total', cache.hits)
+            self.metrics.set('clams_output_cache_misses_total', cache.misses)
+        model_cache = getattr(self.cla, '_model_cache', None)
+        if model_cache is not None:
+            self.metrics.set('clams_loaded_models', len(model_cache))
+        if self.cla.last_cuda_peak_bytes:
+            self.metrics.set('clams_cuda_peak_memory_bytes', self.cla.last_cuda_peak_bytes)
+
+    @staticmethod
+    def _compress_response(res: Response) -> Response:
+        res.vary.add('Accept-Encoding')
+        encoding = negotiate(request.headers.get('Accept-Encoding'))
+        if encoding is None:
+            return res
+        if res.is_streamed:
+            # compressed chunk by chunk while being sent
+            res.response = compress_chunks(res.response, encoding)
+        else:
+            res.set_data(compress(res.get_data(), encoding))
+        res.headers['Content-Encoding'] = encoding
+        return res
+
+    @staticmethod
+    def _invalid_input(detail: str) -> Response:
+        return Response(
+            response="Invalid input data. "
+                     "See below for validation error.\n\n"
+                     + detail,
+            status=500, mimetype='text/plain')
+
+    def _limited_post(self) -> Response:
+        if self.limit is None or self.jobs is not None:
+            return self._post()
+        metrics = self.metrics
+        slot = ExitStack()
+        try:
+            waited = slot.enter_context(self.limit.admit(
+                on_queue=None if metrics is None else lambda delta: metrics.inc('clams_requests_queued', delta)))
+        except TooManyRequests as e:
+            self.cla.logger.warning(f"Refused a request: {e}")
+            if metrics is not None:
+                metrics.inc('clams_requests_shed_total')
+            res = Response(response=f"Too many requests: {e}", status=429, mimetype='text/plain')
+            res.headers['Retry-After'] = str(e.retry_after)
+            return res
+        try:
+            if metrics is not None:
+                metrics.observe('clams_request_queue_wait_seconds', waited)
+            res = self._post()
+        except BaseException:
+            slot.close()
+            raise
+        # a streamed body is serialized while being sent, so the slot is held until then
+        _when_sent(res, slot.close)
+        return res
+
+    def _post(self) -> Response:
+        # raw bytes (decompressed, if sent compressed) are handed over as-is; the app decodes them only once
+        content_encoding = request.headers.get('Content-Encoding')
+        try:
+            raw_data = read_decompressed(
+                request.stream, content_encoding,
+                decompressed_size_limit(self.max_decompressed_mb, current_app.config.get('MAX_CONTENT_LENGTH'))
+            ) if content_encoding else request.get_data()
+        except UnsupportedEncoding as e:
+            return Response(response=str(e), status=415, mimetype='text/plain')
+        except DecompressedTooLarge as e:
+            return Response(response=str(e), status=413, mimetype='text/plain')
+        except CompressionError as e:
+            return self._invalid_input(str(e))
         # this will catch duplicate arguments with different values into a list under the key
         raw_params = request.args.to_dict(flat=False)
+        if self.jobs is not None:
+            self.jobs.start()
+            record = self.jobs.submit(raw_data, raw_params)
+            res = Response(response=json.dumps(record), status=202, mimetype='application/json')
+            res.headers['Location'] = f"{request.script_root}/jobs/{record['id']}"
+            return res
         try:
+            if self.streaming:
+                # no content length is set, so the body is sent with chunked transfer encoding
+                return Response(response=self.cla.annotate_stream(raw_data, **raw_params),
+                                status=200, mimetype='application/json')
             return self.json_to_response(
                 self.cla.annotate(raw_data, **raw_params))
         except (jsonschema.exceptions.ValidationError,
@@ -203,17 +729,21 @@ class ClamsHTTPApi(Resource):
             # jsonschema's str(e) dumps the entire MMIF schema; use its
             # concise .message instead so envelope and MMIF input
             # errors share the same compact payload format.
-            detail = (
+            return self._invalid_input(
                 e.message
                 if isinstance(e, jsonschema.exceptions.ValidationError)
                 else str(e))
-            return Response(
-                response="Invalid input data. "
-                         "See below for validation error.\n\n"
-                         + detail,
-                status=500, mimetype='text/plain')
+        except AdmissionRejected as e:
+            self.cla.logger.warning(f"Rejected a request: {e}")
+            if self.metrics is not None:
+                self.metrics.inc('clams_admission_rejections_total')
+            res = Response(response=f"Service unavailable: {e}", status=503, mimetype='text/plain')
+            res.headers['Retry-After'] = str(e.retry_after)
+            return res
         except Exception:
             self.cla.logger.exception("Error in annotation")
+            if self.metrics is not None:
+                self.metrics.inc('clams_error_views_total')
             return self.json_to_response(
                 self.cla.record_error(
                     raw_data, **raw_params
@@ -221,3 +751,52 @@ class ClamsHTTPApi(Resource):
                 status=500)
 
     put = post
+
+
+class ClamsJobsApi(Resource):
+    """
+    ClamsJobsApi provides HTTP access to asynchronous jobs submitted in job
+    mode (see :class:`~clams.jobs.JobQueue`).
+
+    Constructor takes an instance of :class:`~clams.jobs.JobQueue`.
+    """
+    def __init__(self, jobs: JobQueue):
+        super().__init__()
+        self.jobs = jobs
+
+    def get(self, job_id: str) -> Response:
+        """
+        Returns the job record (``202``) while the job is queued or running,
+        the output MMIF (``200``) when the job succeeded, and the error-view
+        MMIF (or the input validation error message) with ``500`` when the job
+        failed.
+
+        :param job_id: the job id
+        :return: Returns status or output of the job in a HTTP response.
+        """
+        self.jobs.start()
+        record = self.jobs.get(job_id)
+        if record is None:
+            return Response(response=f"Job {job_id} not found.", status=404, mimetype='text/plain')
+        if record['status'] in (QUEUED, RUNNING):
+            return Response(response=json.dumps(record), status=202, mimetype='application/json')
+        result = self.jobs.result_path(job_id)
+        status = 200 if record['status'] == SUCCEEDED else 500
+        if result is None:
+            return Response(response=record.get('error', ''), status=status, mimetype='text/plain')
+        res = send_file(result, mimetype='application/json')
+        res.status_code = status
+        return res
+
+    def delete(self, job_id: str) -> Response:
+        """
+        Deletes a job that is not running, along with its output.
+
+        :param job_id: the job id
+        :return: ``204`` when deleted, ``409`` when the job is running, ``404`` when not found
+        """
+        if self.jobs.delete(job_id):
+            return Response(status=204)
+        if self.jobs.get(job_id) is None:
+            return Response(response=f"Job {job_id} not found.", status=404, mimetype='text/plain')
+        return Response(response=f"Job {job_id} is running.", status=409, mimetype='text/plain')
@@ -0,0 +1,7 @@
+import os
+import tempfile
+
+# apps made in tests record resource profiles (and may cache outputs) under the user's cache
+# directory by default, keep them out of the developer's real one
+_cache_home = tempfile.TemporaryDirectory(prefix='clams-tests-cache-')
+os.environ['XDG_CACHE_HOME'] = _cache_home.name
@@ -0,0 +1,164 @@
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from mmif.utils.workflow_helper import generate_param_hash  # pytype: disable=import-error
+
+import clams
+import clams.hardware
+from clams.admission import AdmissionRejected, ConcurrencyLimit, MemoryAdmission, TooManyRequests
+from clams.hardware import FakeProbe, set_probe
+from tests.test_clamsapp import ExampleClamsApp, ExampleInputMMIF
+
+MiB = 1024 * 1024
+
+
+class TestMemoryAdmission(unittest.TestCase):
+
+    def test_waits_for_memory(self):
+        admission = MemoryAdmission(lambda: 10 * MiB, max_queue=1, timeout=5, poll_interval=0.01)
+        admitted = threading.Event()
+
+        def second():
+            with admission.admit(6 * MiB):
+                admitted.set()
+
+        with admission.admit(6 * MiB):
+            waiter = threading.Thread(target=second)
+            waiter.start()
+            time.sleep(0.1)
+            # the second request doesn't fit next to the first one
+            self.assertFalse(admitted.is_set())
+            self.assertEqual(admission.waiting, 1)
+        waiter.join(5)
+        self.assertTrue(admitted.is_set())
+        self.assertEqual(admission.reserved, 0)
+
+    def test_rejects(self):
+        free = [1 * MiB]
+        admission = MemoryAdmission(lambda: free[0], max_queue=0, timeout=0.05, poll_interval=0.01)
+        with self.assertRaises(AdmissionRejected) as cm:
+            with admission.admit(2 * MiB):
+                pass
+        self.assertGreaterEqual(cm.exception.retry_after, 1)
+        # times out in the queue
+        admission.max_queue = 1
+        with self.assertRaises(AdmissionRejected):
+            with admission.admit(2 * MiB):
+                pass
+        self.assertEqual(admission.waiting, 0)
+        # memory freed by another process
+        free[0] = 4 * MiB
+        with admission.admit(2 * MiB):
+            self.assertEqual(admission.reserved, 2 * MiB)
+        # unknown available memory admits everything
+        with MemoryAdmission(lambda: None).admit(2 * MiB):
+            pass
+
+
+class TestConcurrencyLimit(unittest.TestCase):
+
+    def test_queue(self):
+        limit = ConcurrencyLimit(1, max_queue=1, timeout=5)
+        order = []
+        queue_depth = []
+
+        def waiter(name):
+            with limit.admit(on_queue=queue_depth.append):
+                order.append(name)
+
+        with limit.admit() as waited:
+            self.assertLess(waited, 0.1)
+            first = threading.Thread(target=waiter, args=('first',))
+            first.start()
+            time.sleep(0.1)
+            self.assertEqual((limit.in_flight, limit.waiting), (1, 1))
+            # the queue is full
+            with self.assertRaises(TooManyRequests) as cm:
+                with limit.admit():
+                    pass
+            self.assertIsInstance(cm.exception, AdmissionRejected)
+            self.assertGreaterEqual(cm.exception.retry_after, 1)
+            time.sleep(0.1)
+        first.join(5)
+        self.assertEqual(order, ['first'])
+        self.assertEqual(queue_depth, [1, -1])
+        self.assertEqual((limit.in_flight, limit.waiting), (0, 0))
+        self.assertGreater(limit.mean_hold_time, 0.1)
+
+    def test_timeout(self):
+        limit = ConcurrencyLimit(1, max_queue=2, timeout=0.05)
+        with limit.admit():
+            with self.assertRaises(TooManyRequests):
+                with limit.admit():
+                    pass
+            self.assertEqual(limit.waiting, 0)
+        with limit.admit():
+            self.assertEqual(limit.in_flight, 1)
+        with self.assertRaises(ValueError):
+            ConcurrencyLimit(0)
+
+
+class TestVRAMAdmission(unittest.TestCase):
+
+    def setUp(self):
+        cache_home = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_home.cleanup)
+        for patcher in (mock.patch.dict('os.environ', {'XDG_CACHE_HOME': cache_home.name}),
+                        mock.patch.object(clams.hardware, '_inventory', None)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        set_probe(FakeProbe([('NVIDIA A100', 4096 * MiB, 4096 * MiB)]))
+        self.app = ExampleClamsApp()
+
+    def test_estimate(self):
+        self.app.metadata.est_gpu_mem_typ = 1024
+        params = self.app._refine_params()
+        self.assertEqual(self.app._estimate_vram(params), 1024 * MiB)
+        store = self.app._get_profile_store()
+        for peak in [500] * 19 + [3000]:
+            store.record(generate_param_hash(params), vram_peak=peak * MiB)
+        # a single outlier doesn't inflate the estimate
+        self.assertEqual(self.app._estimate_vram(params), 500 * MiB)
+        for _ in range(3):
+            store.record(generate_param_hash(params), vram_peak=8192 * MiB)
+        # never more than the device has
+        self.assertEqual(self.app._estimate_vram(params), 4096 * MiB)
+
+    def test_http_503(self):
+        client = clams.Restifier(self.app).test_client()
+        with mock.patch.object(ExampleClamsApp, '_annotate', side_effect=AdmissionRejected('no VRAM', 7)):
+            res = client.post('/', data=ExampleInputMMIF.get_mmif())
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(res.headers['Retry-After'], '7')
+
+    def test_http_429(self):
+        restifier = clams.Restifier(self.app, max_in_flight=1, max_queue=0)
+        client = restifier.test_client()
+        self.assertEqual(client.post('/', data=ExampleInputMMIF.get_mmif()).status_code, 200)
+        with restifier.concurrency_limit.admit():
+            res = client.post('/', data=ExampleInputMMIF.get_mmif())
+        self.assertEqual(res.status_code, 429)
+        self.assertIn('Retry-After', res.headers)
+        metrics = client.get('/metrics').get_data(as_text=True)
+        self.assertIn('clams_requests_shed_total 1', metrics)
+        self.assertIn('clams_request_queue_wait_seconds_count 1', metrics)
+
+    def test_streaming_holds_slot(self):
+        restifier = clams.Restifier(self.app, streaming=True, max_in_flight=1, max_queue=0)
+        client = restifier.test_client()
+        res = client.post('/', data=ExampleInputMMIF.get_mmif(), buffered=False)
+        self.assertEqual(res.status_code, 200)
+        # the body isn't sent yet, so the request is still running
+        self.assertEqual(restifier.concurrency_limit.in_flight, 1)
+        self.assertEqual(client.post('/', data=ExampleInputMMIF.get_mmif()).status_code, 429)
+        self.assertTrue(res.get_data(as_text=True))
+        res.close()
+        self.assertEqual(restifier.concurrency_limit.in_flight, 0)
+        self.assertEqual(client.post('/', data=ExampleInputMMIF.get_mmif()).status_code, 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+import asyncio
+import json
+import threading
+import time
+import unittest
+from unittest import mock
+
+from mmif import Mmif
+
+from clams.admission import AdmissionRejected
+from clams.asgi import AsgiRestifier
+from tests.test_clamsapp import ExampleClamsApp, ExampleInputMMIF
+
+
+def request(app, method='GET', query=b'', body=b'', headers=(), path='/'):
+    """
+    Runs a single HTTP request through an ASGI app, returns (status, headers, body).
+    """
+    async def run():
+        chunks = [body[:10], body[10:]]
+        sent = []
+
+        async def receive():
+            chunk = chunks.pop(0)
+            return {'type': 'http.request', 'body': chunk, 'more_body': bool(chunks)}
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query,
+                 'headers': [(k.encode(), v.encode()) for k, v in headers]}
+        await app(scope, receive, send)
+        return sent
+
+    sent = asyncio.run(run())
+    return (sent[0]['status'], {k.decode(): v.decode() for k, v in sent[0]['headers']},
+            b''.join(m.get('body', b'') for m in sent[1:]))
+
+
+class TestAsgiRestifier(unittest.TestCase):
+
+    def setUp(self):
+        self.app = ExampleClamsApp()
+        self.asgi = AsgiRestifier(self.app)
+
+    def test_get(self):
+        status, headers, body = request(self.asgi)
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)['name'], self.app.metadata.name)
+        self.assertEqual(request(self.asgi, headers=[('If-None-Match', headers['etag'])])[0], 304)
+        self.assertEqual(request(self.asgi, query=b'pretty=true', headers=[('If-None-Match', headers['etag'])])[0],
+                         200)
+        self.assertEqual(request(self.asgi, 'HEAD')[2], b'')
+        self.assertEqual(request(self.asgi, path='/jobs')[0], 404)
+        self.assertEqual(request(self.asgi, 'DELETE')[0], 405)
+
+    def test_post(self):
+        mmif_str = ExampleInputMMIF.get_mmif()
+        for method in ('POST', 'PUT'):
+            status, headers, body = request(self.asgi, method, b'pretty=true&raw=a&raw=b', mmif_str.encode())
+            self.assertEqual(status, 200)
+            self.assertEqual(headers['content-type'], 'application/json')
+            self.assertTrue(body.startswith(b'{\n  '))
+            view = Mmif(body.decode()).views.get_last_contentful_view()
+            expected = Mmif(self.app.annotate(mmif_str, pretty=['true'], raw=['a', 'b']))
+            self.assertEqual(view.metadata.parameters, expected.views.get_last_contentful_view().metadata.parameters)
+        status, headers, body = request(self.asgi, 'POST', body=b'{"not": "mmif"}')
+        self.assertEqual(status, 500)
+        self.assertTrue(body.startswith(b'Invalid input data.'))
+        threads = []
+        record_error = self.app.record_error
+
+        def record_error_in(*args, **kwargs):
+            threads.append(threading.current_thread())
+            return record_error(*args, **kwargs)
+
+        with mock.patch.object(self.app, 'record_error', side_effect=record_error_in):
+            status, _, body = request(self.asgi, 'POST', b'raise_error=true', mmif_str.encode())
+        self.assertEqual(status, 500)
+        error = next(reversed(Mmif(body.decode()).views)).metadata.error
+        self.assertIn('ValueError', error.message)
+        # the error view is made off the event loop, with the error captured there
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.main_thread())
+        with mock.patch.object(ExampleClamsApp, '_annotate', side_effect=AdmissionRejected('no VRAM', 7)):
+            status, headers, _ = request(self.asgi, 'POST', body=mmif_str.encode())
+        self.assertEqual(status, 503)
+        self.assertEqual(headers['retry-after'], '7')
+
+    def test_lifespan(self):
+        messages = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message['type'])
+
+        with mock.patch.object(ExampleClamsApp, 'warm_up') as warm_up:
+            asyncio.run(self.asgi({'type': 'lifespan'}, receive, send))
+        warm_up.assert_called_once()
+        self.assertEqual(sent, ['lifespan.startup.complete', 'lifespan.shutdown.complete'])
+
+    def test_bounded_executor(self):
+        self.app.async_max_workers = 2
+        running = []
+        peak = []
+        lock = threading.Lock()
+        original = ExampleClamsApp.annotate
+
+        def slow_annotate(app, mmif, **params):
+            with lock:
+                running.append(1)
+                peak.append(len(running))
+            time.sleep(0.05)
+            with lock:
+                running.pop()
+            return original(app, mmif, **params)
+
+        async def many():
+            return await asyncio.gather(*(self.app.annotate_async(ExampleInputMMIF.get_mmif()) for _ in range(6)))
+
+        with mock.patch.object(ExampleClamsApp, 'annotate', slow_annotate):
+            outputs = asyncio.run(many())
+        self.assertEqual(len(outputs), 6)
+        self.assertEqual(max(peak), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
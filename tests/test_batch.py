@@ -0,0 +1,97 @@
+import gzip
+import io
+import json
+import pathlib
+import tempfile
+import unittest
+
+from mmif import Mmif
+
+from clams.batch import CHECKPOINT_DIR, collect_tasks, read_checkpoints, run_batch, run_jsonl
+from tests.test_clamsapp import ExampleClamsApp, ExampleInputMMIF
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.root = pathlib.Path(tmpdir.name)
+        self.in_dir = self.root / 'in'
+        (self.in_dir / 'sub').mkdir(parents=True)
+        self.out_dir = self.root / 'out'
+        mmif_str = ExampleInputMMIF.get_mmif()
+        (self.in_dir / 'a.mmif').write_text(mmif_str)
+        (self.in_dir / 'sub' / 'b.json').write_text(mmif_str)
+        with gzip.open(self.in_dir / 'c.mmif.gz', 'wt') as f:
+            f.write(mmif_str)
+        (self.in_dir / 'd.mmif').write_text('{"not": "mmif"}')
+        (self.in_dir / 'notes.txt').write_text('not an input')
+
+    def test_collect_tasks(self):
+        tasks = collect_tasks(self.in_dir, self.out_dir)
+        self.assertEqual([pathlib.Path(i).relative_to(self.in_dir).as_posix() for i, _ in tasks],
+                         ['a.mmif', 'c.mmif.gz', 'd.mmif', 'sub/b.json'])
+        self.assertEqual(tasks[3][1], str(self.out_dir / 'sub' / 'b.json'))
+        manifest = self.root / 'manifest.txt'
+        manifest.write_text('# inputs\nin/a.mmif\tresults/a.out.mmif\n\nin/sub/b.json\n')
+        self.assertEqual(collect_tasks(manifest, self.out_dir),
+                         [(str(self.in_dir / 'a.mmif'), str(self.root / 'results' / 'a.out.mmif')),
+                          (str(self.in_dir / 'sub' / 'b.json'), str(self.out_dir / 'b.json'))])
+
+    def test_run_and_resume(self):
+        counts = run_batch(ExampleClamsApp, self.in_dir, self.out_dir)
+        self.assertEqual(counts, {'done': 3, 'skipped': 0, 'error': 0, 'invalid': 1})
+        self.assertEqual(len(Mmif((self.out_dir / 'sub' / 'b.json').read_text()).views), 2)
+        with gzip.open(self.out_dir / 'c.mmif.gz', 'rt') as f:
+            self.assertEqual(len(Mmif(f.read()).views), 2)
+        self.assertFalse((self.out_dir / 'd.mmif').exists())
+        self.assertEqual(read_checkpoints(self.out_dir)[str(self.in_dir / 'd.mmif')], 'invalid')
+        # everything is finished, even if an output went missing
+        (self.out_dir / 'a.mmif').unlink()
+        self.assertEqual(run_batch(ExampleClamsApp, self.in_dir, self.out_dir)['skipped'], 4)
+        # a killed run resumes where it stopped
+        (self.out_dir / CHECKPOINT_DIR / 'shard-0.jsonl').write_text(
+            json.dumps({'input': str(self.in_dir / 'c.mmif.gz'), 'status': 'done'}) + '\n{"input": "trunc')
+        counts = run_batch(ExampleClamsApp, self.in_dir, self.out_dir)
+        self.assertEqual(counts, {'done': 1, 'skipped': 2, 'error': 0, 'invalid': 1})
+        self.assertTrue((self.out_dir / 'a.mmif').exists())
+        self.assertEqual(run_batch(ExampleClamsApp, self.in_dir, self.out_dir, retry_failed=True)['invalid'], 1)
+
+    def test_error_views(self):
+        counts = run_batch(ExampleClamsApp, self.in_dir, self.out_dir, params={'raise_error': ['true']})
+        self.assertEqual(counts['error'], 3)
+        error_view = next(reversed(Mmif((self.out_dir / 'a.mmif').read_text()).views))
+        self.assertEqual(len(error_view.metadata.error), 2)
+
+    def test_shards(self):
+        counts = run_batch(ExampleClamsApp, self.in_dir, self.out_dir, shards=2)
+        self.assertEqual(counts, {'done': 3, 'skipped': 0, 'error': 0, 'invalid': 1})
+        self.assertEqual(len(list((self.out_dir / CHECKPOINT_DIR).glob('shard-*.jsonl'))), 2)
+        self.assertEqual(len(read_checkpoints(self.out_dir)), 4)
+
+
+class TestJsonl(unittest.TestCase):
+
+    def test_stream(self):
+        app = ExampleClamsApp()
+        mmif_line = Mmif(ExampleInputMMIF.get_mmif()).serialize()
+        envelope = json.dumps({'parameters': {'raise_error': 'true'}, 'mmif': json.loads(mmif_line)})
+        lines = io.StringIO('\n'.join([mmif_line, 'not json', '', envelope, '{"not": "mmif"}', mmif_line]))
+        out = io.StringIO()
+        counts = run_jsonl(app, lines, out, {'pretty': ['true']})
+        self.assertEqual(counts, {'done': 2, 'error': 1, 'invalid': 3})
+        outputs = out.getvalue().split('\n')
+        self.assertEqual(outputs[-1], '')
+        outputs = outputs[:-1]
+        self.assertEqual(len(outputs), 6)
+        self.assertEqual(len(Mmif(outputs[0]).views), 2)
+        self.assertEqual(json.loads(outputs[1])['error']['line'], 2)
+        self.assertEqual(json.loads(outputs[2])['error']['line'], 3)
+        self.assertEqual(len(next(reversed(Mmif(outputs[3]).views)).metadata.error), 2)
+        self.assertEqual(json.loads(outputs[4])['error']['line'], 5)
+        self.assertEqual(len(Mmif(outputs[5]).views), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from mmif import Mmif
+
+from clams.cache import OutputCache, cache_key
+from tests.test_clamsapp import ExampleClamsApp, ExampleInputMMIF
+
+
+class TestOutputCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.cache_dir.cleanup()
+
+    def test_key_is_content_addressed(self):
+        mmif_str = ExampleInputMMIF.get_mmif()
+        key = cache_key(json.loads(mmif_str), {'pretty': False}, 'v1')
+        # formatting and key order of the input don't matter
+        reordered = json.loads(mmif_str, object_pairs_hook=lambda pairs: dict(reversed(pairs)))
+        self.assertEqual(key, cache_key(reordered, {'pretty': False}, 'v1'))
+        self.assertEqual(key, cache_key(Mmif(mmif_str), {'pretty': False}, 'v1'))
+        self.assertNotEqual(key, cache_key(json.loads(mmif_str), {'pretty': True}, 'v1'))
+        self.assertNotEqual(key, cache_key(json.loads(mmif_str), {'pretty': False}, 'v2'))
+
+    def test_lru_eviction(self):
+        cache = OutputCache(self.cache_dir.name, max_size=30)
+        cache.put('a', 'x' * 10)
+        cache.put('b', 'x' * 10)
+        past = time.time() - 100
+        os.utime(os.path.join(self.cache_dir.name, 'a.mmif'), (past, past))
+        os.utime(os.path.join(self.cache_dir.name, 'b.mmif'), (past + 1, past + 1))
+        # a hit makes 'a' the most recently used
+        self.assertEqual(cache.get('a'), 'x' * 10)
+        cache.put('c', 'x' * 15)
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNotNone(cache.get('c'))
+        # too large to store at all
+        cache.put('d', 'x' * 31)
+        self.assertIsNone(cache.get('d'))
+        self.assertEqual(cache.stats(), {'hits': 3, 'misses': 2, 'evictions': 1, 'size': 25, 'max_size': 30})
+
+    def test_annotate_with_cache(self):
+        app = ExampleClamsApp()
+        cache = app.enable_output_cache(self.cache_dir.name)
+        mmif_str = ExampleInputMMIF.get_mmif()
+        with mock.patch.object(ExampleClamsApp, '_annotate', wraps=app._annotate) as annotate:
+            first = app.annotate(mmif_str)
+            self.assertEqual(app.annotate(mmif_str), first)
+            self.assertEqual(annotate.call_count, 1)
+            # different parameters, different output
+            self.assertNotEqual(app.annotate(mmif_str, pretty=['true']), first)
+            self.assertEqual(annotate.call_count, 2)
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 2)
+        # errors are not cached
+        with self.assertRaises(ValueError):
+            app.annotate(mmif_str, raise_error=['true'])
+        self.assertEqual(len(os.listdir(self.cache_dir.name)), 2)
+
+    def test_cache_miss_does_work_once(self):
+        app = ExampleClamsApp()
+        app.enable_output_cache(self.cache_dir.name)
+        mmif_str = ExampleInputMMIF.get_mmif()
+        with mock.patch.object(ExampleClamsApp, '_refine_params', wraps=app._refine_params) as refine:
+            app.annotate(Mmif(mmif_str))
+            self.assertEqual(refine.call_count, 1)
+        # a Mmif input is hashed directly, without a serialize round trip
+        mmif = Mmif(mmif_str)
+        with mock.patch.object(Mmif, 'serialize') as serialize:
+            cache_key(mmif, {}, 'v1')
+            self.assertEqual(serialize.call_count, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,11 @@
 import itertools
 import json
+import logging
 import os
 import sys
 import tempfile
+import threading
+import time
 import unittest
 import warnings
 from typing import Union
@@ -13,6 +16,7 @@ from mmif import Mmif, Document, DocumentTypes, AnnotationTypes, View, __specver
 from mmif.serialize.mmif import ViewsList
 
 import clams.app
+import clams.jobs
 import clams.restify
 from clams.app import ParameterCaster
 from clams.appmetadata import AppMetadata, Input
@@ -312,6 +316,22 @@ class TestClamsApp(unittest.TestCase):
         self.assertEqual(views[2].metadata.timestamp, views[3].metadata.timestamp)
         self.assertTrue(views[1].metadata.timestamp < views[2].metadata.timestamp)
 
+    def test_phase_timings(self):
+        reported = []
+        self.app.phase_timing_hooks.append(reported.append)
+        out_mmif = json.loads(self.app.annotate(self.in_mmif))
+        phases = ['decode', 'refine', 'annotate', 'warnings']
+        for v in out_mmif['views']:
+            profiling = v['metadata']['appProfiling']
+            self.assertEqual(list(profiling['phaseSeconds']), phases)
+            for seconds in profiling['phaseSeconds'].values():
+                self.assertIsInstance(seconds, (int, float))
+        self.assertEqual(len(reported), 1)
+        self.assertEqual(list(reported[0]), phases + ['serialize'])
+        out_mmif = json.loads(self.app.annotate(self.in_mmif, runningTime=['false']))
+        for v in out_mmif['views']:
+            self.assertNotIn('appProfiling', v['metadata'])
+
     def test_run_id(self):
         # first run
         out_mmif = Mmif(self.app.annotate(self.in_mmif))
@@ -343,6 +363,84 @@ class TestClamsApp(unittest.TestCase):
         with self.assertRaises(jsonschema.ValidationError):
             self.app.annotate(self.in_mmif)
 
+    def test_annotate_stream_matches_annotate(self):
+        for pretty in (False, True):
+            annotated, _, _ = self.app._run_annotate(self.in_mmif)
+            expected = annotated.serialize(pretty=pretty, sanitize=True)
+            prepared = clams.app._prepare_for_streaming(annotated)
+            chunks = list(clams.app._iter_json_chunks(prepared, 2 if pretty else None, 100))
+            self.assertGreater(len(chunks), 1)
+            self.assertEqual(''.join(chunks), expected)
+        streamed = ''.join(self.app.annotate_stream(self.in_mmif, pretty=['true']))
+        self.assertEqual(len(Mmif(streamed).views), 2)
+
+    def test_annotate_stream_validates_eagerly(self):
+        m = Mmif(self.in_mmif)
+        v = m.new_view()
+        v.new_contain(AnnotationTypes.TimeFrame)
+        v.new_annotation(AnnotationTypes.TimeFrame, start=10, end=30)
+        from unittest.mock import MagicMock
+        self.app._annotate = MagicMock(return_value=m)
+        # raised by the call itself, before any chunk is consumed
+        with self.assertRaises(jsonschema.ValidationError):
+            self.app.annotate_stream(self.in_mmif)
+
+    def test_annotate_many(self):
+        envelope = json.dumps({'parameters': {'pretty': 'true'}, 'mmif': json.loads(self.in_mmif)})
+        inputs = [self.in_mmif, Mmif(self.in_mmif), envelope, self.in_mmif.encode('utf-8')]
+        outputs = list(self.app.annotate_many(iter(inputs), undefined=['x']))
+        self.assertEqual(len(outputs), 4)
+        for output in outputs:
+            # the app view, and a warnings view for the version mismatch and the undefined parameter
+            views = list(Mmif(output).views)
+            self.assertEqual(len(views), 2)
+            self.assertEqual(len(views[-1].metadata.warnings), 2)
+        self.assertNotIn('\n', outputs[0])
+        self.assertIn('\n', outputs[2])
+        with self.assertRaises(ValueError):
+            self.app.annotate_many(inputs, executor='gpu')
+        with self.assertRaises(ValueError):
+            self.app.annotate_many(inputs, tfSamplingMode=['nonexistent'])
+
+    def test_warnings_from_app_threads(self):
+        app_annotate = self.app._annotate
+
+        def annotate_with_worker(mmif, **kwargs):
+            worker = threading.Thread(target=warnings.warn, args=('warned from a worker thread',))
+            worker.start()
+            worker.join()
+            return app_annotate(mmif, **kwargs)
+
+        self.app._annotate = annotate_with_worker
+        views = list(Mmif(self.app.annotate(self.in_mmif)).views)
+        self.assertTrue(any('warned from a worker thread' in w for w in views[-1].metadata.warnings))
+
+    def test_annotate_many_pools(self):
+        inputs = [self.in_mmif] * 5
+        for executor in ('thread', 'process'):
+            for ordered in (True, False):
+                outputs = list(self.app.annotate_many(inputs, executor=executor, max_workers=2, ordered=ordered))
+                self.assertEqual([len(Mmif(output).views) for output in outputs], [2] * 5)
+        outputs = self.app.annotate_many(inputs, executor='thread', raise_error=['true'])
+        with self.assertRaises(ValueError):
+            list(outputs)
+
+    def test_annotate_batch(self):
+        batches = []
+
+        def annotate_batch(mmifs, **refined):
+            batches.append(len(mmifs))
+            return [self.app._annotate(mmif, **refined) for mmif in mmifs]
+        self.app._annotate_batch = annotate_batch
+        outputs = list(self.app.annotate_many([self.in_mmif] * 5, batch_size=2))
+        self.assertEqual(batches, [2, 2])
+        self.assertEqual(len(outputs), 5)
+        timestamps = [next(iter(Mmif(output).views)).metadata.timestamp for output in outputs]
+        self.assertEqual(timestamps[0], timestamps[1])
+        self.app._annotate_batch = lambda mmifs, **refined: mmifs[:1]
+        with self.assertRaises(ValueError):
+            list(self.app.annotate_many([self.in_mmif] * 2, batch_size=2))
+
     def test_open_document_location(self):
         mmif = ExampleInputMMIF.get_rawmmif()
         with self.app.open_document_location(mmif['t1']) as f:
@@ -400,6 +498,32 @@ class TestClamsApp(unittest.TestCase):
             # because param4 can't be 4, note that param1 is "required" 
             self.app._refine_params(param1=['p1'], param4=['4'])
             
+    def test_refine_parameters_memoized(self):
+        self.app.refine_cache_size = 2
+        template = self.app._param_template
+        from unittest import mock
+        with mock.patch.object(AppMetadata, 'model_dump_json') as dump:
+            conf = self.app._refine_params(pretty=['true'])
+            # the template compiled in __init__ is used, and the metadata is not serialized to validate it
+            self.assertIs(self.app._param_template, template)
+            dump.assert_not_called()
+        self.assertIs(conf['pretty'], True)
+        conf['pretty'] = False
+        again = self.app._refine_params(pretty=['true'])
+        self.assertIs(again['pretty'], True)
+        self.assertIsNot(again, conf)
+        self.assertEqual(len(self.app._refine_cache[1]), 1)
+        self.app._refine_params(pretty=['false'])
+        self.app._refine_params(hwFetch=['true'])
+        self.assertEqual(len(self.app._refine_cache[1]), 2)
+        self.assertNotIn(((('pretty', ('true',)),)), self.app._refine_cache[1])
+        # changes in the metadata are picked up
+        self.app.metadata.add_parameter('newParam', type='string', default='new', description='added later')
+        self.assertEqual(self.app._refine_params(pretty=['true'])['newParam'], 'new')
+        self.app.metadata.parameters[-1].default = 'newer'
+        self.assertEqual(self.app._refine_params(pretty=['true'])['newParam'], 'newer')
+        self.assertEqual(len(self.app._refine_cache[1]), 1)
+
     def test_error_handling(self):
         params = {'raise_error': ['true'], 'pretty': ['true']}
         in_mmif = Mmif(self.in_mmif)
@@ -500,11 +624,70 @@ class TestRestifier(unittest.TestCase):
         print(gotten.get_data(as_text=True))
         self.assertIsNotNone(gotten)
 
+    def test_get_etag_and_not_modified(self):
+        gotten = self.app.get('/')
+        self.assertEqual(gotten.status_code, 200)
+        etag = gotten.headers['ETag']
+        self.assertIsNotNone(etag)
+        not_modified = self.app.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified.get_data(), b'')
+        # pretty and compact representations are different entities
+        pretty = self.app.get('/', query_string={'pretty': 'true'}, headers={'If-None-Match': etag})
+        self.assertEqual(pretty.status_code, 200)
+        self.assertNotEqual(pretty.headers['ETag'], etag)
+        stale = self.app.get('/', headers={'If-None-Match': '"some-old-etag"'})
+        self.assertEqual(stale.status_code, 200)
+        self.assertEqual(stale.get_data(), gotten.get_data())
+
+    def test_metadata_cache_refreshes_on_change(self):
+        cla = ExampleClamsApp()
+        client = clams.Restifier(cla).test_client()
+        first = client.get('/')
+        # no re-serialization when nothing changed
+        from unittest import mock
+        with mock.patch.object(AppMetadata, 'jsonify', wraps=cla.metadata.jsonify) as jsonify:
+            self.assertEqual(client.get('/').get_data(), first.get_data())
+            jsonify.assert_not_called()
+        cla.metadata.add_output(AnnotationTypes.BoundingBox, boxType='text')
+        second = client.get('/', headers={'If-None-Match': first.headers['ETag']})
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(len(json.loads(second.get_data())['output']), 2)
+        # assignments to nested objects also invalidate the cache
+        cla.metadata.output[-1].description = 'text bounding box'
+        third = client.get('/', headers={'If-None-Match': second.headers['ETag']})
+        self.assertEqual(third.status_code, 200)
+        self.assertIn('description', json.loads(third.get_data())['output'][-1])
+        # in-place edits of nested lists and dicts need an explicit refresh
+        cla.metadata.output[-1].properties['boxType'] = 'barcode'
+        cla.metadata.refresh()
+        fourth = client.get('/', headers={'If-None-Match': third.headers['ETag']})
+        self.assertEqual(fourth.status_code, 200)
+        self.assertEqual(json.loads(fourth.get_data())['output'][-1]['properties']['boxType'], 'barcode')
+        cla.metadata.add_more('extra', 'value')
+        fifth = client.get('/')
+        cla.metadata.more['extra'] = 'other'
+        cla.metadata.refresh()
+        sixth = client.get('/', headers={'If-None-Match': fifth.headers['ETag']})
+        self.assertEqual(sixth.status_code, 200)
+        self.assertEqual(json.loads(sixth.get_data())['more'], {'extra': 'other'})
+
     def test_can_post(self):
         posted = self.app.post('/', data=ExampleInputMMIF.get_mmif())
         print(posted.get_data(as_text=True))
         self.assertIsNotNone(posted)
 
+    def test_can_post_streaming(self):
+        client = clams.Restifier(ExampleClamsApp(), streaming=True).test_client()
+        posted = client.post('/', data=ExampleInputMMIF.get_mmif(), query_string={'pretty': True})
+        self.assertEqual(posted.status_code, 200)
+        self.assertTrue(posted.is_streamed)
+        self.assertIsNone(posted.content_length)
+        self.assertEqual(len(Mmif(posted.get_data(as_text=True)).views), 2)
+        errored = client.post('/', data=ExampleInputMMIF.get_mmif(), query_string={'raise_error': True})
+        self.assertEqual(errored.status_code, 500)
+        self.assertIsNotNone(Mmif(errored.get_data(as_text=True)))
+
     def test_can_put(self):
         put = self.app.put('/', data=ExampleInputMMIF.get_mmif())
         print(put.get_data(as_text=True))
@@ -573,6 +756,217 @@ class TestRestifier(unittest.TestCase):
         self.assertEqual(res.status_code, 500)
         self.assertEqual(res.mimetype, 'text/plain')
 
+    def production_options(self, **options):
+        from unittest.mock import patch
+        import gunicorn.app.base
+        captured = {}
+        with patch.object(gunicorn.app.base.BaseApplication, 'run',
+                          lambda app: captured.update(app.options)):
+            clams.Restifier(ExampleClamsApp()).serve_production(**options)
+        return captured
+
+    def test_memory_watermark_options(self):
+        self.assertEqual(self.production_options()['max_requests'], 1)
+        options = self.production_options(recycle_rss_mb=4096)
+        self.assertEqual(options['max_requests'], 0)
+        self.assertEqual(options['post_request'].rss_mb, 4096)
+        self.assertNotIn('recycle_rss_mb', options)
+        os.environ['CLAMS_RECYCLE_VRAM_MB'] = '1000'
+        try:
+            options = self.production_options(max_requests=100)
+        finally:
+            del os.environ['CLAMS_RECYCLE_VRAM_MB']
+        self.assertEqual(options['max_requests'], 100)
+        self.assertEqual(options['post_request'].vram_mb, 1000)
+
+    def test_spare_workers_warm_up(self):
+        from types import SimpleNamespace
+        from unittest.mock import patch
+        base = self.production_options()['workers']
+        options = self.production_options(spare_workers=2)
+        self.assertEqual(options['workers'], base + 2)
+        self.assertEqual(self.production_options(workers=3, spare_workers=1)['workers'], 4)
+        with patch.object(ExampleClamsApp, 'warm_up') as warm_up:
+            options['post_worker_init'](SimpleNamespace(pid=os.getpid()))
+        warm_up.assert_called_once()
+
+    def test_workers_by_host_memory(self):
+        from unittest.mock import patch
+        from clams.hardware import get_inventory
+        ram = get_inventory().memory
+        cpu_workers = (os.cpu_count() * 2) + 1
+        with patch.object(ExampleClamsApp, '_estimate_process_memory', return_value=(ram // 3 + 1, 'test')):
+            self.assertEqual(self.production_options()['workers'], min(2, cpu_workers))
+        with patch.object(ExampleClamsApp, '_estimate_process_memory', return_value=(0, 'unknown')):
+            self.assertEqual(self.production_options()['workers'], cpu_workers)
+
+    def test_autosize_workers(self):
+        import io
+        from contextlib import redirect_stdout
+        from unittest.mock import patch
+        from clams.hardware import FakeProbe, set_probe
+        gib = 1024 ** 3
+        cpu_workers = (os.cpu_count() * 2) + 1
+        estimates = {'rss_peak': (1, 'test'), 'vram_peak': (gib, '95th percentile of 10 recorded run(s)')}
+        with patch.object(clams.hardware, '_inventory', None), \
+                patch.object(ExampleClamsApp, '_estimate_process_memory', side_effect=lambda m: estimates[m]):
+            set_probe(FakeProbe([('NVIDIA A100', 10 * gib, 10 * gib)]))
+            restifier = clams.Restifier(ExampleClamsApp())
+            restifier.cla.metadata.est_gpu_mem_typ = 5 * 1024
+            # static estimate from the metadata
+            self.assertEqual(restifier.recommend_workers()[0], min(2, cpu_workers))
+            # spare workers don't go past a memory-based limit
+            workers, reasoning = restifier.recommend_workers(spare_workers=1)
+            self.assertEqual(workers, min(2, cpu_workers))
+            if cpu_workers > 2:
+                self.assertIn('Spare workers: 0 of 1 kept, capped by VRAM', reasoning)
+            # recorded peak, with the safety margin
+            workers, reasoning = restifier.recommend_workers(autosize=True, margin=0.25)
+            self.assertEqual(workers, min(8, cpu_workers))
+            self.assertIn('(95th percentile of 10 recorded run(s)) x 1.25 margin = 8 workers', reasoning[-2])
+            out = io.StringIO()
+            with redirect_stdout(out), patch.dict('os.environ', {'CLAMS_GUNICORN_WORKERS': 'auto'}), \
+                    patch('gunicorn.app.base.BaseApplication.run') as run:
+                restifier.serve_production(dry_run=True)
+            run.assert_not_called()
+            self.assertIn(f'Recommended number of workers: {min(8, cpu_workers)}', out.getvalue())
+
+    def test_gpu_placement(self):
+        from types import SimpleNamespace
+        from unittest.mock import patch
+        from clams.hardware import FakeProbe, set_probe
+        gib = 1024 ** 3
+        estimates = {'rss_peak': (0, 'unknown'), 'vram_peak': (10 * gib, 'test')}
+        with patch.object(clams.hardware, '_inventory', None), patch.dict('os.environ'), \
+                patch.object(ExampleClamsApp, '_estimate_process_memory', side_effect=lambda m: estimates[m]):
+            os.environ.pop('CUDA_VISIBLE_DEVICES', None)
+            set_probe(FakeProbe([('NVIDIA A100', 40 * gib, 40 * gib)] * 2 + [('NVIDIA T4', 16 * gib, 16 * gib)]))
+            options = self.production_options(autosize=True, autosize_margin=0)
+            self.assertEqual(options['workers'], min(4 + 4 + 1, (os.cpu_count() * 2) + 1))
+            server = SimpleNamespace(WORKERS={})
+            for pid in range(4):
+                worker = SimpleNamespace(pid=pid)
+                options['pre_fork'](server, worker)
+                server.WORKERS[pid] = worker
+            self.assertEqual([w.clams_gpu for w in server.WORKERS.values()], [0, 1, 2, 0])
+            # a recycled worker's replacement takes its slot
+            del server.WORKERS[1]
+            replacement = SimpleNamespace(pid=5)
+            options['pre_fork'](server, replacement)
+            self.assertEqual(replacement.clams_gpu, 1)
+            options['post_fork'](server, replacement)
+            self.assertEqual(os.environ['CUDA_VISIBLE_DEVICES'], '1')
+            self.assertEqual(clams.hardware.get_inventory().cuda_index(0), 1)
+            self.assertNotIn('pre_fork', self.production_options(autosize=True, gpu_placement='none'))
+            # a server restricted to a single GPU needs no placement
+            os.environ['CUDA_VISIBLE_DEVICES'] = '2'
+            self.assertNotIn('pre_fork', self.production_options(autosize=True))
+
+    def test_memory_watermark_recycles_worker(self):
+        from types import SimpleNamespace
+        worker = SimpleNamespace(alive=True, pid=os.getpid(), nr=3)
+        clams.restify._MemoryWatermark(logging.getLogger("test"), rss_mb=1024 * 1024)(worker, None, {}, None)
+        self.assertTrue(worker.alive)
+        with self.assertLogs(logging.getLogger("test"), 'WARNING') as logs:
+            clams.restify._MemoryWatermark(logging.getLogger("test"), rss_mb=1)(worker, None, {}, None)
+        self.assertFalse(worker.alive)
+        self.assertIn('RSS', logs.output[0])
+
+
+class TestJobs(unittest.TestCase):
+
+    def setUp(self):
+        self.job_dir = tempfile.TemporaryDirectory()
+        self.restifier = clams.Restifier(ExampleClamsApp(), job_dir=self.job_dir.name)
+        self.restifier.jobs.poll_interval = 0.05
+        self.app = self.restifier.test_client()
+
+    def tearDown(self):
+        self.restifier.jobs.stop()
+        self.job_dir.cleanup()
+
+    def wait_for(self, job_id, timeout=10):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            res = self.app.get(f'/jobs/{job_id}')
+            if res.status_code != 202:
+                return res
+            time.sleep(0.05)
+        self.fail(f'job {job_id} did not finish in {timeout} seconds')
+
+    def test_submit_and_fetch(self):
+        submitted = self.app.post('/', data=ExampleInputMMIF.get_mmif(), query_string={'pretty': True})
+        self.assertEqual(submitted.status_code, 202)
+        job_id = submitted.get_json()['id']
+        self.assertTrue(submitted.headers['Location'].endswith(f'/jobs/{job_id}'))
+        res = self.wait_for(job_id)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(Mmif(res.get_data(as_text=True)).views), 2)
+        self.assertEqual(self.app.delete(f'/jobs/{job_id}').status_code, 204)
+        self.assertEqual(self.app.get(f'/jobs/{job_id}').status_code, 404)
+
+    def test_failed_jobs(self):
+        errored = self.app.post('/', data=ExampleInputMMIF.get_mmif(), query_string={'raise_error': True})
+        res = self.wait_for(errored.get_json()['id'])
+        self.assertEqual(res.status_code, 500)
+        self.assertIn('error', Mmif(res.get_data(as_text=True)).views[0].metadata)
+        invalid = self.app.post('/', data='{"top string": "this is not a mmif"}')
+        res = self.wait_for(invalid.get_json()['id'])
+        self.assertEqual(res.status_code, 500)
+        self.assertEqual(res.mimetype, 'text/plain')
+
+    def test_worker_survives_errors(self):
+        from unittest import mock
+        with mock.patch.object(ExampleClamsApp, 'record_error', side_effect=RuntimeError('no error view')):
+            errored = self.app.post('/', data=ExampleInputMMIF.get_mmif(), query_string={'raise_error': True})
+            res = self.wait_for(errored.get_json()['id'])
+        # the original error is recorded
+        self.assertEqual(res.status_code, 500)
+        self.assertTrue(res.get_data(as_text=True).startswith('ValueError'))
+        with mock.patch.object(clams.jobs.JobQueue, '_run', side_effect=OSError('disk is gone')):
+            broken = self.app.post('/', data=ExampleInputMMIF.get_mmif())
+            res = self.wait_for(broken.get_json()['id'])
+        self.assertEqual(res.status_code, 500)
+        self.assertIn('disk is gone', res.get_data(as_text=True))
+        # and the same workers keep running jobs
+        res = self.wait_for(self.app.post('/', data=ExampleInputMMIF.get_mmif()).get_json()['id'])
+        self.assertEqual(res.status_code, 200)
+
+    def test_unknown_and_interrupted_jobs(self):
+        self.assertEqual(self.app.get('/jobs/0123abcd').status_code, 404)
+        self.assertEqual(self.app.get('/jobs/..%2Fetc').status_code, 404)
+        # a queue without running workers, so that the job stays where we put it
+        jobs = clams.jobs.JobQueue(self.restifier.cla, self.job_dir.name)
+        record = jobs.submit(b'{}', {})
+        # pretend a (now dead) process claimed the job
+        os.rename(jobs.job_dir / f"{record['id']}.input", jobs.job_dir / f"{record['id']}.running")
+        record.update(status=clams.jobs.RUNNING, started=time.time(), pid=2 ** 22 + 1)
+        jobs._write_record(record)
+        self.assertEqual(jobs.get(record['id'])['status'], clams.jobs.FAILED)
+        self.assertIn('interrupted', jobs.get(record['id'])['error'])
+        self.assertFalse(jobs._claim_next())
+        # a live process that reused the pid doesn't keep the job running
+        record['pid'] = os.getpid()
+        jobs._write_record(record)
+        self.assertEqual(jobs.get(record['id'])['status'], clams.jobs.FAILED)
+        # only the worker that holds the lock of the job does
+        lock_path = jobs.job_dir / f"{record['id']}.lock"
+        lock_fd = clams.jobs._hold_lock(lock_path)
+        try:
+            self.assertEqual(jobs.get(record['id'])['status'], clams.jobs.RUNNING)
+        finally:
+            clams.jobs._release_lock(lock_path, lock_fd)
+        self.assertEqual(jobs.get(record['id'])['status'], clams.jobs.FAILED)
+
+    def test_sweep(self):
+        jobs = self.restifier.jobs
+        res = self.wait_for(self.app.post('/', data=ExampleInputMMIF.get_mmif()).get_json()['id'])
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(jobs.sweep(), 0)
+        jobs.retention = 0
+        self.assertEqual(jobs.sweep(), 1)
+        self.assertEqual(list(jobs.job_dir.iterdir()), [])
+
 
 class TestParameterCaster(unittest.TestCase):
     
@@ -0,0 +1,124 @@
+import argparse
+import gzip
+import io
+import tempfile
+import unittest
+from unittest import mock
+
+from mmif import Mmif
+
+import clams
+from clams.asgi import AsgiRestifier
+from clams.compression import (CompressionError, DecompressedTooLarge, FileType, UnsupportedEncoding,
+                               available_encodings, compress, compress_chunks, negotiate, open_text, read_decompressed)
+from tests.test_asgi import request
+from tests.test_clamsapp import ExampleClamsApp, ExampleInputMMIF
+
+HAS_ZSTD = 'zstd' in available_encodings()
+
+
+class TestCompression(unittest.TestCase):
+
+    def test_negotiate(self):
+        self.assertIsNone(negotiate(None))
+        self.assertIsNone(negotiate('br'))
+        self.assertEqual(negotiate('gzip, deflate'), 'gzip')
+        self.assertEqual(negotiate('x-gzip'), 'gzip')
+        self.assertIsNone(negotiate('gzip;q=0'))
+        self.assertEqual(negotiate('*'), available_encodings()[0])
+        self.assertEqual(negotiate('zstd, gzip'), 'zstd' if HAS_ZSTD else 'gzip')
+        self.assertEqual(negotiate('zstd;q=0.5, gzip'), 'gzip')
+
+    def test_round_trip(self):
+        data = ExampleInputMMIF.get_mmif().encode('utf-8') * 10
+        for encoding in available_encodings():
+            compressed = compress(data, encoding)
+            self.assertLess(len(compressed), len(data))
+            self.assertEqual(read_decompressed(io.BytesIO(compressed), encoding), data)
+            chunked = b''.join(compress_chunks([data[:100].decode(), data[100:]], encoding))
+            self.assertEqual(read_decompressed(io.BytesIO(chunked), encoding), data)
+        self.assertEqual(read_decompressed(io.BytesIO(data), 'identity'), data)
+        with self.assertRaises(CompressionError):
+            read_decompressed(io.BytesIO(compress(data, 'gzip')[:50]), 'gzip')
+        with self.assertRaises(UnsupportedEncoding):
+            read_decompressed(io.BytesIO(data), 'br')
+        for encoding in available_encodings():
+            compressed = compress(data, encoding)
+            self.assertEqual(read_decompressed(io.BytesIO(compressed), encoding, max_size=len(data)), data)
+            with self.assertRaises(DecompressedTooLarge):
+                read_decompressed(io.BytesIO(compressed), encoding, max_size=len(data) - 1)
+        if not HAS_ZSTD:
+            with self.assertRaises(UnsupportedEncoding):
+                compress(data, 'zstd')
+
+    def test_files(self):
+        mmif_str = ExampleInputMMIF.get_mmif()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for suffix in ['', '.gz'] + (['.zst'] if HAS_ZSTD else []):
+                path = f'{tmpdir}/out.mmif{suffix}'
+                out = FileType('w')(path)
+                out.write(mmif_str)
+                out.close()
+                with FileType('r')(path) as f:
+                    self.assertEqual(f.read(), mmif_str)
+            with gzip.open(f'{tmpdir}/out.mmif.gz', 'rt') as f:
+                self.assertEqual(f.read(), mmif_str)
+            with open_text(f'{tmpdir}/out.mmif.gz') as f:
+                self.assertEqual(f.read(), mmif_str)
+            with self.assertRaises(argparse.ArgumentTypeError):
+                FileType('r')(f'{tmpdir}/missing.mmif.gz')
+
+
+class TestCompressedTransport(unittest.TestCase):
+
+    def setUp(self):
+        self.app = ExampleClamsApp()
+        self.mmif_str = ExampleInputMMIF.get_mmif()
+
+    def test_http(self):
+        for streaming in (False, True):
+            client = clams.Restifier(self.app, streaming=streaming).test_client()
+            res = client.post('/', data=compress(self.mmif_str, 'gzip'),
+                              headers={'Content-Encoding': 'gzip', 'Accept-Encoding': 'gzip'})
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+            self.assertIn('Accept-Encoding', res.headers['Vary'])
+            self.assertEqual(len(Mmif(gzip.decompress(res.get_data()).decode()).views), 2)
+        res = client.post('/', data=self.mmif_str)
+        self.assertNotIn('Content-Encoding', res.headers)
+        self.assertEqual(len(Mmif(res.get_data(as_text=True)).views), 2)
+        res = client.post('/', data=self.mmif_str, headers={'Content-Encoding': 'br'})
+        self.assertEqual(res.status_code, 415)
+        res = client.post('/', data=compress(self.mmif_str, 'gzip')[:50], headers={'Content-Encoding': 'gzip'})
+        self.assertEqual(res.status_code, 500)
+        self.assertTrue(res.get_data(as_text=True).startswith('Invalid input data.'))
+
+    def test_decompression_limit(self):
+        # a few kilobytes that decompress to 8 MB
+        bomb = compress(b' ' * (8 * 1024 * 1024), 'gzip')
+        restifier = clams.Restifier(self.app)
+        client = restifier.test_client()
+        # limited by the request size limit of the server by default
+        restifier.flask_app.config['MAX_CONTENT_LENGTH'] = 1024 * 1024
+        res = client.post('/', data=bomb, headers={'Content-Encoding': 'gzip'})
+        self.assertEqual(res.status_code, 413)
+        client = clams.Restifier(self.app, max_decompressed_mb=1).test_client()
+        self.assertEqual(client.post('/', data=bomb, headers={'Content-Encoding': 'gzip'}).status_code, 413)
+        res = client.post('/', data=compress(self.mmif_str, 'gzip'), headers={'Content-Encoding': 'gzip'})
+        self.assertEqual(res.status_code, 200)
+        with mock.patch.dict('os.environ', {'CLAMS_MAX_DECOMPRESSED_MB': '1'}):
+            asgi = AsgiRestifier(self.app)
+        self.assertEqual(request(asgi, 'POST', body=bomb, headers=[('Content-Encoding', 'gzip')])[0], 413)
+
+    def test_asgi(self):
+        asgi = AsgiRestifier(self.app)
+        status, headers, body = request(asgi, 'POST', body=compress(self.mmif_str, 'gzip'),
+                                        headers=[('Content-Encoding', 'gzip'), ('Accept-Encoding', 'gzip')])
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['content-encoding'], 'gzip')
+        self.assertEqual(len(Mmif(gzip.decompress(body).decode()).views), 2)
+        self.assertEqual(request(asgi, 'POST', body=b'x', headers=[('Content-Encoding', 'br')])[0], 415)
+
+
+if __name__ == '__main__':
+    unittest.main()
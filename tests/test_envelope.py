@@ -12,7 +12,7 @@ import clams
 import clams.app
 from clams.appmetadata import AppMetadata
 from clams.envelop import (
-    EnvelopeError, create_envelope, is_envelope,
+    EnvelopeError, create_envelope, is_envelope, load_input,
     main as envelope_cli_main, normalize_params, prep_argparser,
     unwrap_envelope, unwrap_if_envelope,
 )
@@ -214,6 +214,50 @@ class TestUnwrapIfEnvelope(unittest.TestCase):
         self.assertEqual(params, {})
 
 
+class TestLoadInput(unittest.TestCase):
+    """
+    Tests for the parse-once helper used by ``ClamsApp.annotate``.
+    """
+
+    def setUp(self):
+        self.mmif_str = ExampleInputMMIF.get_mmif()
+
+    def test_raw_str_decoded(self):
+        data, params = load_input(self.mmif_str, {'a': ['1']})
+        self.assertIsInstance(data, dict)
+        self.assertEqual(data, json.loads(self.mmif_str))
+        self.assertEqual(params, {'a': ['1']})
+
+    def test_raw_bytes_decoded(self):
+        data, _ = load_input(self.mmif_str.encode('utf-8'), {})
+        self.assertEqual(data, json.loads(self.mmif_str))
+
+    def test_envelope_inner_mmif_not_reserialized(self):
+        env = create_envelope(self.mmif_str, {'prompt': 'env'})
+        data, params = load_input(env.encode('utf-8'), {'pretty': ['true']})
+        self.assertIsInstance(data, dict)
+        Mmif(data)
+        self.assertEqual(params, {'prompt': ['env'], 'pretty': ['true']})
+
+    def test_decoded_dict_passthrough(self):
+        body = json.loads(self.mmif_str)
+        data, _ = load_input(body, {})
+        self.assertIs(data, body)
+
+    def test_invalid_json_raises(self):
+        with self.assertRaises(json.JSONDecodeError):
+            load_input('this is not json', {})
+
+    def test_annotate_hands_decoded_mmif_to_mmif(self):
+        from unittest import mock
+        app = EnvelopeTestApp()
+        env = create_envelope(self.mmif_str, {'prompt': 'x'})
+        with mock.patch.object(Mmif, 'validate', wraps=Mmif.validate) as validate:
+            app.annotate(env.encode('utf-8'))
+        # the inner MMIF reaches the constructor already decoded
+        self.assertIsInstance(validate.call_args_list[0].args[0], dict)
+
+
 class TestRestifierEnvelope(unittest.TestCase):
 
     def setUp(self):
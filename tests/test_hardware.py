@@ -0,0 +1,112 @@
+import subprocess
+import sys
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import clams.hardware
+from clams.hardware import FakeProbe, HardwareInventory, NVMLProbe, NvidiaSmiProbe, default_probe, get_inventory, \
+    set_probe
+from tests.test_clamsapp import ExampleClamsApp, ExampleInputMMIF
+
+MiB = 1024 * 1024
+A100S = [('NVIDIA A100', 40960 * MiB, 1024 * MiB), ('NVIDIA A100', 40960 * MiB, 2048 * MiB)]
+
+
+class TestHardwareInventory(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(clams.hardware, '_inventory', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_detects_once(self):
+        probe = FakeProbe(A100S)
+        with mock.patch.object(clams.hardware, 'default_probe', return_value=probe):
+            inventory = get_inventory()
+            self.assertIs(get_inventory(), inventory)
+        self.assertEqual(probe.calls, 1)
+        self.assertEqual([g.name for g in inventory.gpus], ['NVIDIA A100'] * 2)
+        self.assertEqual(inventory.gpu(1).total_memory, 40960 * MiB)
+        self.assertIsNone(inventory.gpu(2))
+        # only free memory is probed again
+        self.assertEqual(inventory.free_memory(), {0: 1024 * MiB, 1: 2048 * MiB})
+        self.assertEqual(probe.calls, 2)
+
+    def test_cpu_only_host(self):
+        probe = FakeProbe()
+        inventory = set_probe(probe)
+        self.assertIs(get_inventory(), inventory)
+        self.assertFalse(inventory.has_gpu)
+        self.assertEqual(inventory.free_memory(), {})
+        self.assertEqual(probe.calls, 1)
+        self.assertIn('cores', inventory.cpu)
+
+    def test_cuda_visible_devices(self):
+        inventory = set_probe(FakeProbe(A100S + [('NVIDIA T4', 16 * MiB, 16 * MiB)]))
+        with mock.patch.dict('os.environ', {'CUDA_VISIBLE_DEVICES': '2,0'}):
+            self.assertEqual([g.index for g in inventory.visible_gpus()], [2, 0])
+            self.assertEqual(inventory.cuda_index(0), 2)
+            self.assertIsNone(inventory.cuda_index(2))
+        with mock.patch.dict('os.environ', {'CUDA_VISIBLE_DEVICES': ''}):
+            self.assertEqual(inventory.visible_gpus(), [])
+        with mock.patch.dict('os.environ', {'CUDA_VISIBLE_DEVICES': 'GPU-1234'}):
+            self.assertEqual(len(inventory.visible_gpus()), 3)
+
+    def test_probe_selection(self):
+        with mock.patch.dict('os.environ', {'CLAMS_GPU_PROBE': 'none'}):
+            self.assertEqual(default_probe().devices(), [])
+        with mock.patch.dict('os.environ', {'CLAMS_GPU_PROBE': 'nvidia-smi'}):
+            self.assertIsInstance(default_probe(), NvidiaSmiProbe)
+        # falls back to nvidia-smi without NVML bindings, unless NVML is explicitly requested
+        with mock.patch.dict(sys.modules, {'pynvml': None}):
+            with mock.patch.dict('os.environ', {'CLAMS_GPU_PROBE': ''}):
+                self.assertIsInstance(default_probe(), NvidiaSmiProbe)
+            with mock.patch.dict('os.environ', {'CLAMS_GPU_PROBE': 'nvml'}), self.assertRaises(ImportError):
+                default_probe()
+
+    def test_nvml_probe(self):
+        handles = ['h0', 'h1']
+        pynvml = SimpleNamespace(
+            NVMLError=RuntimeError,
+            nvmlInit=mock.Mock(),
+            nvmlDeviceGetCount=lambda: 2,
+            nvmlDeviceGetHandleByIndex=lambda i: handles[i],
+            nvmlDeviceGetName=lambda h: b'NVIDIA A100',
+            nvmlDeviceGetMemoryInfo=lambda h: SimpleNamespace(total=40960 * MiB, free=(handles.index(h) + 1) * MiB))
+        with mock.patch.dict(sys.modules, {'pynvml': pynvml}):
+            inventory = HardwareInventory(default_probe())
+        self.assertIsInstance(inventory.probe, NVMLProbe)
+        self.assertEqual([g.name for g in inventory.gpus], ['NVIDIA A100'] * 2)
+        self.assertEqual(inventory.free_memory(), {0: MiB, 1: 2 * MiB})
+        # initialized once per process
+        pynvml.nvmlInit.assert_called_once()
+
+    def test_nvidia_smi_probe(self):
+        outputs = {'index,name,memory.total': '0, NVIDIA A100, 40960\n1, NVIDIA A100, 40960\n',
+                   'index,memory.free': '0, 1024\n1, 2048\n'}
+
+        def run(cmd, **kwargs):
+            return subprocess.CompletedProcess(cmd, 0, stdout=outputs[cmd[1].split('=')[1]])
+
+        with mock.patch('shutil.which', return_value='/usr/bin/nvidia-smi'), \
+                mock.patch('subprocess.run', side_effect=run):
+            inventory = HardwareInventory(NvidiaSmiProbe())
+            self.assertEqual(inventory.gpu(1).total_memory, 40960 * MiB)
+            self.assertEqual(inventory.free_memory(), {0: 1024 * MiB, 1: 2048 * MiB})
+        with mock.patch('shutil.which', return_value=None):
+            self.assertEqual(NvidiaSmiProbe().devices(), [])
+
+    def test_hwfetch_uses_inventory(self):
+        app = ExampleClamsApp()
+        probe = FakeProbe(A100S)
+        set_probe(probe)
+        with mock.patch.dict(sys.modules, {'torch': None}):
+            out = app.annotate(ExampleInputMMIF.get_mmif(), hwFetch=['true'])
+        # neither the CUDA profiler nor hwFetch probes the hardware again
+        self.assertEqual(probe.calls, 1)
+        self.assertIn('NVIDIA A100, With 40960 MiB', out)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import json
+import os
+import pathlib
+import tempfile
+import unittest
+
+import clams
+from clams.metrics import Metrics, COUNTER, HISTOGRAM, LIVESUM, LATEST
+from tests.test_clamsapp import ExampleClamsApp, ExampleInputMMIF
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics_dir = tempfile.TemporaryDirectory()
+        self.metrics = Metrics(self.metrics_dir.name)
+        self.metrics.register('reqs', COUNTER, 'requests')
+        self.metrics.register('lat', HISTOGRAM, 'latency', buckets=(0.1, 1.0))
+        self.metrics.register('inflight', LIVESUM, 'in flight')
+        self.metrics.register('peak', LATEST, 'peak')
+
+    def tearDown(self):
+        self.metrics_dir.cleanup()
+
+    def write_dead_worker(self, values):
+        # no process can have a pid this large (the default pid_max is 2**22)
+        with open(f'{self.metrics_dir.name}/{2 ** 22 + 1}.json', 'w') as f:
+            json.dump(values, f)
+
+    def test_exposition(self):
+        self.metrics.inc('reqs', status='200')
+        self.metrics.inc('reqs', status='200')
+        self.metrics.observe('lat', 0.5, phase='annotate')
+        self.metrics.observe('lat', 5, phase='annotate')
+        self.metrics.inc('inflight')
+        text = self.metrics.exposition()
+        self.assertIn('# TYPE reqs counter', text)
+        self.assertIn('reqs{status="200"} 2', text)
+        self.assertIn('lat_bucket{phase="annotate",le="0.1"} 0', text)
+        self.assertIn('lat_bucket{phase="annotate",le="1"} 1', text)
+        self.assertIn('lat_bucket{phase="annotate",le="+Inf"} 2', text)
+        self.assertIn('lat_sum{phase="annotate"} 5.5', text)
+        self.assertIn('lat_count{phase="annotate"} 2', text)
+        self.assertIn('# TYPE inflight gauge', text)
+        self.assertIn('inflight 1', text)
+
+    def test_deferred_writes(self):
+        metrics = Metrics(self.metrics_dir.name, flush_interval=0)
+        metrics.register('reqs', COUNTER, 'requests')
+        metrics.inc('reqs')
+        path = pathlib.Path(self.metrics_dir.name) / f'{os.getpid()}.json'
+        self.assertFalse(path.exists())
+        metrics.flush()
+        self.assertEqual(json.loads(path.read_text()), {'reqs': {'[]': [1]}})
+        metrics.inc('reqs')
+        self.assertIn('reqs 2', metrics.exposition())
+
+    def test_aggregates_exited_workers(self):
+        self.write_dead_worker({
+            'reqs': {'[["status", "200"]]': [3]},
+            'lat': {'[]': [[1, 1], 0.05, 1]},
+            'inflight': {'[]': [1]},
+            'peak': {'[]': [100, 0.0]},
+        })
+        self.metrics.inc('reqs', status='200')
+        self.metrics.observe('lat', 0.5)
+        self.metrics.set('peak', 200)
+        for _ in range(2):
+            # the second time, values of the exited worker come from the archive
+            text = self.metrics.exposition()
+            self.assertIn('reqs{status="200"} 4', text)
+            self.assertIn('lat_bucket{le="1"} 2', text)
+            self.assertIn('lat_count 2', text)
+            # in-flight requests of exited workers are gone
+            self.assertIn('inflight', text)
+            self.assertNotIn('inflight 1', text)
+            self.assertIn('peak 200', text)
+
+    def test_metrics_endpoint(self):
+        app = ExampleClamsApp()
+        # wrapping an app again shares the metrics, and doesn't count its phases twice
+        clams.Restifier(app, metrics_dir=self.metrics_dir.name)
+        restifier = clams.Restifier(app, metrics_dir=self.metrics_dir.name)
+        self.assertEqual(len(app.phase_timing_hooks), 1)
+        self.assertIs(restifier.metrics, clams.Restifier(ExampleClamsApp(), metrics_dir=self.metrics_dir.name).metrics)
+        self.assertEqual(clams.Restifier(app).metrics.metrics_dir, clams.Restifier(app).metrics.metrics_dir)
+        client = restifier.test_client()
+        client.post('/', data=ExampleInputMMIF.get_mmif())
+        client.post('/', data=ExampleInputMMIF.get_mmif(), query_string={'raise_error': True})
+        res = client.get('/metrics')
+        self.assertEqual(res.status_code, 200)
+        text = res.get_data(as_text=True)
+        self.assertIn('clams_requests_total{method="POST",status="200"} 1', text)
+        self.assertIn('clams_requests_total{method="POST",status="500"} 1', text)
+        self.assertIn('clams_error_views_total 1', text)
+        self.assertIn('clams_requests_in_flight 0', text)
+        for phase in ('decode', 'refine', 'annotate', 'warnings', 'serialize'):
+            self.assertIn(f'clams_phase_duration_seconds_count{{phase="{phase}"}} 1', text)
+
+
+if __name__ == '__main__':
+    unittest.main()
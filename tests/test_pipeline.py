@@ -0,0 +1,51 @@
+import json
+import unittest
+
+from mmif import Mmif
+
+from clams.pipeline import Pipeline
+from tests.test_clamsapp import ExampleClamsApp, ExampleInputMMIF
+
+
+class TestPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.app = ExampleClamsApp()
+        self.mmif_str = ExampleInputMMIF.get_mmif()
+
+    def test_annotate(self):
+        pipeline = Pipeline([self.app, (self.app, {'undefined': ['x']})])
+        self.assertEqual(pipeline.names, [str(self.app.metadata.identifier), f'{self.app.metadata.identifier}#2'])
+        reported = []
+        pipeline.timing_hooks.append(reported.append)
+        app_reported = []
+        self.app.phase_timing_hooks.append(app_reported.append)
+        output = pipeline.annotate(self.mmif_str, pretty=['true'])
+        self.assertIn('\n', output)
+        views = list(Mmif(output).views)
+        # an app view and a warnings view per stage
+        self.assertEqual(len(views), 4)
+        self.assertEqual(len(views[1].metadata.warnings), 1)
+        self.assertEqual(len(views[3].metadata.warnings), 2)
+        self.assertEqual(views[3].metadata.parameters, {'pretty': 'true', 'undefined': 'x'})
+        self.assertEqual(list(reported[0]), ['decode'] + pipeline.names + ['serialize'])
+        self.assertEqual(len(app_reported), 2)
+
+    def test_run(self):
+        mmif = Mmif(self.mmif_str)
+        self.assertIs(Pipeline([self.app]).run(mmif), mmif)
+        self.assertEqual(len(mmif.views), 2)
+        self.assertEqual(len(self.app.annotate_mmif(mmif).views), 4)
+        envelope = json.dumps({'parameters': {'raise_error': 'true'}, 'mmif': json.loads(self.mmif_str)})
+        with self.assertRaises(ValueError):
+            Pipeline([self.app]).run(envelope)
+
+    def test_invalid_stages(self):
+        with self.assertRaises(ValueError):
+            Pipeline([])
+        with self.assertRaises(TypeError):
+            Pipeline([self.app, 'not an app'])
+
+
+if __name__ == '__main__':
+    unittest.main()
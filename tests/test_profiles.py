@@ -0,0 +1,150 @@
+import io
+import json
+import multiprocessing
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from clams.profiles import HostUsageMeter, ProfileStore, profile_store_path
+from tests.test_clamsapp import ExampleClamsApp, ExampleInputMMIF
+
+
+def _record_many(path, n):
+    store = ProfileStore(path)
+    for i in range(n):
+        store.record('h', wall_time=float(i))
+
+
+class TestProfileStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.path = f'{self.tmpdir.name}/profiles.sqlite3'
+
+    def test_stats(self):
+        store = ProfileStore(self.path)
+        self.assertIsNone(store.stats('a', 'vram_peak'))
+        for i in range(1, 101):
+            store.record('a', {'pretty': False}, vram_peak=i, input_size=10)
+        store.record('b', wall_time=1.5)
+        self.assertEqual(store.stats('a', 'vram_peak'), {'count': 100, 'p50': 50, 'p95': 95, 'max': 100})
+        self.assertIsNone(store.stats('a', 'wall_time'))
+        self.assertEqual(store.stats(None, 'wall_time')['max'], 1.5)
+        self.assertEqual(store.param_hashes(), {'a': {'pretty': False}, 'b': None})
+        with self.assertRaises(ValueError):
+            store.record('a', gpu_peak=1)
+
+    def test_keeps_latest_samples(self):
+        store = ProfileStore(self.path, max_samples=5)
+        for i in range(10):
+            store.record('a', vram_peak=i)
+        self.assertEqual(store.stats('a', 'vram_peak'), {'count': 5, 'p50': 7, 'p95': 9, 'max': 9})
+
+    def test_record_async(self):
+        store = ProfileStore(self.path, write_delay=0.05)
+        self.assertIsNone(store.cached_stats('a', 'vram_peak'))
+        store.record_async('a', {'pretty': True}, vram_peak=1)
+        store.record_async('a', vram_peak=2)
+        store.flush()
+        self.assertEqual(store.stats('a', 'vram_peak')['count'], 2)
+        # cached answers are refreshed when buffered samples are written
+        self.assertEqual(store.cached_stats('a', 'vram_peak')['count'], 2)
+        store.record_async('a', vram_peak=3)
+        with mock.patch.object(store, 'stats', wraps=store.stats) as stats:
+            for _ in range(100):
+                if store.cached_stats('a', 'vram_peak')['count'] == 3:
+                    break
+                time.sleep(0.05)
+            # refreshed by the background writer, not by the queries
+            self.assertEqual(stats.call_count, 1)
+        self.assertEqual(ProfileStore(self.path).stats('a', 'vram_peak')['count'], 3)
+        with self.assertRaises(ValueError):
+            store.record_async('a', gpu_peak=1)
+
+    def test_export_import(self):
+        store = ProfileStore(self.path)
+        store.record('a', {'pretty': True}, vram_peak=1, wall_time=0.5)
+        store.record('b', rss_peak=2)
+        out = io.StringIO()
+        self.assertEqual(store.export_samples(out), 2)
+        other = ProfileStore(f'{self.tmpdir.name}/other.sqlite3')
+        self.assertEqual(other.import_samples(io.StringIO(out.getvalue())), 2)
+        self.assertEqual(list(other.samples()), list(store.samples()))
+
+    def test_concurrent_processes(self):
+        workers = [multiprocessing.Process(target=_record_many, args=(self.path, 50)) for _ in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(30)
+        self.assertEqual(ProfileStore(self.path).stats('h', 'wall_time')['count'], 200)
+
+    def test_older_store_gets_new_columns(self):
+        import sqlite3
+        with sqlite3.connect(self.path) as conn:
+            conn.execute("CREATE TABLE samples (id INTEGER PRIMARY KEY, param_hash TEXT NOT NULL, "
+                         "recorded REAL NOT NULL, vram_peak INTEGER)")
+        store = ProfileStore(self.path)
+        store.record('a', cpu_time=0.5, rss_peak=1)
+        self.assertEqual(store.stats('a', 'cpu_time')['max'], 0.5)
+
+    def test_host_usage_meter(self):
+        with HostUsageMeter() as small:
+            pass
+        with HostUsageMeter() as large:
+            block = bytearray(64 * 1024 * 1024)
+            sum(range(100000))
+        del block
+        self.assertGreaterEqual(large.rss_peak, small.rss_peak + 32 * 1024 * 1024)
+        self.assertGreater(large.cpu_time, 0)
+
+    def test_concurrent_meters_dont_reset(self):
+        with mock.patch('clams.profiles._reset_peak_rss', return_value=True) as reset:
+            with HostUsageMeter() as outer:
+                with HostUsageMeter() as inner:
+                    pass
+            with HostUsageMeter():
+                pass
+        # only meters that had the process to themselves reset the peak
+        self.assertEqual(reset.call_count, 2)
+        self.assertLessEqual(inner.rss_peak, outer.rss_peak)
+
+    def test_app_records_host_usage(self):
+        with mock.patch.dict('os.environ', {'XDG_CACHE_HOME': self.tmpdir.name}):
+            app = ExampleClamsApp()
+            self.assertEqual(app._estimate_process_memory('rss_peak'), (0, 'unknown'))
+            app.metadata.est_host_mem_typ = 100
+            self.assertEqual(app._estimate_process_memory('rss_peak')[0], 100 * 1024 * 1024)
+            mmif_str = ExampleInputMMIF.get_mmif()
+            app.annotate(mmif_str)
+            app.annotate(mmif_str, pretty=['true'])
+            store = app._get_profile_store()
+            self.assertEqual(len(store.param_hashes()), 2)
+            samples = list(store.samples())
+            self.assertEqual(samples[0]['input_size'], len(mmif_str))
+            self.assertIsNone(samples[0]['vram_peak'])
+            self.assertGreater(samples[0]['rss_peak'], 0)
+            self.assertIsNotNone(samples[0]['cpu_time'])
+            self.assertEqual(app._estimate_process_memory('rss_peak')[0], store.stats(None, 'rss_peak')['p95'])
+            # opted out
+            app.resource_profiling = False
+            app.annotate(mmif_str)
+            self.assertEqual(len(list(store.samples())), 2)
+
+    def test_app_imports_legacy_profiles(self):
+        with mock.patch.dict('os.environ', {'XDG_CACHE_HOME': self.tmpdir.name}):
+            app = ExampleClamsApp()
+            path = profile_store_path(app.metadata.identifier)
+            legacy_dir = path.parent.parent / 'memory_profiles' / path.stem
+            legacy_dir.mkdir(parents=True)
+            (legacy_dir / 'memory_abc.json').write_text(json.dumps({'peak_bytes': 42, 'parameters': {'x': 1}}))
+            store = app._get_profile_store()
+        self.assertEqual(store.path, path)
+        self.assertEqual(store.stats('abc', 'vram_peak')['max'], 42)
+        self.assertEqual(store.param_hashes(), {'abc': {'x': 1}})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,6 +8,9 @@ promptable-param names, ``build_conversation()`` shape across the
 single-turn / turn-taking / user-only modes, and the
 ``response_to_grounded_textdocument()`` output contract.
 """
+import os
+import threading
+import time
 import unittest
 
 from mmif import AnnotationTypes, Document, DocumentTypes, Mmif
@@ -493,6 +496,117 @@ class TestTransportNeutralCasting(unittest.TestCase):
         self.assertEqual(refined['prompt'], ['only'])
 
 
+# ---------------------------------------------------------------------------
+# Cross-request micro-batching
+# ---------------------------------------------------------------------------
+
+class TestMicroBatching(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+        calls = self.calls
+
+        def generate(app, prompt, system_prompt='', images=None,
+                     audios=None, prompt_mode='turn-taking', **kw):
+            calls.append(images)
+            if kw.get('fail'):
+                raise RuntimeError('boom')
+            if images is None:
+                return [prompt[0]]
+            return [f"{prompt[0]}:{g[0]}" for g in images]
+
+        self.app = make_test_app(make_metadata(call_helper=True))
+        # replace the fixture's generate with the recording one
+        type(self.app).generate = generate
+
+    def run_concurrently(self, *calls):
+        barrier = threading.Barrier(len(calls))
+        results = [None] * len(calls)
+
+        def call(i, kwargs):
+            barrier.wait()
+            try:
+                results[i] = self.app.generate(['describe'], **kwargs)
+            except Exception as e:
+                results[i] = e
+
+        threads = [threading.Thread(target=call, args=(i, kw))
+                   for i, kw in enumerate(calls)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+    def test_off_by_default(self):
+        self.assertEqual(self.app.max_batch_size, 1)
+        self.run_concurrently({'images': [['a']]}, {'images': [['b']]})
+        self.assertEqual(len(self.calls), 2)
+
+    def test_concurrent_calls_share_generate(self):
+        self.app.enable_micro_batching(max_batch_size=4, max_wait=5)
+        results = self.run_concurrently(
+            {'images': [['a']]}, {'images': [['b'], ['c']]}, {'images': [['d']]})
+        # the batch was full, so it didn't wait for the timeout
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(sorted(g[0] for g in self.calls[0]), ['a', 'b', 'c', 'd'])
+        self.assertEqual(results, [['describe:a'], ['describe:b', 'describe:c'], ['describe:d']])
+
+    def test_overflowed_batch_runs_without_waiting(self):
+        self.app.enable_micro_batching(max_batch_size=3, max_wait=5)
+        batcher = self.app.generate
+        results = {}
+
+        def call(name, images):
+            results[name] = self.app.generate(['describe'], images=images)
+
+        first = threading.Thread(target=call, args=('first', [['a'], ['b']]))
+        first.start()
+        while not batcher._open:
+            time.sleep(0.01)
+        # doesn't fit into the first batch, starts a new one
+        second = threading.Thread(target=call, args=('second', [['c'], ['d']]))
+        second.start()
+        first.join(timeout=2)
+        self.assertFalse(first.is_alive())
+        self.assertEqual(results['first'], ['describe:a', 'describe:b'])
+        # fills up the second batch
+        call('third', [['e']])
+        second.join(timeout=2)
+        self.assertFalse(second.is_alive())
+        self.assertEqual(results['second'], ['describe:c', 'describe:d'])
+        self.assertEqual(results['third'], ['describe:e'])
+        self.assertEqual(len(self.calls), 2)
+
+    def test_incompatible_calls_not_merged(self):
+        self.app.enable_micro_batching(max_batch_size=8, max_wait=0.05)
+        results = self.run_concurrently(
+            {'images': [['a']], 'temperature': 0.0},
+            {'images': [['b']], 'temperature': 0.5},
+            {})
+        self.assertEqual(len(self.calls), 3)
+        self.assertEqual(results, [['describe:a'], ['describe:b'], ['describe']])
+
+    def test_error_propagates_to_all_callers(self):
+        self.app.enable_micro_batching(max_batch_size=2, max_wait=5)
+        results = self.run_concurrently(
+            {'images': [['a']], 'fail': True}, {'images': [['b']], 'fail': True})
+        self.assertEqual(len(self.calls), 1)
+        for r in results:
+            self.assertIsInstance(r, RuntimeError)
+
+    def test_enable_from_env(self):
+        os.environ['CLAMS_BATCH_MAX_SIZE'] = '3'
+        try:
+            app = make_test_app(make_metadata(call_helper=True))
+        finally:
+            del os.environ['CLAMS_BATCH_MAX_SIZE']
+        self.assertEqual(app.max_batch_size, 3)
+        self.assertEqual(app.generate(['hi'], images=[['x']]), [''])
+        app.enable_micro_batching(1)
+        self.assertNotIn('generate', app.__dict__)
+
+
 # ---------------------------------------------------------------------------
 # ClamsHFPromptableApp class-attribute validation
 # ---------------------------------------------------------------------------